@@ -0,0 +1,302 @@
+# ./app/artifacts.py
+
+import bisect
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from array import array
+from collections import Counter
+import numpy as np
+from scipy import sparse
+
+# Формат каталога с моделями: меняется при несовместимых изменениях раскладки файлов
+ARTIFACT_FORMAT = 1
+KEEP_VERSIONS = 2
+
+
+# Версионированные каталоги: models/<name>/<version>/..., текущая версия записана в models/<name>/CURRENT
+def new_version_dir(root, name):
+    version = time.strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(root, name, version)
+    suffix = 1
+    while os.path.exists(path):
+        path = os.path.join(root, name, f"{version}-{suffix}")
+        suffix += 1
+    os.makedirs(path)
+    return path
+
+
+def write_manifest(path, manifest):
+    manifest = dict(manifest, format=ARTIFACT_FORMAT, created=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    with open(os.path.join(path, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+
+def read_manifest(path):
+    with open(os.path.join(path, 'manifest.json'), encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('format') != ARTIFACT_FORMAT:
+        raise ValueError(f"Неподдерживаемый формат моделей в {path}: {manifest.get('format')}")
+    return manifest
+
+
+# Указатели (CURRENT, SEGMENTS) подменяются через os.replace: читатель видит либо старое, либо новое содержимое
+def write_pointer(pointer, content):
+    with open(pointer + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(pointer + '.tmp', pointer)
+
+
+def publish(path, manifest):
+    """Записывает manifest.json и атомарно переключает CURRENT на новую версию."""
+    write_manifest(path, manifest)
+    base, version = os.path.split(path)
+    write_pointer(os.path.join(base, 'CURRENT'), version)
+    # Старые версии удаляем, но оставляем предыдущую для отката
+    versions = sorted(entry for entry in os.listdir(base) if os.path.isdir(os.path.join(base, entry)))
+    for old in versions[:-KEEP_VERSIONS]:
+        if old != version:
+            shutil.rmtree(os.path.join(base, old), ignore_errors=True)
+
+
+def current_version(root, name):
+    with open(os.path.join(root, name, 'CURRENT')) as f:
+        return f.read().strip()
+
+
+def current_dir(root, name):
+    path = os.path.join(root, name, current_version(root, name))
+    return path, read_manifest(path)
+
+
+# Дельта-сегменты версии: каталоги <version>/segments/<segment>, список активных — в <version>/SEGMENTS
+def read_segments(path):
+    try:
+        with open(os.path.join(path, 'SEGMENTS'), encoding='utf-8') as f:
+            return [line for line in f.read().split('\n') if line]
+    except FileNotFoundError:
+        return []
+
+
+def write_segments(path, segments):
+    write_pointer(os.path.join(path, 'SEGMENTS'), ''.join(f"{segment}\n" for segment in segments))
+
+
+def load_array(path, name, mmap=True):
+    return np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r' if mmap else None)
+
+
+# Список строк в одном блобе UTF-8 со смещениями: читается через memmap без распаковки
+class StringTable:
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        return bytes(self.blob[self.offsets[idx]:self.offsets[idx + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        return (self[idx] for idx in range(len(self)))
+
+    @staticmethod
+    def save(path, name, strings):
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(item) for item in encoded], out=offsets[1:])
+        np.save(os.path.join(path, f"{name}_blob.npy"), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        np.save(os.path.join(path, f"{name}_offsets.npy"), offsets)
+
+    @classmethod
+    def load(cls, path, name):
+        return cls(load_array(path, f"{name}_blob"), load_array(path, f"{name}_offsets"))
+
+
+# Потоковая запись StringTable: строки не держатся в памяти целиком
+class StringTableWriter:
+    def __init__(self, path, name, chunk_size=1 << 24):
+        self.path = path
+        self.name = name
+        self.chunk_size = chunk_size
+        self.offsets = array('q', [0])
+        self.buffer = tempfile.TemporaryFile(dir=path)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def append(self, string):
+        encoded = string.encode('utf-8')
+        self.buffer.write(encoded)
+        self.offsets.append(self.offsets[-1] + len(encoded))
+
+    def close(self):
+        # Блоб переливается из временного файла в .npy кусками (memmap нулевой длины numpy не создаёт)
+        blob_path = os.path.join(self.path, f"{self.name}_blob.npy")
+        if self.offsets[-1]:
+            blob = np.lib.format.open_memmap(blob_path, mode='w+', dtype=np.uint8, shape=(self.offsets[-1],))
+            self.buffer.seek(0)
+            position = 0
+            while chunk := self.buffer.read(self.chunk_size):
+                blob[position:position + len(chunk)] = np.frombuffer(chunk, dtype=np.uint8)
+                position += len(chunk)
+            blob.flush()
+            del blob
+        else:
+            np.save(blob_path, np.zeros(0, dtype=np.uint8))
+        self.buffer.close()
+        np.save(os.path.join(self.path, f"{self.name}_offsets.npy"), np.frombuffer(self.offsets, dtype=np.int64))
+
+
+# TF-IDF без pickle: отсортированный словарь (номер терма = позиция) и вектор idf.
+# Повторяет TfidfVectorizer(analyzer='word', norm='l2') из scikit-learn
+class TfidfModel:
+    def __init__(self, terms, idf, ngram_range=(1, 2), token_pattern=r"(?u)\b\w\w+\b", lowercase=True):
+        self.terms = terms
+        self.idf = idf
+        self.ngram_range = tuple(ngram_range)
+        self.token_pattern = re.compile(token_pattern)
+        self.lowercase = lowercase
+
+    @classmethod
+    def from_vectorizer(cls, vectorizer):
+        terms = sorted(vectorizer.vocabulary_, key=vectorizer.vocabulary_.get)
+        if any(left >= right for left, right in zip(terms, terms[1:])):
+            raise ValueError("Словарь векторайзера должен быть упорядочен по алфавиту")
+        return cls(terms, vectorizer.idf_, vectorizer.ngram_range, vectorizer.token_pattern, vectorizer.lowercase)
+
+    def save(self, path, name):
+        StringTable.save(path, f"{name}_terms", self.terms)
+        np.save(os.path.join(path, f"{name}_idf.npy"), np.asarray(self.idf))
+        return {'ngram_range': list(self.ngram_range), 'token_pattern': self.token_pattern.pattern,
+                'lowercase': self.lowercase, 'n_features': len(self.terms)}
+
+    @classmethod
+    def load(cls, path, name, params):
+        return cls(StringTable.load(path, f"{name}_terms"), load_array(path, f"{name}_idf"),
+                   params['ngram_range'], params['token_pattern'], params['lowercase'])
+
+    def analyze(self, text):
+        if self.lowercase:
+            text = text.lower()
+        tokens = self.token_pattern.findall(text)
+        low, high = self.ngram_range
+        ngrams = []
+        for n in range(low, high + 1):
+            ngrams.extend(' '.join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+        return ngrams
+
+    def term_index(self, term):
+        idx = bisect.bisect_left(self.terms, term)
+        if idx < len(self.terms) and self.terms[idx] == term:
+            return idx
+        return None
+
+    def transform(self, texts):
+        indptr, indices, data = [0], [], []
+        for text in texts:
+            counts = Counter()
+            for term in self.analyze(text):
+                idx = self.term_index(term)
+                if idx is not None:
+                    counts[idx] += 1
+            columns = np.array(sorted(counts), dtype=np.int32)
+            values = np.array([counts[idx] for idx in columns], dtype=np.float64) * self.idf[columns]
+            norm = np.sqrt((values ** 2).sum())
+            if norm:
+                values /= norm
+            indices.extend(columns)
+            data.extend(values)
+            indptr.append(len(indices))
+        return sparse.csr_matrix((np.array(data, dtype=np.float64), np.array(indices, dtype=np.int32),
+                                  np.array(indptr, dtype=np.int32)), shape=(len(texts), len(self.terms)))
+
+
+# Линейный классификатор (LinearSVC) без pickle: коэффициенты, смещения и классы
+class LinearModel:
+    def __init__(self, coef, intercept, classes):
+        self.coef = coef
+        self.intercept = intercept
+        self.classes = classes
+
+    @classmethod
+    def from_estimator(cls, estimator):
+        return cls(estimator.coef_, estimator.intercept_, list(estimator.classes_))
+
+    def save(self, path, name):
+        np.save(os.path.join(path, f"{name}_coef.npy"), np.asarray(self.coef))
+        np.save(os.path.join(path, f"{name}_intercept.npy"), np.asarray(self.intercept))
+        StringTable.save(path, f"{name}_classes", self.classes)
+        return {'n_classes': len(self.classes)}
+
+    @classmethod
+    def load(cls, path, name):
+        classes = list(StringTable.load(path, f"{name}_classes"))
+        return cls(load_array(path, f"{name}_coef"), load_array(path, f"{name}_intercept"), classes)
+
+    def decision_function(self, matrix):
+        scores = matrix @ np.asarray(self.coef).T + self.intercept
+        return scores.ravel() if scores.shape[1] == 1 else scores
+
+    def predict(self, matrix):
+        scores = self.decision_function(matrix)
+        if scores.ndim == 1:
+            return [self.classes[int(score > 0)] for score in scores]
+        return [self.classes[idx] for idx in scores.argmax(axis=1)]
+
+
+# Тональный словарь без словаря Python: леммы в UTF-8, отсортированные байтово, и оценки float32.
+# Пачка слов ищется одним np.searchsorted
+class TonalLexicon:
+    def __init__(self, words, scores):
+        self.words = words
+        self.scores = scores
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """Из пар (лемма, оценка); у повторяющейся леммы остаётся последняя оценка."""
+        merged = {word.encode('utf-8'): score for word, score in pairs if word}
+        words = sorted(merged)
+        return cls(np.array(words, dtype=f"S{max(map(len, words), default=1)}"),
+                   np.array([merged[word] for word in words], dtype=np.float32))
+
+    def save(self, path, name):
+        np.save(os.path.join(path, f"{name}_words.npy"), self.words)
+        np.save(os.path.join(path, f"{name}_scores.npy"), self.scores)
+        return {'n_words': len(self.words)}
+
+    @classmethod
+    def load(cls, path, name):
+        return cls(load_array(path, f"{name}_words"), load_array(path, f"{name}_scores"))
+
+    def __len__(self):
+        return len(self.words)
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes + self.scores.nbytes
+
+    def score(self, word):
+        """Оценка одного слова или None: двоичный поиск без создания массивов."""
+        encoded = word.encode('utf-8')
+        idx = bisect.bisect_left(self.words, encoded)
+        if idx < len(self.words) and self.words[idx] == encoded:
+            return float(self.scores[idx])
+        return None
+
+    def lookup(self, words):
+        """Оценки слов массива words (байтовые строки UTF-8); NaN для слов не из словаря."""
+        result = np.full(len(words), np.nan, dtype=np.float32)
+        if not len(self.words) or not len(words):
+            return result
+        positions = np.searchsorted(self.words, words)
+        clipped = np.minimum(positions, len(self.words) - 1)
+        found = self.words[clipped] == words
+        result[found] = self.scores[clipped[found]]
+        return result
@@ -0,0 +1,1169 @@
+# ./app/benchmark.py
+
+import argparse
+import gc
+import asyncio
+import io
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+import bot as bot_module
+import logs
+import metrics
+from artifacts import TonalLexicon
+from dialogue_index import DialogueIndex, LiveDialogueIndex
+from retrieval import DialogueRetriever, IVFIndex, exact_dense_search
+from state import SQLiteStateStore, UserState
+import stt
+import tts
+from train_dialogues_model import DIALOGUES_PATH, iter_dialogues, train
+from update_dialogues_model import compact, update
+import utils
+from utils import get_config, lemmatize_batch, logger, reload_changed_components
+
+# Типовые реплики для нагрузочного теста
+LOAD_MESSAGES = [
+    'привет', 'сколько стоит цезарь', 'цена?', 'да', 'покажи салаты', 'блюда до 400 рублей',
+    'что в меню?', 'как дела', 'расскажи про борщ', 'посоветуй блюдо', 'нет', 'хочу заказать котлету',
+    'какая погода', 'ыыы', 'пока'
+]
+
+
+async def load_test_run(users, messages_per_user):
+    contexts = [SimpleNamespace(user_data={}) for _ in range(users)]
+    processed = [[] for _ in range(users)]
+
+    async def send(user_id, idx):
+        replica = LOAD_MESSAGES[idx % len(LOAD_MESSAGES)]
+        if await bot_module.bot_async(replica, contexts[user_id]):
+            processed[user_id].append(idx)
+
+    # Все сообщения отправляются сразу, порядок внутри пользователя держит run_for_user
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        bot_module.run_for_user(user_id, send, user_id, idx)
+        for idx in range(messages_per_user) for user_id in range(users)
+    ))
+    elapsed = time.perf_counter() - start
+    ordered = all(items == sorted(items) for items in processed)
+    return elapsed, ordered, sum(len(items) for items in processed)
+
+
+def load_test(mode, workers_list, users, messages_per_user):
+    """Пропускная способность bot() в зависимости от числа воркеров."""
+    results = []
+    for workers in workers_list:
+        bot_module.configure_executor(mode, workers)
+        # Прогрев: индексы и пул воркеров
+        asyncio.run(load_test_run(workers, 1))
+        elapsed, ordered, _ = asyncio.run(load_test_run(users, messages_per_user))
+        total = users * messages_per_user
+        results.append({'mode': mode, 'workers': workers, 'messages': total,
+                        'seconds': round(elapsed, 3), 'msg_per_sec': round(total / elapsed, 1),
+                        'ordered': ordered})
+        logger.info(f"Нагрузочный тест: {results[-1]}")
+    bot_module.configure_executor('inline')
+    return results
+
+
+# Синтетический корпус вопросов с распределением слов по Ципфу
+def synthetic_corpus(size, vocabulary_size=20000, seed=0):
+    rng = random.Random(seed)
+    syllables = ['ка', 'ло', 'ми', 'ну', 'пре', 'сто', 'ра', 'ве', 'ти', 'жо', 'бы', 'де', 'зу', 'ша', 'гри', 'мо']
+    vocabulary = [''.join(rng.choices(syllables, k=rng.randint(2, 4))) + str(idx) for idx in range(vocabulary_size)]
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, vocabulary_size + 1)))
+    return [' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(3, 11))) for _ in range(size)]
+
+
+def retrieval_benchmark(sizes, queries=200):
+    """Сравнение полного перебора cosine_similarity и поиска по инвертированному индексу."""
+    results = []
+    for size in sizes:
+        corpus = synthetic_corpus(size)
+        vectorizer = TfidfVectorizer(analyzer='word', ngram_range=(1, 2), lowercase=True)
+        matrix = vectorizer.fit_transform(corpus)
+        retriever = DialogueRetriever.from_matrix(matrix)
+        rng = np.random.default_rng(1)
+        # Запрос — укороченный вопрос из корпуса
+        query_texts = [' '.join(corpus[idx].split()[:4]) for idx in rng.integers(0, size, size=queries)]
+        vectors = [vectorizer.transform([text]) for text in query_texts]
+
+        start = time.perf_counter()
+        brute = []
+        for vector in vectors:
+            similarities = cosine_similarity(vector, matrix).flatten()
+            best_idx = similarities.argmax()
+            brute.append((int(best_idx), float(similarities[best_idx])))
+        brute_ms = (time.perf_counter() - start) / queries * 1000
+
+        start = time.perf_counter()
+        indexed = [retriever.search(vector, k=1) for vector in vectors]
+        indexed_ms = (time.perf_counter() - start) / queries * 1000
+
+        same = sum(found[0][0] == best[0] for found, best in zip(indexed, brute) if found)
+        results.append({'size': size, 'brute_ms': round(brute_ms, 3), 'indexed_ms': round(indexed_ms, 3),
+                        'speedup': round(brute_ms / indexed_ms, 1), 'same_top1': f"{same}/{queries}"})
+        logger.info(f"Поиск по dialogues: {results[-1]}")
+    return results
+
+
+# Синтетические «эмбеддинги»: кластеры вокруг случайных центров
+def synthetic_embeddings(size, dim=300, clusters=200, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, size=size)] + rng.normal(scale=0.6, size=(size, dim)).astype(np.float32)
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float16)
+
+
+def ann_benchmark(vectors, probes, k=10, queries=200):
+    """recall@k IVF-индекса относительно точного перебора и задержка на запрос."""
+    index = IVFIndex.build(vectors)
+    rng = np.random.default_rng(1)
+    # Запрос — зашумлённый вектор из корпуса
+    query_rows = np.asarray(vectors[rng.integers(0, len(vectors), size=queries)], dtype=np.float32)
+    query_rows += rng.normal(scale=0.02, size=query_rows.shape).astype(np.float32)
+    query_rows /= np.linalg.norm(query_rows, axis=1, keepdims=True)
+
+    start = time.perf_counter()
+    exact = [{row for row, _ in exact_dense_search(vectors, query, k)} for query in query_rows]
+    exact_ms = (time.perf_counter() - start) / queries * 1000
+    results = [{'n_probe': 'перебор', 'recall': 1.0, 'ms': round(exact_ms, 3)}]
+    for n_probe in probes:
+        start = time.perf_counter()
+        found = [{row for row, _ in index.search(query, k, n_probe)} for query in query_rows]
+        elapsed_ms = (time.perf_counter() - start) / queries * 1000
+        recall = np.mean([len(a & b) / len(b) for a, b in zip(found, exact)])
+        results.append({'n_probe': n_probe, 'recall': round(float(recall), 3), 'ms': round(elapsed_ms, 3)})
+        logger.info(f"IVF: {results[-1]}")
+    return len(vectors), len(index.centroids), results
+
+
+def worker_config(dish):
+    """Цена блюда в CONFIG процесса-воркера; пауза, чтобы пробы разошлись по всем воркерам."""
+    time.sleep(0.2)
+    return os.getpid(), get_config()['dishes'][dish]['price']
+
+
+def reload_benchmark(mode, workers, users, messages_per_user, period, dish='цезарь'):
+    """Перезагрузка CONFIG под нагрузкой: задержка подмены и проверка, что ни одно сообщение не потеряно."""
+    total = users * messages_per_user
+    with tempfile.TemporaryDirectory() as root:
+        # Копия data/config.py, в которой меняется цена блюда. Путь задаётся до запуска пула:
+        # процессы-воркеры получают его при fork (или из BOT_CONFIG_PATH при spawn) и перезагружают CONFIG сами
+        config_path = os.path.join(root, 'config.py')
+        shutil.copy(utils.CONFIG_PATH, config_path)
+        original_path, utils.CONFIG_PATH = utils.CONFIG_PATH, config_path
+        original_env = os.environ.get('BOT_CONFIG_PATH')
+        os.environ['BOT_CONFIG_PATH'] = config_path
+        utils.config.reload()
+        bot_module.configure_executor(mode, workers)
+        asyncio.run(load_test_run(workers, 1))
+        elapsed, _, answered = asyncio.run(load_test_run(users, messages_per_user))
+        baseline = {'msg_per_sec': round(total / elapsed, 1), 'answered': answered}
+        price_pattern = re.compile(rf"('{dish}': {{\s*'price': )(\d+)")
+        written, latencies, prices = [], [], []
+        stop = threading.Event()
+
+        def write_config(price):
+            with open(config_path, encoding='utf-8') as f:
+                text = f.read()
+            # Файл подменяется атомарно; недописанный файл при правке на месте просто не перезагрузится
+            with open(config_path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(price_pattern.sub(rf"\g<1>{price}", text))
+            os.replace(config_path + '.tmp', config_path)
+            written.append(time.perf_counter())
+            prices.append(price)
+
+        def watch():
+            # То же, что start_reloader, но с частым опросом и замером задержки от записи файла до подмены
+            while not stop.is_set():
+                if reload_changed_components() and written:
+                    latencies.append(time.perf_counter() - written[-1])
+                time.sleep(0.01)
+
+        async def edit_config():
+            price = 1000
+            while not stop.is_set():
+                # Пауза прерывается окончанием нагрузки: правка после неё уже не проверяет подмену под нагрузкой
+                if await asyncio.to_thread(stop.wait, period):
+                    break
+                price += 1
+                await asyncio.to_thread(write_config, price)
+
+        async def run():
+            editor = asyncio.create_task(edit_config())
+            result = await load_test_run(users, messages_per_user)
+            stop.set()
+            await editor
+            return result
+
+        watcher = threading.Thread(target=watch, daemon=True)
+        watcher.start()
+        elapsed, ordered, answered = asyncio.run(run())
+        watcher.join()
+        reload_changed_components()
+        current = utils.config.get()
+        worker_prices = {}
+        if mode == 'process' and prices:
+            # Воркеры опрашивают файл сами раз в RELOAD_INTERVAL
+            time.sleep(bot_module.RELOAD_INTERVAL + 0.5)
+            probes = [bot_module.executor.submit(worker_config, dish) for _ in range(workers * 2)]
+            worker_prices = dict(probe.result() for probe in probes)
+        result = {'mode': mode, 'workers': workers, 'messages': total, 'answered': answered, 'ordered': ordered,
+                  'msg_per_sec': round(total / elapsed, 1), 'baseline': baseline, 'reloads': len(latencies),
+                  'latency_ms_median': round(float(np.median(latencies)) * 1000, 1) if latencies else None,
+                  'latency_ms_max': round(max(latencies) * 1000, 1) if latencies else None,
+                  'price_applied': bool(prices) and get_config()['dishes'][dish]['price'] == prices[-1]
+                  and all(price == prices[-1] for price in worker_prices.values()),
+                  'worker_prices': worker_prices,
+                  'indexes_prebuilt': set(current.derived) == set(utils.ConfigVersion.builders)}
+        bot_module.configure_executor('inline')
+        utils.CONFIG_PATH = original_path
+        if original_env is None:
+            del os.environ['BOT_CONFIG_PATH']
+        else:
+            os.environ['BOT_CONFIG_PATH'] = original_env
+        utils.config.reload()
+
+    # Перезагрузка моделей: новое значение собирается рядом со старым и подменяется присваиванием
+    start = time.perf_counter()
+    bot_module.models.reload()
+    result['models_reload_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    logger.info(f"Перезагрузка под нагрузкой: {result}")
+    return result
+
+
+def write_dialogues(path, questions, mode='w'):
+    with open(path, mode, encoding='utf-8') as f:
+        for idx, question in enumerate(questions):
+            f.write(f"- {question}\n- ответ {idx}\n\n")
+
+
+def top_row(index, text):
+    found = index.search(text)
+    return found[0][0] if found else None
+
+
+def append_benchmark(base_size, pairs, queries=200):
+    """Цена добавления pairs пар: дельта-сегмент против полного переобучения, и проверка слияния."""
+    corpus = synthetic_corpus(base_size + pairs)
+    with tempfile.TemporaryDirectory() as root:
+        dialogues_path = os.path.join(root, 'dialogues.txt')
+        write_dialogues(dialogues_path, corpus[:base_size])
+        train(dialogues_path, root)
+        live = LiveDialogueIndex(root, interval=0)
+
+        write_dialogues(dialogues_path, corpus[base_size:], mode='a')
+        start = time.perf_counter()
+        update(dialogues_path, root)
+        update_s = time.perf_counter() - start
+        start = time.perf_counter()
+        live.refresh()
+        refreshed = live.get()
+        refresh_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        compact(root)
+        compact_s = time.perf_counter() - start
+        compacted = DialogueIndex.load(root)
+
+        start = time.perf_counter()
+        train(dialogues_path, root)
+        retrain_s = time.perf_counter() - start
+        retrained = DialogueIndex.load(root)
+
+        # Запросы — укороченные вопросы из добавленных пар
+        rng = random.Random(1)
+        query_texts = lemmatize_batch([' '.join(rng.choice(corpus[base_size:]).split()[:4]) for _ in range(queries)])
+        same_segmented = sum(top_row(refreshed, text) == top_row(retrained, text) for text in query_texts)
+        same_compacted = sum(compacted.search(text, k=5) == retrained.search(text, k=5) for text in query_texts)
+    result = {'base': base_size, 'pairs': pairs, 'update_s': round(update_s, 2), 'refresh_ms': round(refresh_ms, 1),
+              'retrain_s': round(retrain_s, 2), 'compact_s': round(compact_s, 2), 'rows': len(refreshed),
+              'same_top1_segmented': f"{same_segmented}/{queries}", 'same_compacted': f"{same_compacted}/{queries}"}
+    logger.info(f"Дообучение dialogues: {result}")
+    return result
+
+
+def simulated_users(users, seed=0):
+    """Поля состояний как после нескольких реплик: общие названия блюд и намерений, свои реплики и ответ."""
+    config = get_config()
+    dishes = list(config['dishes'].keys())
+    intents = list(config['intents'].keys())
+    states = ['NONE', 'WAITING_FOR_DISH', 'WAITING_FOR_INTENT']
+    rng = random.Random(seed)
+    for user_id in range(users):
+        history = [f"реплика {user_id} {idx}" for idx in range(5)]
+        yield (user_id, rng.choice(states), rng.choice(dishes), rng.choice(intents), f"ответ пользователю {user_id}",
+               history, {'intent': rng.randrange(50), 'generate': rng.randrange(50), 'failure': rng.randrange(5)})
+
+
+def measure(build):
+    tracemalloc.start()
+    value = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return value, size
+
+
+def state_benchmark(users, lookups=10000):
+    """Память на пользователя (словарь user_data против UserState) и скорость записи в SQLite."""
+    rows = list(simulated_users(users))
+    strings = sum(sys.getsizeof(response) + sum(map(sys.getsizeof, history)) for *_, response, history, _ in rows)
+    dicts, dict_bytes = measure(lambda: [
+        {'state': state, 'current_dish': dish, 'last_intent': intent, 'last_bot_response': response,
+         'history': list(history), 'stats': dict(stats)} for _, state, dish, intent, response, history, stats in rows])
+    del dicts
+    states, state_bytes = measure(lambda: [
+        UserState(state, dish, intent, response, history, (stats['intent'], stats['generate'], stats['failure']))
+        for _, state, dish, intent, response, history, stats in rows])
+
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, 'user_state.sqlite3')
+        store = SQLiteStateStore(path, idle_ttl=3600)
+        start = time.perf_counter()
+        for (user_id, *_), state in zip(rows, states):
+            store.put(user_id, state)
+        put_s = time.perf_counter() - start
+        start = time.perf_counter()
+        written = store.flush()
+        flush_s = time.perf_counter() - start
+        # Все пользователи простаивают дольше idle_ttl: из памяти уходят, в базе остаются
+        evicted = store.evict(time.time() + 3601)
+        rng = random.Random(1)
+        sample = [rng.randrange(users) for _ in range(lookups)]
+        start = time.perf_counter()
+        loaded = [store.get(user_id) for user_id in sample]
+        load_s = time.perf_counter() - start
+        same = all(state.history == states[user_id].history and state.counters == states[user_id].counters
+                   and state.current_dish == states[user_id].current_dish for user_id, state in zip(sample, loaded))
+        store.close()
+        db_bytes = sum(os.path.getsize(os.path.join(root, name)) for name in os.listdir(root))
+    result = {'users': users, 'strings_bytes_per_user': round(strings / users),
+              'dict_bytes_per_user': round(dict_bytes / users), 'state_bytes_per_user': round(state_bytes / users),
+              'put_per_sec': round(users / put_s), 'flush_rows_per_sec': round(written / flush_s),
+              'flush_s': round(flush_s, 2), 'evicted': evicted, 'load_per_sec': round(lookups / load_s),
+              'loaded_same': same, 'db_bytes_per_user': round(db_bytes / users)}
+    logger.info(f"Состояния пользователей: {result}")
+    return result
+
+
+# Непонятные реплики, которые должен отсечь is_meaningful_text
+GIBBERISH = ['ыыы', 'asdf', 'ккккк', 'фывапролдж', 'qwerty', 'ъъъ ьььь', 'ааааааа', 'йцукен', 'зщшгнек', '...']
+
+
+def sample_offtopic(count, rng, path=DIALOGUES_PATH, limit=20000):
+    """Вопросы из начала dialogues.txt; если файла нет — несколько бытовых реплик."""
+    try:
+        questions = [question for question, _, _ in itertools.islice(iter_dialogues(path), limit)]
+    except OSError:
+        questions = []
+    questions = questions or ['как дела', 'что делаешь', 'какая погода', 'я устал', 'мне грустно', 'расскажи анекдот']
+    return [rng.choice(questions) for _ in range(count)]
+
+
+def build_corpus(size, seed=0):
+    """Разговоры по смесям: по одной реплике для dish/filter/offtopic/gibberish, несколько ходов для flow."""
+    config = get_config()
+    dishes = list(config['dishes'].keys())
+    categories = config['categories']
+    rng = random.Random(seed)
+    mixes = {
+        'dish': lambda: [rng.choice(['сколько стоит {}', 'расскажи про {}', '{}', 'есть ли {}', 'хочу заказать {}'])
+                         .format(rng.choice(dishes))],
+        'filter': lambda: [rng.choice([f"блюда до {rng.randrange(100, 1000, 50)} рублей", f"покажи {rng.choice(categories)}",
+                                       f"что есть дешевле {rng.randrange(100, 1000, 50)}", rng.choice(categories)])],
+        'offtopic': lambda: sample_offtopic(1, rng),
+        'gibberish': lambda: [rng.choice(GIBBERISH)],
+        # Ходы через WAITING_FOR_DISH и WAITING_FOR_INTENT
+        'flow': lambda: rng.choice([
+            ['сколько это стоит?', rng.choice(dishes), 'да'],
+            [rng.choice(dishes), 'какой состав?'],
+            [rng.choice(dishes), 'нет', 'посоветуй блюдо'],
+            ['хочу заказать', rng.choice(categories), 'сколько стоит?'],
+            ['привет', 'да', rng.choice(dishes), 'есть в наличии?'],
+        ]),
+    }
+    weights = {'dish': 3, 'filter': 2, 'offtopic': 3, 'gibberish': 1, 'flow': 2}
+    names = rng.choices(list(weights), weights=list(weights.values()), k=size)
+    return {'seed': seed, 'conversations': [{'mix': name, 'turns': mixes[name]()} for name in names]}
+
+
+def percentile(values, q):
+    return round(float(np.percentile(values, q)) * 1000, 3) if values else None
+
+
+def latency_summary(values):
+    return {'count': len(values), 'p50_ms': percentile(values, 50), 'p95_ms': percentile(values, 95),
+            'p99_ms': percentile(values, 99), 'max_ms': round(max(values) * 1000, 3) if values else None}
+
+
+def run_corpus(corpus):
+    """Прогоняет разговоры через bot(): время каждой реплики по ветке (смесь, состояние) и по исходу Stats."""
+    branches, outcomes = {}, {}
+    for conversation in corpus['conversations']:
+        context = SimpleNamespace(user_data={})
+        for replica in conversation['turns']:
+            state = context.user_data.get('state', 'NONE')
+            before = dict(context.user_data.get('stats', {}))
+            start = time.perf_counter()
+            bot_module.bot(replica, context)
+            elapsed = time.perf_counter() - start
+            branch = conversation['mix'] if state == 'NONE' else f"{conversation['mix']}/{state}"
+            outcome = next((stat_type for stat_type, count in context.user_data['stats'].items()
+                            if count != before.get(stat_type, 0)), 'none')
+            branches.setdefault(branch, []).append(elapsed)
+            outcomes.setdefault(outcome, []).append(elapsed)
+    return branches, outcomes
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def pipeline_benchmark(corpus, repeat=3):
+    """Задержки bot() по веткам, сообщений в секунду и пиковая память на записанном корпусе."""
+    random.seed(corpus['seed'])
+    # Прогрев: загрузка моделей и индексов не входит в замер
+    run_corpus({'conversations': [{'mix': 'warmup', 'turns': LOAD_MESSAGES}]})
+    branches, outcomes, seconds = {}, {}, []
+    stage_histograms = metrics.registry.values[metrics.STAGE_SECONDS]
+    stages_before = {stage: (histogram.count, histogram.sum) for stage, histogram in stage_histograms.items()}
+    for _ in range(repeat):
+        # Кэш лемматизации каждый раз пустой: повторы внутри корпуса попадают в него как в работе
+        utils.lemma_cache.clear()
+        random.seed(corpus['seed'])
+        start = time.perf_counter()
+        run_branches, run_outcomes = run_corpus(corpus)
+        seconds.append(time.perf_counter() - start)
+        for target, source in ((branches, run_branches), (outcomes, run_outcomes)):
+            for name, values in source.items():
+                target.setdefault(name, []).extend(values)
+    stages = {}
+    for stage, histogram in sorted(stage_histograms.items()):
+        count, total = stages_before.get(stage, (0, 0.0))
+        if histogram.count > count:
+            stages[stage] = {'count': histogram.count - count,
+                             'mean_ms': round((histogram.sum - total) / (histogram.count - count) * 1000, 3)}
+    # Пик выделений Python отдельным проходом: tracemalloc замедляет код и в замер времени не попадает
+    utils.lemma_cache.clear()
+    tracemalloc.start()
+    run_corpus(corpus)
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    messages = sum(len(conversation['turns']) for conversation in corpus['conversations'])
+    latencies = list(itertools.chain.from_iterable(branches.values()))
+    result = {
+        'commit': git_commit(), 'python': platform.python_version(), 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'conversations': len(corpus['conversations']), 'messages': messages, 'repeat': repeat,
+        'msg_per_sec': round(messages * repeat / sum(seconds), 1), 'overall': latency_summary(latencies),
+        'branches': {name: latency_summary(values) for name, values in sorted(branches.items())},
+        'outcomes': {name: latency_summary(values) for name, values in sorted(outcomes.items())},
+        # ru_maxrss в Linux — в килобайтах
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'traced_peak_mb': round(traced_peak / 2 ** 20, 2),
+        # Среднее по этапам из метрик бота (только по сообщениям из выборки METRICS_SAMPLE_RATE)
+        'sample_rate': metrics.SAMPLE_RATE,
+        'stages': stages,
+    }
+    logger.info(f"Бенчмарк bot(): {result['messages']} сообщений, {result['msg_per_sec']} msg/s")
+    return result
+
+
+def compare_results(old, new):
+    """Строки «метрика: было -> стало (изменение)» для двух JSON-результатов pipeline."""
+    def line(name, before, after):
+        if before is None or after is None:
+            return f"{name}: {before} -> {after}"
+        change = (after - before) / before * 100 if before else 0.0
+        return f"{name}: {before} -> {after} ({change:+.1f}%)"
+
+    lines = [f"{old.get('commit')} -> {new.get('commit')}", line('msg/s', old['msg_per_sec'], new['msg_per_sec']),
+             line('peak_rss_mb', old['peak_rss_mb'], new['peak_rss_mb']),
+             line('traced_peak_mb', old['traced_peak_mb'], new['traced_peak_mb'])]
+    for section in ('branches', 'outcomes'):
+        for name in sorted(set(old[section]) | set(new[section])):
+            before, after = old[section].get(name, {}), new[section].get(name, {})
+            for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+                lines.append(line(f"{section}.{name}.{key}", before.get(key), after.get(key)))
+    return lines
+
+
+# Режимы логирования для сравнения. legacy — как было: f-строки, синхронная запись, сбор файла и строки вызова
+LOGGING_MODES = {
+    'legacy': {'use_queue': False},
+    'sync_text': {'use_queue': False, 'lean_records': True},
+    'queue_text': {'use_queue': True, 'lean_records': True},
+    'queue_json': {'fmt': 'json', 'use_queue': True, 'lean_records': True},
+    'queue_text_sampled': {'use_queue': True, 'lean_records': True, 'rate': 0.1},
+}
+
+
+class CaptureHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.message = 0
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((self.message, record.name, record.levelno, record.msg, record.args))
+
+
+def capture_log_calls(corpus):
+    """Вызовы логгера при обработке корпуса: (номер сообщения, логгер, уровень, шаблон, аргументы)."""
+    capture = CaptureHandler()
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(capture)
+    try:
+        for conversation in corpus['conversations']:
+            context = SimpleNamespace(user_data={})
+            for replica in conversation['turns']:
+                capture.message += 1
+                bot_module.bot(replica, context)
+    finally:
+        root.removeHandler(capture)
+        for handler in handlers:
+            root.addHandler(handler)
+    return capture.message, capture.records
+
+
+def replay_log_calls(records, mode, options, stream):
+    """Повторяет записанные вызовы в режиме mode; возвращает время в вызывающем потоке и CPU процесса с дозаписью."""
+    options = dict(options)
+    rate = options.pop('rate', 1.0)
+    flags = (logging._srcfile, logging.logProcesses, logging.logMultiprocessing, logging.logThreads)
+    logs.configure_logging(stream=stream, **options)
+    if mode == 'legacy':
+        logging._srcfile = os.path.normcase(logging.addLevelName.__code__.co_filename)
+        logging.logProcesses = logging.logMultiprocessing = logging.logThreads = True
+    loggers = {}
+    message = None
+    try:
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        for number, name, level, msg, args in records:
+            if number != message:
+                message = number
+                logs.sample_message_log(1.0 if mode == 'legacy' else rate)
+            if mode == 'legacy':
+                logging.getLogger(name).log(level, msg % args if args else msg)
+                continue
+            target = loggers.get(name)
+            if target is None:
+                target = loggers[name] = utils.message_logger if name == utils.message_logger.logger.name \
+                    else logging.getLogger(name)
+            target.log(level, msg, *args)
+        caller = time.perf_counter() - start
+        logs.stop_listener()
+        cpu = time.process_time() - cpu_start
+    finally:
+        logging._srcfile, logging.logProcesses, logging.logMultiprocessing, logging.logThreads = flags
+        logs.sample_message_log(1.0)
+    return caller, cpu
+
+
+def logging_benchmark(corpus, rounds=5):
+    """Цена логирования на сообщение: записанные при обработке корпуса вызовы повторяются в каждом режиме."""
+    run_corpus({'conversations': [{'mix': 'warmup', 'turns': LOAD_MESSAGES}]})
+    random.seed(corpus['seed'])
+    messages, records = capture_log_calls(corpus)
+    best, lines = {}, {}
+    try:
+        with tempfile.TemporaryDirectory() as root:
+            for _ in range(rounds):
+                for mode, options in LOGGING_MODES.items():
+                    path = os.path.join(root, f"{mode}.log")
+                    with open(path, 'w', encoding='utf-8') as stream:
+                        caller, cpu = replay_log_calls(records, mode, options, stream)
+                    previous = best.get(mode, (caller, cpu))
+                    best[mode] = (min(previous[0], caller), min(previous[1], cpu))
+                    with open(path, encoding='utf-8') as f:
+                        lines[mode] = sum(1 for _ in f)
+    finally:
+        logs.configure_logging()
+    results = []
+    for mode in LOGGING_MODES:
+        caller, cpu = best[mode]
+        results.append({'mode': mode, 'caller_us_per_msg': round(caller / messages * 1e6, 1),
+                        'cpu_us_per_msg': round(cpu / messages * 1e6, 1),
+                        'lines_per_msg': round(lines[mode] / messages, 2)})
+        logger.info(f"Логирование: {results[-1]}")
+    return results
+
+
+def synthetic_speech(seconds, seed=0):
+    """Тон с шумом как 16 кГц моно PCM: для замера скорости движков содержание не важно."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * stt.SAMPLE_RATE)) / stt.SAMPLE_RATE
+    signal = 0.3 * np.sin(2 * np.pi * 220 * t) + 0.05 * rng.standard_normal(len(t))
+    return stt.PCMAudio((signal * 32767).astype(np.int16).tobytes())
+
+
+async def voice_load_run(recognizer, audios):
+    """Голосовые сообщения сразу: сколько распознано и сколько упёрлось в таймаут, задержка цикла событий."""
+    lags = []
+    stop = asyncio.Event()
+
+    async def watch_loop():
+        # Опоздание пробуждения таймера — насколько распознавание задерживает остальные сообщения
+        while not stop.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - start - 0.01)
+
+    async def one(audio):
+        try:
+            return await recognizer.transcribe(audio)
+        except asyncio.TimeoutError:
+            return TimeoutError
+
+    watcher = asyncio.create_task(watch_loop())
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(audio) for audio in audios))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await watcher
+    return {'messages': len(audios), 'recognized': sum(isinstance(result, str) for result in results),
+            'timed_out': sum(result is TimeoutError for result in results), 'seconds': round(elapsed, 2),
+            'loop_lag_max_ms': round(max(lags, default=0) * 1000, 1)}
+
+
+def stt_benchmark(backends, durations, repeat=3, messages=20, stub_rtf=0.1):
+    """Задержка распознавания на секунду аудио для каждого движка и прогон очереди голосовых через пул."""
+    rows = []
+    for name in backends:
+        try:
+            backend = stt.StubBackend(real_time_factor=stub_rtf) if name == 'stub' else stt.create_backend(name)
+        except Exception as e:
+            rows.append({'backend': name, 'skipped': f"{type(e).__name__}: {e}"})
+            continue
+        for seconds in durations:
+            audio = synthetic_speech(seconds)
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                backend.transcribe(audio)
+                timings.append(time.perf_counter() - start)
+            best = min(timings)
+            rows.append({'backend': name, 'audio_s': seconds, 'ms': round(best * 1000, 1),
+                         'ms_per_audio_s': round(best / seconds * 1000, 1)})
+        logger.info(f"Распознавание речи, {name}: {rows[-1]}")
+
+    # Очередь голосовых: короткие по 5 с и каждое четвёртое на 30 с; таймаут отсекает длинные
+    short, long = synthetic_speech(5), synthetic_speech(30)
+    recognizer = stt.SpeechRecognizer(stt.StubBackend(real_time_factor=stub_rtf), workers=2, concurrency=2,
+                                      timeout=10 * stub_rtf)
+    load = asyncio.run(voice_load_run(recognizer, [long if idx % 4 == 3 else short for idx in range(messages)]))
+    recognizer.close()
+    audio = short
+    decode_ms = None
+    if shutil.which('ffmpeg'):
+        from pydub import AudioSegment
+        buffer = io.BytesIO()
+        AudioSegment(audio.pcm, sample_width=2, frame_rate=stt.SAMPLE_RATE, channels=1).export(
+            buffer, format='ogg', codec='libopus')
+        start = time.perf_counter()
+        stt.decode_ogg(buffer.getvalue())
+        decode_ms = round((time.perf_counter() - start) * 1000, 1)
+    return rows, load, decode_ms
+
+
+def corpus_answers(corpus):
+    """Ответы bot() на реплики корпуса в порядке разговоров — то, что ушло бы в синтез речи."""
+    random.seed(corpus['seed'])
+    answers = []
+    for conversation in corpus['conversations']:
+        context = SimpleNamespace(user_data={})
+        for replica in conversation['turns']:
+            answers.append(bot_module.bot(replica, context))
+    return [answer for answer in answers if answer]
+
+
+def tts_benchmark(corpus, synth_ms=100, bytes_per_char=300):
+    """Голосовые ответы на корпус: без кэша, с холодным кэшем и с прогретым; доля попаданий и время ответа.
+
+    Синтез заменён заглушкой: synth_ms на ответ и MP3 размером bytes_per_char на символ (порядок gTTS).
+    Отправка в Telegram моделируется: после первой отправки байтов ответ получает file_id.
+    """
+    answers = corpus_answers(corpus)
+    templated = list(bot_module.templated_answers(get_config()))
+
+    def synthesize(text):
+        time.sleep(synth_ms / 1000)
+        return b'\0' * (len(text) * bytes_per_char)
+
+    rows = []
+    for name in ('none', 'cold', 'prewarmed'):
+        directory = tempfile.mkdtemp(prefix='tts-bench-')
+        try:
+            # Без кэша: каждый ответ синтезируется и отправляется байтами
+            cache = tts.VoiceCache(synthesize, directory, memory_bytes=0, disk_bytes=0) if name == 'none' \
+                else tts.VoiceCache(synthesize, directory)
+            prewarm_s = None
+            if name == 'prewarmed':
+                start = time.perf_counter()
+                cache.prewarm(templated)
+                prewarm_s = round(time.perf_counter() - start, 2)
+            timings, uploaded = [], 0
+            for idx, answer in enumerate(answers):
+                start = time.perf_counter()
+                file_id = cache.file_id(answer) if name != 'none' else None
+                if file_id is None:
+                    data = cache.get(answer)
+                    uploaded += len(data)
+                    cache.remember_file_id(answer, f"file-{idx}")
+                timings.append(time.perf_counter() - start)
+            summary = cache.summary()
+            rows.append({'cache': name, 'replies': len(answers), 'unique': len(set(answers)),
+                         'hit_rate': summary['hit_rate'] if name != 'none' else 0.0,
+                         'sources': {result: summary[result] for result in tts.RESULTS},
+                         'mean_ms': round(sum(timings) / len(timings) * 1000, 2),
+                         'p50_ms': percentile(timings, 50), 'p95_ms': percentile(timings, 95),
+                         'uploaded_kb': round(uploaded / 1024), 'disk_kb': round(summary['disk_bytes'] / 1024),
+                         'prewarm_s': prewarm_s, 'prewarmed_texts': len(set(templated))})
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        logger.info(f"Кэш синтеза речи: {rows[-1]}")
+    return rows
+
+
+def dict_bytes(mapping):
+    return sys.getsizeof(mapping) + sum(sys.getsizeof(key) + sys.getsizeof(value) for key, value in mapping.items())
+
+
+def dict_sentiment(analysis, scores):
+    """Прежний подсчёт: словарь строка→float и цикл по словам лемматизированной фразы."""
+    total = count = 0
+    for word in analysis.lemmatized.split():
+        if word in scores:
+            total += scores[word]
+            count += 1
+    return total / count if count else None
+
+
+def sentiment_benchmark(size, lexicon_sizes, rounds=5):
+    """Память тонального словаря (dict против TonalLexicon) и скорость оценки пакета реплик.
+
+    Разбор Natasha делается заранее и в замер не входит. Кроме словаря из data/tonal.txt
+    берутся синтетические словари из лемм dialogues.txt со случайными оценками.
+    """
+    rng = random.Random(0)
+    analyses = utils.analyze_batch(sample_offtopic(size, rng))
+    lexicon = utils.tonal_dict.get()
+    vocabulary = sorted({lemma for analysis in analyses for lemma in analysis.lemmas})
+    rows = []
+    for lexicon_size in [len(lexicon)] + lexicon_sizes:
+        if lexicon_size == len(lexicon):
+            pairs = [(word.decode('utf-8'), float(score)) for word, score in zip(lexicon.words, lexicon.scores)]
+        else:
+            words = vocabulary + [f"{word}{idx}" for idx in range(lexicon_size) for word in vocabulary[:1]]
+            pairs = [(word, rng.uniform(-1, 1)) for word in words[:lexicon_size]]
+        scores = dict(pairs)
+        compact = TonalLexicon.from_pairs(pairs)
+        original = utils.tonal_dict
+        utils.tonal_dict = SimpleNamespace(get=lambda: compact)
+        try:
+            utils.sentiment_scores(analyses)
+            loop_s = single_s = batch_s = float('inf')
+            for _ in range(rounds):
+                start = time.perf_counter()
+                for analysis in analyses:
+                    dict_sentiment(analysis, scores)
+                loop_s = min(loop_s, time.perf_counter() - start)
+                start = time.perf_counter()
+                single = [utils.phrase_sentiment(analysis) for analysis in analyses]
+                single_s = min(single_s, time.perf_counter() - start)
+                start = time.perf_counter()
+                batch = utils.sentiment_scores(analyses)
+                batch_s = min(batch_s, time.perf_counter() - start)
+        finally:
+            utils.tonal_dict = original
+        scored = int(np.count_nonzero(~np.isnan(batch)))
+        rows.append({'words': len(compact), 'dict_kb': round(dict_bytes(scores) / 1024, 1),
+                     'compact_kb': round(compact.nbytes / 1024, 1), 'replicas': len(analyses), 'scored': scored,
+                     'loop_per_sec': round(len(analyses) / loop_s), 'single_per_sec': round(len(analyses) / single_s),
+                     'batch_per_sec': round(len(analyses) / batch_s),
+                     'same': bool(np.allclose(batch, single, equal_nan=True))})
+        logger.info(f"Тональность: {rows[-1]}")
+    return rows
+
+
+def synthetic_menu(size, seed=0):
+    """Каталог из size блюд с категориями и метками CONFIG и случайными ценами."""
+    config = get_config()
+    rng = random.Random(seed)
+    dishes = {}
+    for idx in range(size):
+        categories = rng.sample(config['categories'], rng.choice([1, 1, 2]))
+        dishes[f"блюдо {idx}"] = {'price': rng.randrange(100, 3000, 10), 'categories': categories,
+                                  'dietary': ['vegan'] if rng.random() < 0.1 else []}
+    return {'dishes': dishes, 'categories': config['categories'], 'dietary': config.get('dietary', {})}
+
+
+def scan_filter(data, max_price=None, category=None, dietary=None):
+    """Прежний способ: проход по всем блюдам CONFIG на каждый запрос."""
+    dishes = data['dishes']
+    result = [dish for dish, item in dishes.items() if max_price is None or item['price'] <= max_price]
+    if category is not None:
+        result = [dish for dish in result if category in dishes[dish].get('categories', [])]
+    if dietary is not None:
+        categories = data['dietary'][dietary].get('categories', [])
+        result = [dish for dish in result if dietary in dishes[dish].get('dietary', [])
+                  or any(category in categories for category in dishes[dish].get('categories', []))]
+    return result
+
+
+def menu_benchmark(sizes, queries=200):
+    """Фильтры меню: полный проход против utils.Menu на каталогах разного размера."""
+    rows = []
+    for size in sizes:
+        data = synthetic_menu(size)
+        start = time.perf_counter()
+        menu = utils.Menu(data['dishes'], data['dietary'])
+        build_ms = (time.perf_counter() - start) * 1000
+        rng = random.Random(1)
+        requests = [(rng.choice([None, rng.randrange(100, 3000, 10), 300]), rng.choice([None] + data['categories']),
+                     rng.choice([None, None, 'vegan'])) for _ in range(queries)]
+        same = all(menu.filter(*request).dishes == scan_filter(data, *request) for request in requests)
+        timings = {}
+        for name, run in (('scan', lambda request: scan_filter(data, *request)),
+                          ('menu', lambda request: menu.filter(*request, limit=10))):
+            start = time.perf_counter()
+            for request in requests:
+                run(request)
+            timings[name] = (time.perf_counter() - start) / queries
+        rows.append({'dishes': size, 'build_ms': round(build_ms, 1), 'scan_us': round(timings['scan'] * 1e6, 1),
+                     'menu_us': round(timings['menu'] * 1e6, 1), 'speedup': round(timings['scan'] / timings['menu'], 1),
+                     'same': same})
+        logger.info(f"Меню: {rows[-1]}")
+    return rows
+
+
+def replace_answer(response, dish_name, dishes):
+    """Прежний способ: цепочка str.replace по выбранному ответу при каждом ответе."""
+    answer = response.replace('[dish_name]', dish_name)
+    answer = answer.replace('[price]', str(dishes[dish_name]['price']))
+    return answer.replace('[description]', dishes[dish_name].get('description', 'вкусное блюдо'))
+
+
+def templates_benchmark(sizes, renders=200000):
+    """Подстановка в шаблоны ответов: str.replace, разобранный шаблон и заранее подставленные ответы."""
+    config = get_config()
+    rows = []
+    for size in sizes:
+        dishes = synthetic_menu(size)['dishes'] if size else config['dishes']
+        data = dict(config, dishes=dishes)
+        start = time.perf_counter()
+        templates = utils.ResponseTemplates(data)
+        build_ms = (time.perf_counter() - start) * 1000
+        compiled = utils.ResponseTemplates(data, prerender_limit=0)
+        pairs = [(template, compiled_template) for template, compiled_template
+                 in zip(templates.dish_templates(), compiled.dish_templates()) if template.slots]
+        rng = random.Random(1)
+        names = list(dishes)
+        requests = [(*rng.choice(pairs), rng.choice(names)) for _ in range(renders)]
+        same = all(replace_answer(template.text, dish_name, dishes) == templates.render(template, dish_name)
+                   == compiled.render(compiled_template, dish_name)
+                   for template, compiled_template, dish_name in requests[:1000])
+        timings = {}
+        for name, run in (('replace', lambda template, _, dish_name: replace_answer(template.text, dish_name, dishes)),
+                          ('compiled', lambda _, template, dish_name: compiled.render(template, dish_name)),
+                          ('prerendered', lambda template, _, dish_name: templates.render(template, dish_name))):
+            start = time.perf_counter()
+            for request in requests:
+                run(*request)
+            timings[name] = (time.perf_counter() - start) / renders
+        rows.append({'dishes': len(dishes), 'build_ms': round(build_ms, 1), 'prerendered': templates.prerendered,
+                     **{f"{name}_ns": round(seconds * 1e9) for name, seconds in timings.items()}, 'same': same})
+        logger.info(f"Шаблоны: {rows[-1]}")
+    return rows
+
+
+def write_tenants(directory, count, dishes, seed=0):
+    """count ресторанов с общими намерениями и своими меню по dishes блюд."""
+    base = get_config()
+    rng = random.Random(seed)
+    for tenant_idx in range(count):
+        menu = {}
+        for idx in range(dishes):
+            name = f"блюдо {tenant_idx} {idx}"
+            menu[name] = {'price': rng.randrange(100, 2000, 10), 'description': f"описание {name}",
+                          'synonyms': [f"вариант {tenant_idx} {idx}"], 'categories': rng.sample(base['categories'], 1)}
+        with open(os.path.join(directory, f"r{tenant_idx}.py"), 'w', encoding='utf-8') as f:
+            f.write(f"CONFIG = {dict(base, dishes=menu)!r}\n")
+
+
+def tenants_benchmark(count, capacities, messages, dishes):
+    """Сообщения ресторанам с неравномерной популярностью: загрузки, вытеснения, задержки и память индексов."""
+    directory = tempfile.mkdtemp(prefix='tenants-bench-')
+    rows = []
+    try:
+        write_tenants(directory, count, dishes)
+        replicas = ('сколько стоит блюдо 1', 'блюда до 500 рублей', 'покажи салаты', 'посоветуй блюдо', 'привет')
+        original = utils.tenants
+        # Общие кэши (леммы, морфология) прогреваются заранее: в памяти прогонов остаются только версии CONFIG
+        utils.tenants = utils.TenantConfigs(directory, count)
+        for tenant_idx in range(count):
+            with utils.tenant_scope(f"r{tenant_idx}"):
+                for replica in replicas:
+                    bot_module.bot(replica, SimpleNamespace(user_data={}))
+        utils.tenants = original
+        for capacity in capacities:
+            utils.tenants = registry = utils.TenantConfigs(directory, capacity)
+            rng = random.Random(1)
+            contexts = {}
+            timings = []
+            gc.collect()
+            tracemalloc.start()
+            try:
+                for idx in range(messages):
+                    # Популярность ресторанов по закону Ципфа: немного активных, длинный хвост редких
+                    tenant = f"r{min(int(rng.paretovariate(1.2)) - 1, count - 1)}"
+                    context = contexts.setdefault(tenant, SimpleNamespace(user_data={'tenant': tenant}))
+                    start = time.perf_counter()
+                    with utils.tenant_scope(tenant):
+                        bot_module.bot(replicas[idx % len(replicas)], context)
+                    timings.append(time.perf_counter() - start)
+                gc.collect()
+                current, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+                utils.tenants = original
+            rows.append({'tenants': count, 'capacity': capacity, 'active': len(contexts), **registry.stats(),
+                         'latency': latency_summary(timings), 'memory_mb': round(current / 2 ** 20, 1),
+                         'peak_mb': round(peak / 2 ** 20, 1)})
+            logger.info(f"Рестораны: {rows[-1]}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарки чат-бота')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    load_parser = subparsers.add_parser('load', help='нагрузочный тест bot() с пулом воркеров')
+    load_parser.add_argument('--mode', choices=['inline', 'thread', 'process'], default='process')
+    load_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    load_parser.add_argument('--users', type=int, default=50)
+    load_parser.add_argument('--messages', type=int, default=20)
+
+    retrieval_parser = subparsers.add_parser('retrieval', help='поиск в dialogues: перебор против индекса')
+    retrieval_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    retrieval_parser.add_argument('--queries', type=int, default=200)
+
+    ann_parser = subparsers.add_parser('ann', help='recall@k приближённого поиска по эмбеддингам')
+    ann_parser.add_argument('--vectors', help='файл .npy с эмбеддингами (по умолчанию — синтетика)')
+    ann_parser.add_argument('--synthetic', type=int, default=100000)
+    ann_parser.add_argument('--probes', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+    ann_parser.add_argument('--k', type=int, default=10)
+
+    append_parser = subparsers.add_parser('append', help='дообучение dialogues: дельта-сегмент против переобучения')
+    append_parser.add_argument('--base', type=int, default=20000)
+    append_parser.add_argument('--pairs', type=int, default=1000)
+
+    reload_parser = subparsers.add_parser('reload', help='перезагрузка CONFIG под нагрузкой')
+    reload_parser.add_argument('--mode', choices=['thread', 'process'], default='thread')
+    reload_parser.add_argument('--workers', type=int, default=4)
+    reload_parser.add_argument('--users', type=int, default=50)
+    reload_parser.add_argument('--messages', type=int, default=100)
+    reload_parser.add_argument('--period', type=float, default=0.2, help='интервал между правками config.py, с')
+
+    state_parser = subparsers.add_parser('state', help='память и запись состояний пользователей')
+    state_parser.add_argument('--users', type=int, default=1000000)
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='задержки bot() по веткам на записанном корпусе')
+    pipeline_parser.add_argument('--corpus', help='JSON-корпус разговоров (по умолчанию генерируется по CONFIG)')
+    pipeline_parser.add_argument('--record', help='сохранить сгенерированный корпус в файл')
+    pipeline_parser.add_argument('--size', type=int, default=1000, help='разговоров в генерируемом корпусе')
+    pipeline_parser.add_argument('--seed', type=int, default=0)
+    pipeline_parser.add_argument('--repeat', type=int, default=3)
+    pipeline_parser.add_argument('--output', help='куда записать JSON (по умолчанию bench_results/pipeline-<commit>.json)')
+    pipeline_parser.add_argument('--compare', help='JSON прошлого прогона для сравнения')
+    pipeline_parser.add_argument('--quiet', action='store_true', help='логировать только предупреждения и ошибки')
+
+    logging_parser = subparsers.add_parser('logging', help='цена логирования на сообщение в разных режимах')
+    logging_parser.add_argument('--size', type=int, default=500, help='разговоров в корпусе')
+    logging_parser.add_argument('--rounds', type=int, default=5)
+
+    stt_parser = subparsers.add_parser('stt', help='скорость движков распознавания речи и очередь голосовых')
+    stt_parser.add_argument('--backends', nargs='+', default=['stub', 'vosk'], choices=sorted(stt.BACKENDS))
+    stt_parser.add_argument('--durations', type=float, nargs='+', default=[1, 5, 15])
+    stt_parser.add_argument('--messages', type=int, default=20)
+    stt_parser.add_argument('--stub-rtf', type=float, default=0.1, help='секунд работы заглушки на секунду аудио')
+
+    tts_parser = subparsers.add_parser('tts', help='кэш синтеза речи на ответах корпуса')
+    tts_parser.add_argument('--size', type=int, default=300, help='разговоров в корпусе')
+    tts_parser.add_argument('--synth-ms', type=float, default=100, help='время синтеза одного ответа заглушкой, мс')
+
+    sentiment_parser = subparsers.add_parser('sentiment', help='память тонального словаря и скорость оценки')
+    sentiment_parser.add_argument('--size', type=int, default=5000, help='реплик в пакете')
+    sentiment_parser.add_argument('--lexicons', type=int, nargs='+', default=[10000, 100000],
+                                  help='размеры синтетических словарей')
+
+    menu_parser = subparsers.add_parser('menu', help='фильтры меню: полный проход против каталога Menu')
+    menu_parser.add_argument('--sizes', type=int, nargs='+', default=[7, 1000, 10000, 100000])
+    menu_parser.add_argument('--queries', type=int, default=200)
+
+    templates_parser = subparsers.add_parser('templates', help='подстановка в шаблоны ответов')
+    templates_parser.add_argument('--sizes', type=int, nargs='+', default=[0, 1000, 100000],
+                                  help='блюд в меню; 0 — меню CONFIG')
+    templates_parser.add_argument('--renders', type=int, default=200000)
+
+    tenants_parser = subparsers.add_parser('tenants', help='много ресторанов в одном процессе: LRU и память')
+    tenants_parser.add_argument('--tenants', type=int, default=200)
+    tenants_parser.add_argument('--capacities', type=int, nargs='+', default=[8, 32, 200])
+    tenants_parser.add_argument('--messages', type=int, default=3000)
+    tenants_parser.add_argument('--dishes', type=int, default=50, help='блюд в меню ресторана')
+
+    args = parser.parse_args()
+    if args.command == 'load':
+        for row in load_test(args.mode, args.workers, args.users, args.messages):
+            print(f"{row['mode']:>8} workers={row['workers']:<3} {row['msg_per_sec']:>8} msg/s "
+                  f"({row['messages']} за {row['seconds']} с, порядок сохранён: {row['ordered']})")
+    elif args.command == 'retrieval':
+        for row in retrieval_benchmark(args.sizes, args.queries):
+            print(f"{row['size']:>8} строк: перебор {row['brute_ms']} мс, индекс {row['indexed_ms']} мс "
+                  f"(x{row['speedup']}, совпадений top-1: {row['same_top1']})")
+    elif args.command == 'ann':
+        vectors = np.load(args.vectors, mmap_mode='r') if args.vectors else synthetic_embeddings(args.synthetic)
+        size, lists, rows = ann_benchmark(vectors, args.probes, args.k)
+        print(f"{size} векторов, {lists} кластеров, recall@{args.k}:")
+        for row in rows:
+            print(f"  n_probe={row['n_probe']:<8} recall={row['recall']:<6} {row['ms']} мс/запрос")
+    elif args.command == 'reload':
+        row = reload_benchmark(args.mode, args.workers, args.users, args.messages, args.period)
+        print(f"{row['messages']} сообщений, ответов {row['answered']} (без перезагрузок: {row['baseline']['answered']}), "
+              f"порядок сохранён: {row['ordered']}")
+        print(f"{row['msg_per_sec']} msg/s при перезагрузках, {row['baseline']['msg_per_sec']} msg/s без них")
+        print(f"Перезагрузок CONFIG: {row['reloads']}, от записи файла до подмены: медиана {row['latency_ms_median']} мс, "
+              f"максимум {row['latency_ms_max']} мс; индексы построены заранее: {row['indexes_prebuilt']}, "
+              f"новая цена применена: {row['price_applied']}")
+        print(f"Перезагрузка моделей: {row['models_reload_ms']} мс")
+        if row['worker_prices']:
+            print(f"Цена в процессах-воркерах: {row['worker_prices']}")
+        # Потерянное сообщение, нарушенный порядок, не применённая правка или ни одной подмены
+        # во время нагрузки — провал проверки
+        if (row['answered'] != row['messages'] or not row['ordered'] or not row['price_applied']
+                or row['reloads'] == 0):
+            raise SystemExit(f"Перезагрузка под нагрузкой не прошла проверку: ответов {row['answered']} из "
+                             f"{row['messages']}, порядок сохранён: {row['ordered']}, "
+                             f"новая цена применена: {row['price_applied']}, "
+                             f"подмен под нагрузкой: {row['reloads']}")
+    elif args.command == 'append':
+        row = append_benchmark(args.base, args.pairs)
+        print(f"+{row['pairs']} пар к {row['base']}: сегмент {row['update_s']} с, подхват ботом {row['refresh_ms']} мс; "
+              f"полное переобучение {row['retrain_s']} с, слияние {row['compact_s']} с")
+        print(f"Совпадений top-1 с переобучением: сегменты {row['same_top1_segmented']}, "
+              f"после слияния {row['same_compacted']}")
+    elif args.command == 'state':
+        row = state_benchmark(args.users)
+        print(f"{row['users']} пользователей, контейнер состояния: словарь {row['dict_bytes_per_user']} Б, "
+              f"UserState {row['state_bytes_per_user']} Б на пользователя (+{row['strings_bytes_per_user']} Б "
+              f"собственных строк у обоих)")
+        print(f"SQLite: put {row['put_per_sec']}/с, сброс {row['flush_rows_per_sec']} строк/с ({row['flush_s']} с), "
+              f"{row['db_bytes_per_user']} Б на пользователя на диске")
+        print(f"Вытеснено из памяти: {row['evicted']}, чтение из базы {row['load_per_sec']}/с, "
+              f"совпадает с записанным: {row['loaded_same']}")
+    elif args.command == 'pipeline':
+        if args.quiet:
+            logger.setLevel('WARNING')
+        if args.corpus:
+            with open(args.corpus, encoding='utf-8') as f:
+                corpus = json.load(f)
+        else:
+            corpus = build_corpus(args.size, args.seed)
+        if args.record:
+            with open(args.record, 'w', encoding='utf-8') as f:
+                json.dump(corpus, f, ensure_ascii=False, indent=1)
+        row = pipeline_benchmark(corpus, args.repeat)
+        output = args.output or os.path.join('bench_results', f"pipeline-{row['commit'] or 'local'}.json")
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(row, f, ensure_ascii=False, indent=1)
+        print(f"{row['messages']} сообщений x{row['repeat']}: {row['msg_per_sec']} msg/s, "
+              f"пиковый RSS {row['peak_rss_mb']} МБ, пик выделений Python {row['traced_peak_mb']} МБ")
+        for section in ('branches', 'outcomes'):
+            for name, summary in row[section].items():
+                print(f"  {name:<28} n={summary['count']:<6} p50={summary['p50_ms']} p95={summary['p95_ms']} "
+                      f"p99={summary['p99_ms']} мс")
+        print(f"Результат: {output}")
+        if args.compare:
+            with open(args.compare, encoding='utf-8') as f:
+                print('\n'.join(compare_results(json.load(f), row)))
+    elif args.command == 'stt':
+        rows, load, decode_ms = stt_benchmark(args.backends, args.durations, messages=args.messages,
+                                              stub_rtf=args.stub_rtf)
+        for row in rows:
+            if 'skipped' in row:
+                print(f"{row['backend']:<8} пропущен: {row['skipped']}")
+            else:
+                print(f"{row['backend']:<8} {row['audio_s']:>5} с аудио: {row['ms']:>8} мс "
+                      f"({row['ms_per_audio_s']} мс на секунду аудио)")
+        print(f"Очередь из {load['messages']} голосовых (stub, 5 и 30 с, пул 2): распознано {load['recognized']}, "
+              f"таймаутов {load['timed_out']}, {load['seconds']} с; "
+              f"макс. задержка цикла событий {load['loop_lag_max_ms']} мс")
+        print(f"Декодирование OGG 5 с через ffmpeg: {decode_ms} мс" if decode_ms is not None
+              else "ffmpeg не найден, декодирование OGG не замерялось")
+    elif args.command == 'tts':
+        logger.setLevel('WARNING')
+        for row in tts_benchmark(build_corpus(args.size), args.synth_ms):
+            print(f"{row['cache']:<10} {row['replies']} ответов ({row['unique']} разных): попаданий {row['hit_rate']}, "
+                  f"{row['sources']}; ответ в среднем {row['mean_ms']} мс (p50 {row['p50_ms']}, p95 {row['p95_ms']}), "
+                  f"отправлено {row['uploaded_kb']} КБ, на диске {row['disk_kb']} КБ"
+                  + (f"; прогрев {row['prewarmed_texts']} шаблонов за {row['prewarm_s']} с" if row['prewarm_s'] else ''))
+    elif args.command == 'sentiment':
+        logger.setLevel('WARNING')
+        for row in sentiment_benchmark(args.size, args.lexicons):
+            print(f"{row['words']:>7} слов: dict {row['dict_kb']} КБ, TonalLexicon {row['compact_kb']} КБ; "
+                  f"{row['replicas']} реплик (с оценкой {row['scored']}): прежний цикл {row['loop_per_sec']}/с, "
+                  f"по одной {row['single_per_sec']}/с, пакет {row['batch_per_sec']}/с, совпадают: {row['same']}")
+    elif args.command == 'menu':
+        logger.setLevel('WARNING')
+        for row in menu_benchmark(args.sizes, args.queries):
+            print(f"{row['dishes']:>7} блюд: проход {row['scan_us']} мкс, Menu {row['menu_us']} мкс на запрос "
+                  f"(x{row['speedup']}), построение {row['build_ms']} мс, результаты совпадают: {row['same']}")
+    elif args.command == 'templates':
+        logger.setLevel('WARNING')
+        for row in templates_benchmark(args.sizes, args.renders):
+            print(f"{row['dishes']:>7} блюд: str.replace {row['replace_ns']} нс, шаблон {row['compiled_ns']} нс, "
+                  f"готовый ответ {row['prerendered_ns']} нс; построение {row['build_ms']} мс, "
+                  f"подставлено заранее {row['prerendered']}, результаты совпадают: {row['same']}")
+    elif args.command == 'tenants':
+        logger.setLevel('WARNING')
+        for row in tenants_benchmark(args.tenants, args.capacities, args.messages, args.dishes):
+            print(f"{row['tenants']} ресторанов, в памяти до {row['capacity']}: активных {row['active']}, "
+                  f"загрузок {row['loads']}, вытеснений {row['evictions']}; p50 {row['latency']['p50_ms']} мс, "
+                  f"p99 {row['latency']['p99_ms']} мс; память после прогона {row['memory_mb']} МБ, "
+                  f"пик {row['peak_mb']} МБ")
+    elif args.command == 'logging':
+        for row in logging_benchmark(build_corpus(args.size), args.rounds):
+            print(f"{row['mode']:<20} в обработчике {row['caller_us_per_msg']:>6} мкс/сообщение, "
+                  f"CPU вместе с фоновой записью {row['cpu_us_per_msg']:>6} мкс, строк на сообщение {row['lines_per_msg']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,88 +1,187 @@
 # ./app/bot.py
+import time
+PROCESS_START = time.perf_counter()
+
 import random
-import nltk
-import pickle
 import os
+import asyncio
+import contextvars
+import functools
+import io
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from types import SimpleNamespace
 from telegram import Update
+from telegram.error import BadRequest
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
-import speech_recognition as sr
-from gtts import gTTS
-from pydub import AudioSegment
 from dotenv import load_dotenv
-from app.data.config import CONFIG
-from sklearn.metrics.pairwise import cosine_similarity
-from utils import clear_phrase, is_meaningful_text, extract_dish_name, extract_dish_category, extract_price, Stats, \
-    logger, lemmatize_phrase, analyze_sentiment
+import metrics
+from logs import sample_message_log
+from metrics import span, trace
+from state import UserState
+from transitions import ALWAYS, Transitions
+from utils import is_meaningful_text, extract_dish_name, extract_dish_category, extract_price, Stats, \
+    logger, message_logger, lemmatize_phrase, lemmatize_batch, analyze_sentiment, analyze_replica, reset_lemmatizer_calls, \
+    get_intent_index, get_menu_index, get_category_variants, get_embedding, Component, preload_components, \
+    components_ready, get_config, pin_components, reload_hooks, start_reloader, get_menu, extract_dietary, tenants, \
+    tenant_scope, get_templates, DISH_INTENTS, COMPOSED_INTENTS
 
 # Загрузка токена
 load_dotenv()
 TOKEN = os.getenv('TELEGRAM_TOKEN')
 
-# Загрузка модели для намерений
-try:
-    with open('models/intent_model.pkl', 'rb') as f:
-        clf = pickle.load(f)
-    with open('models/intent_vectorizer.pkl', 'rb') as f:
-        vectorizer = pickle.load(f)
-except FileNotFoundError as e:
-    logger.error(f"Не найдены файлы модели для намерений: {e}")
-    raise
-
-# Загрузка модели для dialogues.txt
-try:
-    with open('models/dialogues_vectorizer.pkl', 'rb') as f:
-        tfidf_vectorizer = pickle.load(f)
-    with open('models/dialogues_matrix.pkl', 'rb') as f:
-        tfidf_matrix = pickle.load(f)
-    with open('models/dialogues_answers.pkl', 'rb') as f:
-        answers = pickle.load(f)
-except FileNotFoundError as e:
-    logger.error(f"Не найдены файлы модели для dialogues.txt: {e}")
-    raise
+# Режим выполнения bot(): inline (в цикле событий), thread или process
+EXECUTION_MODE = os.getenv('BOT_EXECUTION_MODE', 'thread')
+WORKERS = int(os.getenv('BOT_WORKERS', '4'))
+CONCURRENT_UPDATES = int(os.getenv('BOT_CONCURRENT_UPDATES', '64'))
+
+# Загрузка тяжёлых компонентов: eager (до опроса), background (параллельно с подключением) или lazy
+STARTUP_MODE = os.getenv('STARTUP_MODE', 'background')
+
+# Поиск по dialogues.txt: tfidf (лексический) или dense (эмбеддинги navec + IVF)
+RETRIEVAL_MODE = os.getenv('DIALOGUE_RETRIEVAL', 'tfidf')
+DENSE_PROBES = int(os.getenv('DENSE_PROBES', '8'))
+DENSE_THRESHOLD = float(os.getenv('DENSE_THRESHOLD', '0.85'))
+# Как часто проверять, не появились ли новые сегменты или версия индекса dialogues
+DIALOGUES_REFRESH_INTERVAL = float(os.getenv('DIALOGUES_REFRESH_INTERVAL', '5'))
+# Как часто проверять изменения data/config.py и модели намерений (0 — без перезагрузки)
+RELOAD_INTERVAL = float(os.getenv('RELOAD_INTERVAL', '2'))
+# Эндпоинт /metrics (0 — выключен) и интервал сводки метрик в логе (0 — без сводки)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_DUMP_INTERVAL = float(os.getenv('METRICS_DUMP_INTERVAL', '0'))
+# Сколько блюд перечислять в ответе на фильтр, остальные — «и ещё N»
+MENU_PAGE_SIZE = int(os.getenv('MENU_PAGE_SIZE', '10'))
+
+def load_models():
+    # scipy и формат артефактов импортируются здесь, чтобы не задерживать старт бота
+    from artifacts import current_dir, LinearModel, TfidfModel
+    from dialogue_index import LiveDialogueIndex
+    models = SimpleNamespace()
+
+    # Загрузка модели для намерений (memmap, без pickle)
+    try:
+        intent_path, intent_manifest = current_dir('models', 'intent')
+        models.clf = LinearModel.load(intent_path, 'classifier')
+        models.vectorizer = TfidfModel.load(intent_path, 'vectorizer', intent_manifest['vectorizer'])
+    except FileNotFoundError as e:
+        logger.error(f"Не найдены файлы модели для намерений: {e}")
+        raise
+
+    # Загрузка модели для dialogues.txt: основная версия и дельта-сегменты
+    try:
+        models.dialogues = LiveDialogueIndex(dense=RETRIEVAL_MODE == 'dense', interval=DIALOGUES_REFRESH_INTERVAL)
+    except FileNotFoundError as e:
+        logger.error(f"Не найдены файлы модели для dialogues.txt: {e}")
+        raise
+    return models
+
+
+# Перезагрузка моделей при переобучении: train_intent_model.py переключает models/intent/CURRENT
+def models_stamp():
+    from artifacts import current_version
+    return current_version('models', 'intent')
+
+
+def load_speech():
+    from gtts import gTTS
+    from stt import SpeechRecognizer, create_backend
+    from tts import TTS_LANG, TTS_PREWARM, VoiceCache
+
+    def synthesize(text):
+        buffer = io.BytesIO()
+        gTTS(text=text, lang=TTS_LANG).write_to_fp(buffer)
+        return buffer.getvalue()
+
+    voices = VoiceCache(synthesize)
+    if TTS_PREWARM:
+        voices.start_prewarm(templated_answers(get_config()))
+    return SimpleNamespace(gTTS=gTTS, recognizer=SpeechRecognizer(create_backend()), voices=voices)
+
+
+def load_indexes():
+    get_menu()
+    get_menu_index()
+    get_intent_index()
+    get_category_variants()
+
+
+# Состояния диалогов пользователей (STATE_BACKEND: sqlite или memory)
+def load_sessions():
+    from state import open_state_store
+    store = open_state_store()
+    store.start()
+    return store
+
+
+models = Component('models', load_models, stamp=models_stamp)
+speech = Component('speech', load_speech)
+indexes = Component('indexes', load_indexes)
+sessions = Component('sessions', load_sessions)
+
+
+# Новые сегменты dialogues подхватывает поток перезагрузки, а не обработка сообщения
+def refresh_dialogues():
+    return models.loaded.is_set() and models.get().dialogues.refresh_if_due()
+
+
+reload_hooks.append(('dialogues', refresh_dialogues))
 
 # Классификация намерения
+@span('classify_intent')
 def classify_intent(replica):
     replica = lemmatize_phrase(replica)  # Используем лемматизированную фразу
     if not replica:
         return None
-    vectorized = vectorizer.transform([replica])
-    intent = clf.predict(vectorized)[0]
-    best_score = 0
-    best_intent = None
-    for intent_key, data in CONFIG['intents'].items():
-        for example in data.get('examples', []):
-            example = lemmatize_phrase(example)  # Лемматизируем примеры
-            if not example:
-                continue
-            distance = nltk.edit_distance(replica, example)
-            score = 1 - distance / max(len(example), 1)
-            if score > best_score and score >= 0.65:
-                best_score = score
-                best_intent = intent_key
-    logger.info(f"Classify intent: replica='{replica}', predicted='{intent}', best_intent='{best_intent}', score={best_score}")
+    loaded = models.get()
+    vectorized = loaded.vectorizer.transform([replica])
+    intent = loaded.clf.predict(vectorized)[0]
+    best_intent, best_score = get_intent_index().best_match(replica)
+    message_logger.info("Classify intent: replica='%s', predicted='%s', best_intent='%s', score=%s", replica, intent,
+                        best_intent, best_score)
     return best_intent or intent if best_score >= 0.65 else None
 
+
+def classify_intents(replicas):
+    """Пакетная classify_intent: те же метки, но лемматизация, векторизация и поиск по примерам — пакетами."""
+    lemmatized = lemmatize_batch(replicas)
+    rows = [idx for idx, replica in enumerate(lemmatized) if replica]
+    labels = [None] * len(replicas)
+    if not rows:
+        return labels
+    loaded = models.get()
+    texts = [lemmatized[idx] for idx in rows]
+    intents = loaded.clf.predict(loaded.vectorizer.transform(texts))
+    matches = get_intent_index().best_matches(texts)
+    for idx, intent, (best_intent, best_score) in zip(rows, intents, matches):
+        labels[idx] = best_intent or intent if best_score >= 0.65 else None
+    return labels
+
 # Получение ответа
-def get_answer_by_intent(intent, replica, context):
+@span('answer_by_intent')
+def get_answer_by_intent(intent, turn):
+    config = get_config()
+    menu = get_menu()
+    context = turn.context
     dish_name = context.user_data.get('current_dish')
     last_response = context.user_data.get('last_bot_response', '')
     last_intent = context.user_data.get('last_intent', '')
-    dish_category = extract_dish_category(replica)
-    price = extract_price(replica)
 
-    if intent in CONFIG['intents']:
-        responses = CONFIG['intents'][intent]['responses']
+    if intent in config['intents']:
+        templates = get_templates()
+        responses = templates.intents[intent]
         if not responses:
             return None
-        answer = random.choice(responses)
+        template = random.choice(responses)
+        answer = template.text
 
-        if intent in ['dish_price', 'dish_availability', 'dish_info', 'order_dish']:
+        if intent in DISH_INTENTS:
             if not dish_name:
                 if last_response and 'Кстати, у нас есть' in last_response:
                     dish_name = extract_dish_name(last_response)
                     context.user_data['current_dish'] = dish_name
-                elif dish_category:
-                    suitable_dishes = [dish for dish, data in CONFIG['dishes'].items() if dish_category in data.get('categories', [])]
+                elif turn['category']:
+                    dish_category = turn['category']
+                    suitable_dishes = menu.in_category(dish_category)
                     if suitable_dishes:
                         dish_name = random.choice(suitable_dishes)
                         context.user_data['current_dish'] = dish_name
@@ -97,7 +196,7 @@ def get_answer_by_intent(intent, replica, context):
                             break
                         hist_category = extract_dish_category(hist)
                         if hist_category:
-                            suitable_dishes = [dish for dish, data in CONFIG['dishes'].items() if hist_category in data.get('categories', [])]
+                            suitable_dishes = menu.in_category(hist_category)
                             if suitable_dishes:
                                 dish_name = random.choice(suitable_dishes)
                                 context.user_data['current_dish'] = dish_name
@@ -105,41 +204,38 @@ def get_answer_by_intent(intent, replica, context):
                 if not dish_name:
                     context.user_data['state'] = 'WAITING_FOR_DISH'
                     return "Какое блюдо или категорию вы имеете в виду?"
-            if dish_name in CONFIG['dishes']:
-                answer = answer.replace('[dish_name]', dish_name)
-                answer = answer.replace('[price]', str(CONFIG['dishes'][dish_name]['price']))
-                answer = answer.replace('[description]', CONFIG['dishes'][dish_name].get('description', 'вкусное блюдо'))
-                answer += f" Что ещё интересует?"
+            if dish_name in config['dishes']:
+                answer = fill_dish_answer(template, dish_name, templates)
             else:
                 return "Извините, такого блюда нет в меню."
 
         elif intent == 'dish_recommendation':
-            suitable_dishes = list(CONFIG['dishes'].keys())
-            if suitable_dishes:
-                dish_name = random.choice(suitable_dishes)
+            if menu.names:
+                dish_name = random.choice(menu.names)
                 context.user_data['current_dish'] = dish_name
-                answer = answer.replace('[dish_name]', dish_name)
-                answer += f" Хотите узнать цену или состав {dish_name}?"
+                answer = templates.render(template, dish_name) + f" Хотите узнать цену или состав {dish_name}?"
             else:
                 return "Извините, в меню пока нет блюд."
 
         elif intent == 'menu_types':
-            categories = random.sample(CONFIG['categories'], min(3, len(CONFIG['categories'])))
-            dishes = random.sample(list(CONFIG['dishes'].keys()), min(2, len(CONFIG['dishes'])))
+            categories = random.sample(config['categories'], min(3, len(config['categories'])))
+            dishes = random.sample(menu.names, min(2, len(menu)))
             answer = f"У нас есть {', '.join(categories)} и блюда вроде {', '.join(dishes)}. Что интересно?"
             context.user_data['current_dish'] = None
 
         elif intent == 'yes':
             if last_intent == 'hello':
-                categories = random.sample(CONFIG['categories'], min(3, len(CONFIG['categories'])))
+                categories = random.sample(config['categories'], min(3, len(config['categories'])))
                 answer = f"Отлично! У нас есть {', '.join(categories)}. Что хотите узнать?"
             elif last_intent in ['dish_price', 'dish_info', 'dish_availability', 'order_dish']:
-                if dish_name:
-                    answer = f"Цена на {dish_name} — {CONFIG['dishes'][dish_name]['price']} рублей. Что ещё интересует?"
+                if dish_name in config['dishes']:
+                    answer = f"Цена на {dish_name} — {config['dishes'][dish_name]['price']} рублей. Что ещё интересует?"
                 else:
+                    # Блюда нет или его убрали из меню после сохранения состояния
+                    context.user_data['current_dish'] = None
                     answer = "Назови блюдо, чтобы я рассказал подробнее!"
             elif last_intent == 'menu_types':
-                dishes = random.sample(list(CONFIG['dishes'].keys()), min(2, len(CONFIG['dishes'])))
+                dishes = random.sample(menu.names, min(2, len(menu)))
                 answer = f"У нас есть {', '.join(dishes)}. Назови одно, чтобы узнать больше!"
             elif last_intent == 'offtopic':
                 answer = "Хорошо, давай продолжим! Но дай знать, если захочешь узнать что-нибудь о блюдах"
@@ -152,66 +248,236 @@ def get_answer_by_intent(intent, replica, context):
             answer = "Хорошо, давайте продолжим диалог"
 
         elif intent == 'filter_dishes':
-            if price:
-                suitable_dishes = [dish for dish, data in CONFIG['dishes'].items() if data['price'] <= price]
-                if suitable_dishes:
-                    dishes_list = ', '.join(suitable_dishes)
-                    answer = f"До {price} рублей есть: {dishes_list}."
-                else:
-                    answer = f"Извините, нет блюд до {price} рублей."
-            elif dish_category:
-                suitable_dishes = [dish for dish, data in CONFIG['dishes'].items() if dish_category in data.get('categories', [])]
-                if suitable_dishes:
-                    dishes_list = ', '.join(suitable_dishes)
-                    answer = f"В категории {dish_category} есть: {dishes_list}."
-                    context.user_data['current_dish'] = random.choice(suitable_dishes)
-                    context.user_data['state'] = 'WAITING_FOR_INTENT'
+            price = turn['price']
+            dish_category = turn['category']
+            dietary = turn['dietary']
+            if dietary and dish_category in menu.dietary_categories[dietary]:
+                # «детское меню» — уже и категория, и метка
+                dietary = None
+            if price or dish_category or dietary:
+                # Условия объединяются: «салаты до 400 рублей», «для детей до 300 рублей»
+                conditions = []
+                if dish_category:
+                    conditions.append(f"в категории {dish_category}")
+                if dietary:
+                    conditions.append(menu.labels[dietary])
+                if price:
+                    conditions.append(f"до {price} рублей")
+                conditions = ' '.join(conditions)
+                page = menu.filter(max_price=price or None, category=dish_category, dietary=dietary,
+                                   limit=MENU_PAGE_SIZE)
+                if page.dishes:
+                    dishes_list = ', '.join(page.dishes)
+                    if page.rest:
+                        dishes_list += f" и ещё {page.rest}"
+                    answer = f"{conditions[0].upper()}{conditions[1:]} есть: {dishes_list}."
+                    if dish_category:
+                        context.user_data['current_dish'] = random.choice(page.dishes)
+                        context.user_data['state'] = 'WAITING_FOR_INTENT'
                 else:
-                    answer = f"Извините, нет блюд в категории {dish_category}."
+                    answer = f"Извините, нет блюд {conditions}."
             else:
                 answer = "Укажите цену или категорию для фильтрации."
 
         # Реклама
         if intent in ['hello', 'menu_types'] and random.random() < 0.2:
-            ad_dish = random.choice([d for d in CONFIG['dishes'].keys() if d != dish_name])
+            ad_dish = menu.random_dish(exclude=dish_name)
             answer += f" Кстати, у нас есть {ad_dish} — отличный выбор для вкусного ужина!"
 
         context.user_data['last_intent'] = intent
         return answer
     return None
 
+def fill_dish_answer(template, dish_name, templates):
+    return templates.render(template, dish_name) + " Что ещё интересует?"
+
+
+def templated_answers(config):
+    """Ответы, которые повторяются дословно: шаблоны CONFIG['intents'] × блюда и фиксированные фразы.
+
+    Нужны для прогрева кэша синтеза речи; ответы со случайной рекламой или списками сюда не входят.
+    """
+    dishes = config['dishes']
+    templates = get_templates()
+    yield config['start_message']
+    yield config['help_message']
+    for intent, responses in templates.intents.items():
+        for template in responses:
+            if intent in DISH_INTENTS:
+                for dish_name in dishes:
+                    yield fill_dish_answer(template, dish_name, templates)
+            elif intent == 'dish_recommendation':
+                for dish_name in dishes:
+                    yield templates.render(template, dish_name) + f" Хотите узнать цену или состав {dish_name}?"
+            elif not template.slots and intent not in COMPOSED_INTENTS:
+                yield template.text
+    for dish_name, data in dishes.items():
+        yield f"Вы имеете в виду {dish_name}? Хотите узнать цену, состав или наличие?"
+        yield f"Цена на {dish_name} — {data['price']} рублей. Что ещё интересует?"
+        yield f"Что хотите узнать про {dish_name}: цену, состав или наличие?"
+        for category in data.get('categories', []):
+            yield f"Из {category} есть {dish_name}. Хотите узнать цену, состав или наличие?"
+        for template in templates.failure:
+            yield templates.render(template, dish_name)
+    yield from ["Хорошо, давайте продолжим диалог", "Хорошо, какое блюдо обсудим теперь?",
+                "Какое блюдо или категорию вы имеете в виду?", "Извините, такого блюда нет в меню.",
+                "Укажите цену или категорию для фильтрации.", "Пожалуйста, уточните название блюда или категорию.",
+                "Назови блюдо, чтобы я рассказал подробнее!", "Хорошо, что интересует? Блюда, цены или что-то ещё?",
+                "Хорошо, давай продолжим! Но дай знать, если захочешь узнать что-нибудь о блюдах"]
+
 # Ответ из dialogues.txt с TF-IDF
+@span('generate_answer')
 def generate_answer(replica, context):
-    replica = clear_phrase(replica)
-    if not replica or not answers:
+    analysis = analyze_replica(replica)
+    replica = analysis.cleaned
+    dialogues = models.get().dialogues.get()
+    if not replica or not len(dialogues):
         return None
     if not is_meaningful_text(replica):
         return None
-    replica_vector = tfidf_vectorizer.transform([replica])
-    similarities = cosine_similarity(replica_vector, tfidf_matrix).flatten()
-    best_idx = similarities.argmax()
-    if similarities[best_idx] > 0.5:
-        answer = answers[best_idx]
-        logger.info(f"Found in dialogues.txt: replica='{replica}', answer='{answer}', similarity={similarities[best_idx]}")
+    if RETRIEVAL_MODE == 'dense':
+        from retrieval import sentence_vector
+        found = dialogues.search_dense(sentence_vector(analysis.lemmas, get_embedding()), k=1, n_probe=DENSE_PROBES)
+        threshold = DENSE_THRESHOLD
+    else:
+        found = dialogues.search(replica, k=1)
+        threshold = 0.5
+    if found and found[0][1] > threshold:
+        best_idx, similarity = found[0]
+        answer = dialogues.answer(best_idx)
+        message_logger.info("Found in dialogues.txt: replica='%s', answer='%s', similarity=%s", replica, answer,
+                            similarity)
         if random.random() < 0.05:
-            ad_dish = random.choice(list(CONFIG['dishes'].keys()))
+            ad_dish = random.choice(get_menu().names)
             answer += f" Кстати, у нас есть {ad_dish} — очень вкусно!"
         context.user_data['last_intent'] = 'offtopic'
-        sentiment = analyze_sentiment(replica)
+        sentiment = analyze_sentiment(analysis)
         if sentiment == 'positive':
             answer += " Рад, что вы в хорошем настроении!"
         elif sentiment == 'negative':
             answer += " Кажется, вы не в духе. Я думаю, блюда в ресторане поднимут настроение?"
         return answer
-    logger.info(f"No match in dialogues.txt for replica='{replica}'")
+    message_logger.info("No match in dialogues.txt for replica='%s'", replica)
     return None
 
 # Заглушка
 def get_failure_phrase():
-    dish_name = random.choice(list(CONFIG['dishes'].keys()))
-    return random.choice(CONFIG['failure_phrases']).replace('[dish_name]', dish_name)
+    dish_name = random.choice(get_menu().names)
+    templates = get_templates()
+    return templates.render(random.choice(templates.failure), dish_name)
+
+# Признаки сообщения для таблицы переходов: (этап метрик, извлечение); каждый считается не больше раза
+SIGNALS = {
+    'nonsense': ('meaningful', lambda turn: not is_meaningful_text(turn.analysis)),
+    'price': ('extract', lambda turn: extract_price(turn.analysis)),
+    'category': ('extract', lambda turn: extract_dish_category(turn.analysis)),
+    'dietary': ('extract', lambda turn: extract_dietary(turn.analysis)),
+    'filter': (None, lambda turn: turn['price'] or turn['category'] or turn['dietary']),
+    'dish': ('extract_dish', lambda turn: extract_dish_name(turn.analysis)),
+    # classify_intent пишет свой этап
+    'intent': (None, lambda turn: classify_intent(turn.analysis)),
+    'dish_intent': (None, lambda turn: turn['intent'] in DISH_INTENTS),
+    'yes': (None, lambda turn: turn['intent'] == 'yes'),
+    'no': (None, lambda turn: turn['intent'] == 'no'),
+}
+
+
+# Обработчики переходов: (тип статистики, ответ) или None — тогда проверяется следующее правило
+def reset_with_failure_phrase(turn):
+    turn.context.user_data['state'] = 'NONE'
+    turn.context.user_data['current_dish'] = None
+    return 'failure', get_failure_phrase()
+
+
+def answer_intent(turn, intent=None):
+    answer = get_answer_by_intent(intent or turn['intent'], turn)
+    return ('intent', answer) if answer else None
+
+
+def answer_filter(turn):
+    return answer_intent(turn, 'filter_dishes')
+
+
+def answer_dish_intent(turn):
+    turn.context.user_data['state'] = 'NONE'
+    return answer_intent(turn)
+
+
+def ask_about_dish(turn):
+    dish_name = turn['dish']
+    turn.context.user_data['current_dish'] = dish_name
+    turn.context.user_data['state'] = 'WAITING_FOR_INTENT'
+    return 'intent', f"Вы имеете в виду {dish_name}? Хотите узнать цену, состав или наличие?"
+
+
+def offer_from_category(turn):
+    dish_category = turn['category']
+    suitable_dishes = get_menu().in_category(dish_category)
+    if not suitable_dishes:
+        return None
+    dish_name = random.choice(suitable_dishes)
+    turn.context.user_data['current_dish'] = dish_name
+    turn.context.user_data['state'] = 'WAITING_FOR_INTENT'
+    return 'intent', f"Из {dish_category} есть {dish_name}. Хотите узнать цену, состав или наличие?"
+
+
+def offer_from_category_or_fail(turn):
+    return offer_from_category(turn) or \
+        ('failure', f"У нас нет блюд в категории {turn['category']}. Попробуйте другую категорию!")
+
+
+def ask_dish_again(turn):
+    return 'failure', "Пожалуйста, уточните название блюда или категорию."
+
+
+def tell_price(turn):
+    dish_name = turn.context.user_data.get('current_dish')
+    if not dish_name:
+        return None
+    turn.context.user_data['state'] = 'NONE'
+    dishes = get_config()['dishes']
+    if dish_name not in dishes:
+        # Блюдо убрали из меню, пока пользователь о нём спрашивал
+        turn.context.user_data['current_dish'] = None
+        return 'intent', "Назови блюдо, чтобы я рассказал подробнее!"
+    return 'intent', f"Цена на {dish_name} — {dishes[dish_name]['price']} рублей. Что ещё интересует?"
+
+
+def drop_dish(turn):
+    turn.context.user_data['current_dish'] = None
+    turn.context.user_data['state'] = 'NONE'
+    return 'intent', "Хорошо, какое блюдо обсудим теперь?"
+
+
+def ask_what_about_dish(turn):
+    dish_name = turn.context.user_data.get('current_dish', 'блюдо')
+    return 'failure', f"Что хотите узнать про {dish_name}: цену, состав или наличие?"
+
+
+def answer_offtopic(turn):
+    # dialogues.txt для отвлечённых тем
+    answer = generate_answer(turn.analysis, turn.context)
+    return ('generate', answer) if answer else None
+
+
+def fail(turn):
+    return 'failure', get_failure_phrase()
+
 
-# Основная логика
+# Диалог: в любом состоянии сначала несуразный текст и фильтры меню, затем правила состояния по порядку
+TRANSITIONS = Transitions(SIGNALS, common=(('nonsense', reset_with_failure_phrase), ('filter', answer_filter)), table={
+    'WAITING_FOR_DISH': (('dish', ask_about_dish), ('category', offer_from_category), (ALWAYS, ask_dish_again)),
+    'WAITING_FOR_INTENT': (('dish_intent', answer_dish_intent), ('yes', tell_price), ('no', drop_dish),
+                           (ALWAYS, ask_what_about_dish)),
+    'NONE': (('dish', ask_about_dish), ('category', offer_from_category_or_fail), ('intent', answer_intent),
+             (ALWAYS, answer_offtopic), (ALWAYS, fail)),
+})
+
+
+# Основная логика; CONFIG и модели фиксируются на время обработки сообщения
+@pin_components()
+@trace()
+@span('bot')
 def bot(replica, context):
     stats = Stats(context)
     if 'state' not in context.user_data:
@@ -225,204 +491,240 @@ def bot(replica, context):
     if 'history' not in context.user_data:
         context.user_data['history'] = []
 
-    context.user_data['history'].append(replica)
-    context.user_data['history'] = context.user_data['history'][-5:]
+    context.user_data['history'] = (context.user_data['history'] + [replica])[-5:]
 
     state = context.user_data['state']
-    logger.info(f"Processing: replica='{replica}', state='{state}', last_intent='{context.user_data.get('last_intent')}'")
-
-    # Проверка на несуразный текст
-    if not is_meaningful_text(replica):
-        context.user_data['state'] = 'NONE'
-        context.user_data['current_dish'] = None
-        answer = get_failure_phrase()
-        context.user_data['last_bot_response'] = answer
-        stats.add('failure', replica, answer, context)
-        return answer
-
-    # Проверка цены или категории
-    price = extract_price(replica)
-    dish_category = extract_dish_category(replica)
-    if price or dish_category:
-        intent = 'filter_dishes'
-        answer = get_answer_by_intent(intent, replica, context)
-        if answer:
-            context.user_data['last_bot_response'] = answer
-            stats.add('intent', replica, answer, context)
-            return answer
-
-    # Обработка состояния
-    if state == 'WAITING_FOR_DISH':
-        dish_name = extract_dish_name(replica)
-        if dish_name:
-            context.user_data['current_dish'] = dish_name
-            context.user_data['state'] = 'WAITING_FOR_INTENT'
-            answer = f"Вы имеете в виду {dish_name}? Хотите узнать цену, состав или наличие?"
-            context.user_data['last_bot_response'] = answer
-            stats.add('intent', replica, answer, context)
-            return answer
-        dish_category = extract_dish_category(replica)
-        if dish_category:
-            suitable_dishes = [dish for dish, data in CONFIG['dishes'].items() if dish_category in data.get('categories', [])]
-            if suitable_dishes:
-                dish_name = random.choice(suitable_dishes)
-                context.user_data['current_dish'] = dish_name
-                context.user_data['state'] = 'WAITING_FOR_INTENT'
-                answer = f"Из {dish_category} есть {dish_name}. Хотите узнать цену, состав или наличие?"
-                context.user_data['last_bot_response'] = answer
-                stats.add('intent', replica, answer, context)
-                return answer
-        answer = "Пожалуйста, уточните название блюда или категорию."
-        context.user_data['last_bot_response'] = answer
-        stats.add('failure', replica, answer, context)
-        return answer
-
-    if state == 'WAITING_FOR_INTENT':
-        intent = classify_intent(replica)
-        if intent in ['dish_price', 'dish_availability', 'dish_info', 'order_dish']:
-            context.user_data['state'] = 'NONE'
-            answer = get_answer_by_intent(intent, replica, context)
-            if answer:
-                context.user_data['last_bot_response'] = answer
-                stats.add('intent', replica, answer, context)
-                return answer
-        if intent == 'yes':
-            dish_name = context.user_data.get('current_dish')
-            if dish_name:
-                context.user_data['state'] = 'NONE'
-                answer = f"Цена на {dish_name} — {CONFIG['dishes'][dish_name]['price']} рублей. Что ещё интересует?"
-                context.user_data['last_bot_response'] = answer
-                stats.add('intent', replica, answer, context)
-                return answer
-        if intent == 'no':
-            context.user_data['current_dish'] = None
-            context.user_data['state'] = 'NONE'
-            answer = "Хорошо, какое блюдо обсудим теперь?"
-            context.user_data['last_bot_response'] = answer
-            stats.add('intent', replica, answer, context)
-            return answer
-        dish_name = context.user_data.get('current_dish', 'блюдо')
-        answer = f"Что хотите узнать про {dish_name}: цену, состав или наличие?"
-        context.user_data['last_bot_response'] = answer
-        stats.add('failure', replica, answer, context)
-        return answer
-
-    # Проверка блюда
-    dish_name = extract_dish_name(replica)
-    if dish_name:
-        context.user_data['current_dish'] = dish_name
-        context.user_data['state'] = 'WAITING_FOR_INTENT'
-        answer = f"Вы имеете в виду {dish_name}? Хотите узнать цену, состав или наличие?"
-        context.user_data['last_bot_response'] = answer
-        stats.add('intent', replica, answer, context)
-        return answer
+    # Natasha запускается один раз, дальше все извлекатели работают с готовым разбором
+    reset_lemmatizer_calls()
+    sample_message_log()
+    with span('analyze'):
+        analysis = analyze_replica(replica)
+    message_logger.info("Processing: replica='%s', state='%s', last_intent='%s'", replica, state,
+                        context.user_data.get('last_intent'))
+
+    stat_type, answer = TRANSITIONS.run(state, TRANSITIONS.turn(replica, analysis, context))
+    context.user_data['last_bot_response'] = answer
+    stats.add(stat_type, replica, answer, context)
+    return answer
 
-    # Проверка категории
-    dish_category = extract_dish_category(replica)
-    if dish_category:
-        suitable_dishes = [dish for dish, data in CONFIG['dishes'].items() if dish_category in data.get('categories', [])]
-        if suitable_dishes:
-            dish_name = random.choice(suitable_dishes)
-            context.user_data['current_dish'] = dish_name
-            context.user_data['state'] = 'WAITING_FOR_INTENT'
-            answer = f"Из {dish_category} есть {dish_name}. Хотите узнать цену, состав или наличие?"
-            context.user_data['last_bot_response'] = answer
-            stats.add('intent', replica, answer, context)
-            return answer
-        answer = f"У нас нет блюд в категории {dish_category}. Попробуйте другую категорию!"
-        context.user_data['last_bot_response'] = answer
-        stats.add('failure', replica, answer, context)
+# Пул воркеров для CPU-нагрузки (Natasha, sklearn)
+executor = None
+
+
+def init_worker():
+    """Загружает модели и прогревает индексы в воркере один раз."""
+    metrics.reset_trace()
+    models.get()
+    indexes.get()
+    start_reloader(RELOAD_INTERVAL)
+
+
+def configure_executor(mode=EXECUTION_MODE, workers=WORKERS):
+    global executor, EXECUTION_MODE
+    if executor is not None:
+        executor.shutdown()
+        executor = None
+    if mode == 'thread':
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bot-worker')
+    elif mode == 'process':
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+    elif mode != 'inline':
+        raise ValueError(f"Неизвестный режим выполнения: {mode}")
+    EXECUTION_MODE = mode
+    logger.info(f"Режим выполнения bot(): {mode}, воркеров: {workers if executor else 0}")
+    return executor
+
+
+# Выполнение в процессе-воркере: user_data передаётся копией и возвращается обратно
+# вместе с ними возвращаются метрики, накопленные воркером
+def process_replica(replica, user_data, sampled=None):
+    context = SimpleNamespace(user_data=user_data)
+    # Ресторан пользователя: контекстная переменная в процесс-воркер не передаётся
+    with trace(sampled, record=False) as current, tenant_scope(user_data.get('tenant')):
+        answer = bot(replica, context)
+    return answer, context.user_data, current.pending
+
+
+async def run_blocking(func, *args):
+    if executor is None:
+        return func(*args)
+    if isinstance(executor, ThreadPoolExecutor):
+        # Поток-воркер продолжает трассировку сообщения
+        return await asyncio.get_running_loop().run_in_executor(executor, contextvars.copy_context().run, func, *args)
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def bot_async(replica, context):
+    if EXECUTION_MODE == 'process' and executor is not None:
+        current = metrics.current_trace()
+        answer, user_data, pending = await run_blocking(process_replica, replica, context.user_data.copy(),
+                                                        current.sampled if current else None)
+        context.user_data.update(user_data)
+        metrics.extend(pending)
         return answer
+    return await run_blocking(bot, replica, context)
 
-    # Классификация намерения
-    intent = classify_intent(replica)
-    if intent:
-        answer = get_answer_by_intent(intent, replica, context)
-        if answer:
-            context.user_data['last_bot_response'] = answer
-            stats.add('intent', replica, answer, context)
-            return answer
 
-    # dialogues.txt для отвлечённых тем
-    answer = generate_answer(replica, context)
-    if answer:
-        context.user_data['last_bot_response'] = answer
-        stats.add('generate', replica, answer, context)
-        return answer
+# Сообщения одного пользователя обрабатываются строго по очереди
+_user_locks = {}
 
-    # Заглушка как последний вариант
-    answer = get_failure_phrase()
-    context.user_data['last_bot_response'] = answer
-    stats.add('failure', replica, answer, context)
-    return answer
 
-# Голос в текст
-def voice_to_text(voice_file):
-    recognizer = sr.Recognizer()
+async def run_for_user(user_id, func, *args):
+    entry = _user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            return await func(*args)
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _user_locks[user_id]
+
+
+# Ранние сообщения ждут загрузки компонентов, а не падают
+async def wait_until_ready():
+    if not components_ready.is_set():
+        logger.info("Компоненты ещё загружаются, сообщение ждёт готовности")
+        await asyncio.get_running_loop().run_in_executor(None, components_ready.wait)
+
+
+def forget_missing_dish(user_data):
+    """Сохранённое блюдо могло пропасть из меню после перезапуска или перезагрузки CONFIG."""
+    dish_name = user_data.get('current_dish')
+    if dish_name and dish_name not in get_config()['dishes']:
+        user_data['current_dish'] = None
+        if user_data.get('state') == 'WAITING_FOR_INTENT':
+            user_data['state'] = 'NONE'
+
+
+def per_user(handler):
+    """Обработчик получает контекст, где user_data — состояние пользователя из хранилища sessions.
+
+    Ресторан пользователя (user_data['tenant']) действует на всё время обработки, включая воркеры bot().
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async def handle():
+            await wait_until_ready()
+            with trace(), span(handler.__name__):
+                args = getattr(context, 'args', None)
+                if user is None:
+                    return await handler(update, SimpleNamespace(bot=context.bot, user_data=UserState(), args=args))
+                store = sessions.get()
+                session = SimpleNamespace(bot=context.bot, user_data=store.get(user.id), args=args)
+                try:
+                    with tenant_scope(session.user_data.get('tenant')):
+                        forget_missing_dish(session.user_data)
+                        return await handler(update, session)
+                finally:
+                    store.put(user.id, session.user_data)
+
+        user = update.effective_user
+        return await run_for_user(user.id if user else None, handle)
+    return wrapper
+
+# Голос в текст: движок STT_BACKEND в отдельном пуле с ограничением одновременных распознаваний и таймаутом
+async def voice_to_text(voice_data):
     try:
-        audio = AudioSegment.from_ogg(voice_file)
-        audio.export('voice.wav', format='wav')
-        with sr.AudioFile('voice.wav') as source:
-            audio_data = recognizer.record(source)
-        return recognizer.recognize_google(audio_data, language='ru-RU')
-    except (sr.UnknownValueError, sr.RequestError, Exception) as e:
+        return await speech.get().recognizer.transcribe(voice_data)
+    except asyncio.TimeoutError:
+        logger.error("Распознавание голоса не уложилось в таймаут")
+        return None
+    except Exception as e:
         logger.error(f"Ошибка распознавания голоса: {e}")
         return None
-    finally:
-        if os.path.exists('voice.wav'):
-            os.remove('voice.wav')
 
-# Текст в голос
+# Текст в голос: MP3 из кэша синтеза (память, диск) или от gTTS, без временных файлов
+@span('tts')
 def text_to_voice(text):
     if not text:
         return None
     try:
-        tts = gTTS(text=text, lang='ru')
-        voice_file = 'response.mp3'
-        tts.save(voice_file)
-        return voice_file
+        return speech.get().voices.get(text)
     except Exception as e:
         logger.error(f"Ошибка синтеза речи: {e}")
         return None
 
+# Голосовой ответ: по file_id, если этот текст уже отправлялся, иначе MP3; без голоса — текстом
+async def reply_with_voice(message, answer):
+    voices = speech.get().voices
+    file_id = voices.file_id(answer)
+    if file_id:
+        try:
+            with span('reply'):
+                await message.reply_voice(file_id)
+            return
+        except BadRequest as e:
+            logger.error(f"Telegram не принял сохранённый file_id голосового ответа: {e}")
+            voices.forget_file_id(answer)
+    voice_response = await asyncio.to_thread(text_to_voice, answer)
+    with span('reply'):
+        if not voice_response:
+            await message.reply_text(answer)
+            return
+        sent = await message.reply_voice(voice_response)
+    if sent.voice:
+        voices.remember_file_id(answer, sent.voice.file_id)
+
 # Telegram-обработчики
+# /start <ресторан> (deep-link t.me/<бот>?start=<ресторан>) переключает пользователя на меню ресторана
+@per_user
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    answer = CONFIG['start_message']
+    tenant = context.user_data.get('tenant')
+    if context.args:
+        if tenants.exists(context.args[0]):
+            if context.args[0] != tenant:
+                # Блюдо и состояние диалога относятся к прежнему меню
+                context.user_data['current_dish'] = None
+                context.user_data['state'] = 'NONE'
+            tenant = context.user_data['tenant'] = context.args[0]
+        else:
+            logger.error(f"Неизвестный ресторан в /start: {context.args[0]}")
+    with tenant_scope(tenant):
+        config = get_config()
+    answer = config['start_message']
     context.user_data['last_bot_response'] = answer
     context.user_data['last_intent'] = 'hello'
     await update.message.reply_text(answer)
 
+@per_user
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    answer = CONFIG['help_message']
+    config = get_config()
+    answer = config['help_message']
     context.user_data['last_bot_response'] = answer
     context.user_data['last_intent'] = 'help'
     await update.message.reply_text(answer)
 
+@per_user
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    metrics.count(metrics.MESSAGES, 'text')
     user_text = update.message.text
     if not user_text:
         answer = "Пожалуйста, отправьте текст."
         context.user_data['last_bot_response'] = answer
         await update.message.reply_text(answer)
         return
-    answer = bot(user_text, context)
-    await update.message.reply_text(answer)
+    # bot_async включает ожидание свободного воркера, bot — только саму обработку
+    with span('bot_async'):
+        answer = await bot_async(user_text, context)
+    with span('reply'):
+        await update.message.reply_text(answer)
 
+# Голосовой путь целиком в памяти: общих файлов нет, сообщения разных пользователей обрабатываются параллельно
+@per_user
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    metrics.count(metrics.MESSAGES, 'voice')
     voice = update.message.voice
     try:
-        voice_file = await context.bot.get_file(voice.file_id)
-        await voice_file.download_to_drive('voice.ogg')
-        text = voice_to_text('voice.ogg')
+        with span('download'):
+            voice_file = await context.bot.get_file(voice.file_id)
+            buffer = io.BytesIO()
+            await voice_file.download_to_memory(buffer)
+        text = await voice_to_text(buffer.getvalue())
         if text:
-            answer = bot(text, context)
-            voice_response = text_to_voice(answer)
-            if voice_response:
-                with open(voice_response, 'rb') as audio:
-                    await update.message.reply_voice(audio)
-                os.remove(voice_response)
-            else:
-                await update.message.reply_text(answer)
+            with span('bot_async'):
+                answer = await bot_async(text, context)
+            await reply_with_voice(update.message, answer)
         else:
             answer = "Не удалось распознать голос. Попробуйте ещё раз."
             context.user_data['last_bot_response'] = answer
@@ -432,14 +734,38 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
         answer = "Произошла ошибка. Попробуйте снова."
         context.user_data['last_bot_response'] = answer
         await update.message.reply_text(answer)
-    finally:
-        if os.path.exists('voice.ogg'):
-            os.remove('voice.ogg')
+
+async def report_startup(app):
+    logger.info(f"Время до начала опроса: {time.perf_counter() - PROCESS_START:.3f} с")
+
+
+async def close_sessions(app):
+    # Несохранённые состояния записываются перед выходом
+    if sessions.loaded.is_set():
+        sessions.get().close()
+
+
+def start_components():
+    start_reloader(RELOAD_INTERVAL)
+    metrics.start_server(METRICS_PORT, METRICS_HOST)
+    metrics.start_dump(METRICS_DUMP_INTERVAL, logger.info)
+    if STARTUP_MODE == 'lazy':
+        components_ready.set()
+        return
+    preload_components()
+    if STARTUP_MODE == 'eager':
+        components_ready.wait()
+
 
 def run_bot():
     if not TOKEN:
         raise ValueError("TELEGRAM_TOKEN не найден")
-    app = ApplicationBuilder().token(TOKEN).build()
+    start_components()
+    builder = ApplicationBuilder().token(TOKEN).post_init(report_startup).post_shutdown(close_sessions)
+    if configure_executor() is not None:
+        # Обновления разных пользователей обрабатываются параллельно
+        builder = builder.concurrent_updates(CONCURRENT_UPDATES)
+    app = builder.build()
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
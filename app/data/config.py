@@ -174,6 +174,19 @@ CONFIG = {
             'categories': ['горячие блюда']
         }
     },
+    # Диетические фильтры: слова запроса (леммы), категории и поле 'dietary' блюда, которые им соответствуют
+    'dietary': {
+        'vegan': {
+            'label': 'для веганов',
+            'keywords': ['веган', 'веганский', 'вегетарианец', 'вегетарианский', 'постный'],
+            'categories': ['веганские блюда']
+        },
+        'kids': {
+            'label': 'для детей',
+            'keywords': ['ребенок', 'дети', 'детский'],
+            'categories': ['детское меню']
+        }
+    },
     'failure_phrases': [
         'Не понял вас. Может, спросите про [dish_name]?',
         'Уточните, пожалуйста, что вы имеете в виду. Например, про [dish_name].',
@@ -0,0 +1,48 @@
+# ./app/data/tenants/pizzeria.py
+# Пример второго ресторана: /start pizzeria. Намерения и фразы берутся из основного CONFIG, меню своё
+
+import os
+import runpy
+
+# Тот же файл, что у основного CONFIG бота: его изменения перечитывают и этот ресторан
+BASE_PATH = os.getenv('BOT_CONFIG_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config.py'))
+BASE = runpy.run_path(BASE_PATH)['CONFIG']
+
+CONFIG = dict(
+    BASE,
+    start_message='Привет! Я чат-бот пиццерии. Расскажу о пицце, напитках и десертах, помогу выбрать и заказать. '
+                  'Поддерживаю текстовые и голосовые сообщения.',
+    categories=['пицца', 'напитки', 'десерты', 'детское меню'],
+    dishes={
+        'пицца маргарита': {
+            'price': 550,
+            'description': 'пицца с томатным соусом, моцареллой и базиликом',
+            'synonyms': ['маргарита', 'пицца с сыром'],
+            'categories': ['пицца']
+        },
+        'пицца пепперони': {
+            'price': 650,
+            'description': 'пицца с острой колбасой пепперони и моцареллой',
+            'synonyms': ['пепперони', 'острая пицца'],
+            'categories': ['пицца']
+        },
+        'детская пицца': {
+            'price': 400,
+            'description': 'маленькая пицца с ветчиной и сыром',
+            'synonyms': ['маленькая пицца'],
+            'categories': ['пицца', 'детское меню']
+        },
+        'лимонад': {
+            'price': 200,
+            'description': 'домашний лимонад с мятой, 0.4 л',
+            'synonyms': ['домашний лимонад'],
+            'categories': ['напитки']
+        },
+        'тирамису': {
+            'price': 380,
+            'description': 'десерт с маскарпоне и кофе',
+            'synonyms': ['десерт тирамису'],
+            'categories': ['десерты']
+        }
+    }
+)
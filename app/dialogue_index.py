@@ -0,0 +1,203 @@
+# ./app/dialogue_index.py
+
+import bisect
+import itertools
+import math
+import os
+import time
+from collections import Counter
+import numpy as np
+from artifacts import StringTable, TfidfModel, current_version, load_array, read_manifest, read_segments
+from retrieval import DialogueRetriever, IVFIndex, exact_dense_search, top_k
+from utils import logger
+
+
+# Одна часть индекса dialogues: основная версия или дельта-сегмент, добавленный дообучением
+class DialogueSegment:
+    def __init__(self, path, manifest, vectorizer, document_freq, retriever, answers, vectors=None, ivf_index=None):
+        self.path = path
+        self.manifest = manifest
+        self.vectorizer = vectorizer
+        self.document_freq = document_freq
+        self.retriever = retriever
+        self.answers = answers
+        self.vectors = vectors
+        self.ivf_index = ivf_index
+
+    def __len__(self):
+        return len(self.answers)
+
+    @classmethod
+    def load(cls, path, dense=False):
+        manifest = read_manifest(path)
+        vectorizer = TfidfModel.load(path, 'vectorizer', manifest['vectorizer'])
+        if os.path.exists(os.path.join(path, 'vectorizer_df.npy')):
+            document_freq = load_array(path, 'vectorizer_df')
+        else:
+            # Модели, обученные до появления сегментов: частоты документов восстанавливаются из idf
+            n_rows = manifest['n_answers']
+            document_freq = np.rint((1 + n_rows) / np.exp(np.asarray(vectorizer.idf) - 1) - 1).astype(np.int64)
+        segment = cls(path, manifest, vectorizer, document_freq,
+                      DialogueRetriever.load(path, manifest['postings']), StringTable.load(path, 'answers'))
+        if dense:
+            if 'dense' not in manifest:
+                raise FileNotFoundError(f"Нет плотного индекса для dialogues.txt в {path}")
+            if 'n_lists' in manifest['dense']:
+                segment.ivf_index = IVFIndex.load(path)
+            else:
+                segment.vectors = load_array(path, 'embeddings')
+        return segment
+
+
+class DialogueIndex:
+    """Основная версия models/dialogues и её дельта-сегменты как один индекс со сквозной нумерацией строк.
+
+    idf запроса считается по суммарной статистике всех сегментов. Веса строк сегмента посчитаны
+    с idf на момент его записи; точное соответствие полному переобучению восстанавливает слияние.
+    """
+
+    def __init__(self, root, name, version, segment_names, segments):
+        self.root = root
+        self.name = name
+        self.stamp = (version, tuple(segment_names))
+        self.segments = segments
+        self.starts = list(itertools.accumulate([0] + [len(segment) for segment in segments]))
+        self.vectorizer = segments[0].vectorizer
+
+    @classmethod
+    def load(cls, root='models', name='dialogues', dense=False):
+        version = current_version(root, name)
+        path = os.path.join(root, name, version)
+        segment_names = read_segments(path)
+        segments = [DialogueSegment.load(path, dense)]
+        segments.extend(DialogueSegment.load(os.path.join(path, 'segments', segment), dense)
+                        for segment in segment_names)
+        return cls(root, name, version, segment_names, segments)
+
+    @staticmethod
+    def read_stamp(root='models', name='dialogues'):
+        version = current_version(root, name)
+        return version, tuple(read_segments(os.path.join(root, name, version)))
+
+    @property
+    def path(self):
+        return self.segments[0].path
+
+    @property
+    def source_offset(self):
+        # Сколько байт dialogues.txt уже проиндексировано
+        for segment in reversed(self.segments):
+            if segment.manifest.get('source_offset') is not None:
+                return segment.manifest['source_offset']
+        return 0
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def document_freq(self, term):
+        freq = 0
+        for segment in self.segments:
+            idx = segment.vectorizer.term_index(term)
+            if idx is not None:
+                freq += int(segment.document_freq[idx])
+        return freq
+
+    def answer(self, row):
+        segment = bisect.bisect_right(self.starts, row) - 1
+        return self.segments[segment].answers[row - self.starts[segment]]
+
+    def iter_batches(self, batch_size):
+        """Проиндексированные пары пакетами (вопросы в леммах, ответы, позиция в файле) — для слияния."""
+        for segment in self.segments:
+            questions = StringTable.load(segment.path, 'questions')
+            for start in range(0, len(segment), batch_size):
+                end = min(start + batch_size, len(segment))
+                yield ([questions[row] for row in range(start, end)],
+                       [segment.answers[row] for row in range(start, end)], self.source_offset)
+
+    def search(self, text, k=1):
+        """Косинусная близость TF-IDF: до k пар (номер строки, косинус) по всем сегментам."""
+        n_rows = len(self)
+        weights = []
+        for term, count in Counter(self.vectorizer.analyze(text)).items():
+            term_ids = [segment.vectorizer.term_index(term) for segment in self.segments]
+            freq = sum(int(segment.document_freq[idx])
+                       for segment, idx in zip(self.segments, term_ids) if idx is not None)
+            if freq:
+                weights.append((count * (math.log((1 + n_rows) / (1 + freq)) + 1), term_ids))
+        norm = math.sqrt(sum(weight * weight for weight, _ in weights))
+        if not norm:
+            return []
+        rows, scores = [], []
+        for number, (segment, start) in enumerate(zip(self.segments, self.starts)):
+            query = sorted((term_ids[number], weight / norm) for weight, term_ids in weights
+                           if term_ids[number] is not None)
+            if not query:
+                continue
+            terms, term_weights = zip(*query)
+            candidates, candidate_scores = segment.retriever.score(np.array(terms), np.array(term_weights))
+            rows.append(candidates + start)
+            scores.append(candidate_scores)
+        if not rows:
+            return []
+        rows, scores = np.concatenate(rows), np.concatenate(scores)
+        if k == 1:
+            # Строки идут по возрастанию, argmax при равенстве берёт меньший номер
+            best = scores.argmax()
+            return [(int(rows[best]), float(scores[best]))]
+        return top_k(rows, scores, k)
+
+    def search_dense(self, vector, k=1, n_probe=8):
+        """Ближайшие по эмбеддингу: IVF для основной версии, точный перебор для небольших сегментов."""
+        rows, scores = [], []
+        for segment, start in zip(self.segments, self.starts):
+            if segment.ivf_index is not None:
+                found = segment.ivf_index.search(vector, k, n_probe)
+            else:
+                found = exact_dense_search(segment.vectors, vector, k)
+            rows.extend(row + start for row, _ in found)
+            scores.extend(score for _, score in found)
+        if not rows:
+            return []
+        return top_k(np.array(rows), np.array(scores), k)
+
+
+class LiveDialogueIndex:
+    """DialogueIndex, который подхватывает новые сегменты и версии без перезапуска бота.
+
+    Указатели CURRENT и SEGMENTS проверяет поток перезагрузки (см. start_reloader) не чаще
+    раза в interval секунд. Новый индекс загружается в этом потоке и подменяет старый одним
+    присваиванием; запросы тем временем обслуживает старый индекс, get() только возвращает текущий.
+    """
+
+    def __init__(self, root='models', name='dialogues', dense=False, interval=5.0):
+        self.root = root
+        self.name = name
+        self.dense = dense
+        self.interval = interval
+        self.index = DialogueIndex.load(root, name, dense)
+        self.checked = time.monotonic()
+
+    def get(self):
+        return self.index
+
+    def refresh_if_due(self):
+        if time.monotonic() - self.checked < self.interval:
+            return False
+        return self.refresh()
+
+    def refresh(self):
+        """Загружает новую версию, если указатели изменились; True, если индекс подменён."""
+        self.checked = time.monotonic()
+        try:
+            if DialogueIndex.read_stamp(self.root, self.name) == self.index.stamp:
+                return False
+            start = time.perf_counter()
+            self.index = DialogueIndex.load(self.root, self.name, self.dense)
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Не удалось обновить индекс dialogues, работаем со старым: {e}")
+            return False
+        version, segments = self.index.stamp
+        logger.info(f"Индекс dialogues обновлён: версия {version}, сегментов {len(segments)}, "
+                    f"{len(self.index)} пар, загрузка {(time.perf_counter() - start) * 1000:.1f} мс")
+        return True
@@ -0,0 +1,123 @@
+# ./app/logs.py
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+# text или json (по одному объекту в строке)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+# Запись в поток вывода в фоновом потоке через QueueHandler/QueueListener
+LOG_QUEUE = os.getenv('LOG_QUEUE', '1') == '1'
+# Не собирать в записи файл и строку вызова, процесс и поток (см. configure_logging)
+LOG_LEAN_RECORDS = os.getenv('LOG_LEAN_RECORDS', '0') == '1'
+# Доля сообщений пользователей, для которых пишутся построчные логи обработки (Processing, Stats, ...)
+MESSAGE_LOG_RATE = float(os.getenv('MESSAGE_LOG_RATE', '1'))
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+# Аргументы этих типов не меняются, пока запись ждёт в очереди, и форматирование можно отложить
+IMMUTABLE_ARGS = (str, int, float, bool, type(None))
+
+_message_logged = contextvars.ContextVar('message_logged', default=True)
+_random = random.Random()
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись как JSON: шаблон сообщения отдельно от аргументов, чтобы логи можно было группировать."""
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage(), 'template': str(getattr(record, 'template', record.msg))}
+        if isinstance(record.args, tuple) and record.args:
+            entry['args'] = record.args
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не форматирует запись в вызывающем потоке, если это безопасно.
+
+    Стандартный prepare() подставляет аргументы сразу. Здесь это делается только для
+    изменяемых аргументов (словари, списки): к моменту записи их содержимое могло бы измениться.
+    """
+
+    def prepare(self, record):
+        if isinstance(record.args, tuple) and all(isinstance(arg, IMMUTABLE_ARGS) for arg in record.args):
+            return record
+        record.template = record.msg
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class SampledLogger(logging.LoggerAdapter):
+    """Логгер построчных логов сообщения: вне выборки запись даже не создаётся."""
+
+    def isEnabledFor(self, level):
+        return _message_logged.get() and self.logger.isEnabledFor(level)
+
+
+def sample_message_log(rate=None):
+    """Решает один раз на сообщение пользователя, пишутся ли его построчные логи."""
+    rate = MESSAGE_LOG_RATE if rate is None else rate
+    _message_logged.set(rate >= 1 or _random.random() < rate)
+
+
+def stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def configure_logging(fmt=None, level=None, use_queue=None, stream=None, lean_records=None):
+    """Настраивает корневой логгер; повторный вызов заменяет прежние обработчики.
+
+    lean_records (LOG_LEAN_RECORDS) отключает в logging сбор файла и строки вызова, процесса
+    и потока для каждой записи. Это глобальные флаги модуля logging: %(pathname)s, %(lineno)d,
+    %(funcName)s, %(process)d и %(thread)d в форматах других обработчиков процесса перестанут
+    заполняться, поэтому включается явно и только там, где логи пишет один этот формат.
+    """
+    global _listener
+    fmt = fmt or LOG_FORMAT
+    use_queue = LOG_QUEUE if use_queue is None else use_queue
+    if LOG_LEAN_RECORDS if lean_records is None else lean_records:
+        logging._srcfile = None
+        logging.logProcesses = False
+        logging.logMultiprocessing = False
+        logging.logThreads = False
+    stop_listener()
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.setLevel(level or LOG_LEVEL)
+    if use_queue:
+        log_queue = queue.SimpleQueue()
+        root.addHandler(DeferredQueueHandler(log_queue))
+        _listener = logging.handlers.QueueListener(log_queue, handler)
+        _listener.start()
+    else:
+        root.addHandler(handler)
+    return handler
+
+
+def configure_forked_child():
+    # В процессе, созданном fork, нет потока QueueListener: пишем синхронно
+    global _listener
+    _listener = None
+    configure_logging(use_queue=False)
+
+
+# Недописанные записи из очереди сбрасываются при выходе
+atexit.register(stop_listener)
+os.register_at_fork(after_in_child=configure_forked_child)
@@ -0,0 +1,237 @@
+# ./app/metrics.py
+
+import contextvars
+import functools
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Доля сообщений, для которых пишутся интервалы этапов; счётчики считаются всегда
+SAMPLE_RATE = float(os.getenv('METRICS_SAMPLE_RATE', '0.1'))
+# Верхние границы корзин гистограмм, секунды
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Свой генератор: выборка не должна сдвигать random, которым бот выбирает ответы
+_random = random.Random()
+
+STAGE_SECONDS = 'bot_stage_seconds'
+REPLIES = 'bot_replies_total'
+MESSAGES = 'bot_messages_total'
+TTS_CACHE = 'bot_tts_cache_total'
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Верхняя граница корзины, в которую попадает квантиль q (для последней корзины — бесконечность)."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+# Гистограммы и счётчики с одной меткой; изменения приходят пачками от завершённых трассировок
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}
+        self.values = {}
+
+    def describe(self, name, kind, label, help_text):
+        self.families[name] = (kind, label, help_text)
+        self.values.setdefault(name, {})
+
+    def apply(self, pending):
+        if not pending:
+            return
+        with self.lock:
+            for name, label, value in pending:
+                values = self.values[name]
+                if self.families[name][0] == 'histogram':
+                    histogram = values.get(label)
+                    if histogram is None:
+                        histogram = values[label] = Histogram()
+                    histogram.observe(value)
+                else:
+                    values[label] = values.get(label, 0) + value
+
+    def render(self):
+        """Текст в формате Prometheus exposition 0.0.4."""
+        lines = []
+        with self.lock:
+            for name, (kind, label, help_text) in self.families.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for value_label, value in sorted(self.values[name].items()):
+                    if kind == 'counter':
+                        lines.append(f'{name}{{{label}="{value_label}"}} {value}')
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + ('+Inf',), value.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{label}="{value_label}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{{label}="{value_label}"}} {value.sum}')
+                    lines.append(f'{name}_count{{{label}="{value_label}"}} {value.count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Короткая сводка для лога: число, p50 и p95 по этапам, значения счётчиков."""
+        parts = []
+        with self.lock:
+            for name, (kind, _, _) in self.families.items():
+                for value_label, value in sorted(self.values[name].items()):
+                    if kind == 'counter':
+                        parts.append(f"{name}[{value_label}]={value}")
+                    else:
+                        parts.append(f"{value_label}: n={value.count} p50<={value.quantile(0.5) * 1000:g} мс "
+                                     f"p95<={value.quantile(0.95) * 1000:g} мс")
+        return '; '.join(parts)
+
+
+registry = Registry()
+registry.describe(STAGE_SECONDS, 'histogram', 'stage', 'Время этапов обработки сообщения (по выборке сообщений)')
+registry.describe(REPLIES, 'counter', 'type', 'Ответы бота по типу исхода (Stats)')
+registry.describe(MESSAGES, 'counter', 'handler', 'Входящие сообщения по обработчику')
+registry.describe(TTS_CACHE, 'counter', 'result', 'Голосовые ответы по источнику: file_id, memory, disk или miss')
+
+
+# Трассировка одного сообщения: решение о выборке и накопленные изменения метрик
+class Trace:
+    __slots__ = ('sampled', 'pending')
+
+    def __init__(self, sampled):
+        self.sampled = sampled
+        self.pending = []
+
+
+_current = contextvars.ContextVar('metrics_trace', default=None)
+
+
+def current_trace():
+    return _current.get()
+
+
+def reset_trace():
+    # Процесс-воркер, созданный fork во время трассировки, наследует её; каждая задача начинает свою
+    _current.set(None)
+
+
+@contextmanager
+def trace(sampled=None, record=True):
+    """Начинает трассировку сообщения; вложенная трассировка работает в рамках внешней.
+
+    Изменения попадают в registry одной пачкой при выходе. С record=False они остаются
+    в trace.pending — так процесс-воркер возвращает их основному процессу.
+    """
+    current = _current.get()
+    if current is not None:
+        yield current
+        return
+    current = Trace(_random.random() < SAMPLE_RATE if sampled is None else sampled)
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        if record:
+            registry.apply(current.pending)
+
+
+def extend(pending):
+    current = _current.get()
+    if current is not None:
+        current.pending.extend(pending)
+    else:
+        registry.apply(pending)
+
+
+def count(name, label, amount=1):
+    extend([(name, label, amount)])
+
+
+class span:
+    """Интервал этапа: with span('stage') или декоратор @span('stage'). Вне выборки ничего не пишет."""
+    __slots__ = ('stage', 'trace', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.trace = None
+
+    def __enter__(self):
+        current = _current.get()
+        if current is not None and current.sampled:
+            self.trace = current
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.trace is not None:
+            self.trace.pending.append((STAGE_SECONDS, self.stage, time.perf_counter() - self.start))
+            self.trace = None
+
+    def __call__(self, func):
+        stage = self.stage
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port, host='127.0.0.1'):
+    """HTTP-эндпоинт /metrics для Prometheus в фоновом потоке; port <= 0 — выключен."""
+    if port <= 0:
+        return None
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+
+def start_dump(interval, log):
+    """Периодически передаёт сводку метрик в log; interval <= 0 — выключено."""
+    if interval <= 0:
+        return None
+
+    def run():
+        while True:
+            time.sleep(interval)
+            log(f"Метрики: {registry.summary()}")
+
+    thread = threading.Thread(target=run, name='metrics-dump', daemon=True)
+    thread.start()
+    return thread
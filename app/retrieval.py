@@ -0,0 +1,165 @@
+# ./app/retrieval.py
+
+import os
+import numpy as np
+from scipy import sparse
+from artifacts import load_array
+
+
+# Нормировка строк разреженной матрицы по L2 (без импорта sklearn на старте бота)
+def normalize_rows(matrix):
+    matrix = sparse.csr_matrix(matrix, dtype=np.float64)
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.csr_matrix(sparse.diags(1 / norms) @ matrix)
+
+
+# Поиск ответа в dialogues.txt по инвертированному индексу TF-IDF
+class DialogueRetriever:
+    def __init__(self, indptr, indices, data, n_rows):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.n_rows = n_rows
+
+    @classmethod
+    def from_matrix(cls, tfidf_matrix):
+        # Строки нормализуются заранее, поэтому косинус — это просто скалярное произведение.
+        # CSC-матрица — это и есть инвертированный индекс: столбец терма хранит его постинги
+        postings = sparse.csc_matrix(normalize_rows(tfidf_matrix))
+        postings.sort_indices()
+        return cls(postings.indptr, postings.indices, postings.data, postings.shape[0])
+
+    def save(self, path):
+        np.save(os.path.join(path, 'postings_indptr.npy'), self.indptr)
+        np.save(os.path.join(path, 'postings_indices.npy'), self.indices)
+        np.save(os.path.join(path, 'postings_data.npy'), self.data)
+        return {'n_rows': int(self.n_rows), 'nnz': int(len(self.data))}
+
+    @classmethod
+    def load(cls, path, params):
+        return cls(load_array(path, 'postings_indptr'), load_array(path, 'postings_indices'),
+                   load_array(path, 'postings_data'), params['n_rows'])
+
+    def search(self, query_vector, k=1):
+        """Возвращает до k пар (номер строки, косинус) по убыванию близости.
+
+        Оцениваются только строки, у которых есть общие термы с запросом.
+        """
+        query = normalize_rows(query_vector)
+        candidates, scores = self.score(query.indices, query.data)
+        if not len(candidates):
+            return []
+        if k == 1:
+            # argmax берёт первую из равных, то есть строку с меньшим номером, как и полный перебор
+            best = scores.argmax()
+            return [(int(candidates[best]), float(scores[best]))]
+        return top_k(candidates, scores, k)
+
+    def score(self, terms, weights):
+        """Скалярные произведения строк с запросом (номера термов и их веса): кандидаты и их оценки."""
+        terms = np.asarray(terms, dtype=np.int64)
+        if not len(terms):
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        starts, ends = self.indptr[terms], self.indptr[terms + 1]
+        lengths = ends - starts
+        if not lengths.sum():
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        # Склеиваем постинги всех термов запроса и суммируем вклад по строкам
+        positions = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+        rows = self.indices[positions]
+        contributions = self.data[positions] * np.repeat(weights, lengths)
+        candidates, inverse = np.unique(rows, return_inverse=True)
+        return candidates, np.bincount(inverse, weights=contributions)
+
+
+# Усреднённый эмбеддинг фразы по леммам (navec из Natasha), нормированный по L2
+def sentence_vector(words, embedding):
+    vectors = [embedding[word] for word in words if word in embedding]
+    if not vectors:
+        return np.zeros(embedding.pq.dim, dtype=np.float32)
+    vector = np.mean(vectors, axis=0).astype(np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def top_k(rows, scores, k):
+    """Выбирает k лучших строк; при равенстве выигрывает строка с меньшим номером."""
+    if k < len(scores):
+        part = np.argpartition(-scores, k - 1)[:k]
+        rows, scores = rows[part], scores[part]
+    order = np.lexsort((rows, -scores))[:k]
+    return [(int(rows[idx]), float(scores[idx])) for idx in order]
+
+
+# Точный поиск по плотным векторам: эталон для оценки recall
+def exact_dense_search(vectors, query, k=1):
+    scores = np.asarray(vectors, dtype=np.float32) @ query
+    return top_k(np.arange(len(scores)), scores, k)
+
+
+# Приближённый поиск ближайших соседей: IVF (инвертированные списки по кластерам k-means)
+class IVFIndex:
+    def __init__(self, vectors, centroids, order, offsets):
+        self.vectors = vectors
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, vectors, n_lists=None, iterations=10, sample_size=50000, seed=0):
+        """Сферический k-means на выборке, затем распределение всех векторов по спискам."""
+        rng = np.random.default_rng(seed)
+        n_rows = len(vectors)
+        n_lists = n_lists or max(1, int(np.sqrt(n_rows)))
+        n_lists = min(n_lists, n_rows)
+        sample_idx = np.sort(rng.choice(n_rows, size=min(sample_size, n_rows), replace=False))
+        sample = np.asarray(vectors[sample_idx], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = (sample @ centroids.T).argmax(axis=1)
+            for list_id in range(n_lists):
+                members = sample[assignment == list_id]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    norm = np.linalg.norm(centroid)
+                    centroids[list_id] = centroid / norm if norm else centroid
+        assignment = cls.assign(vectors, centroids)
+        order = np.argsort(assignment, kind='stable').astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))]).astype(np.int64)
+        return cls(vectors, centroids, order, offsets)
+
+    @staticmethod
+    def assign(vectors, centroids, batch_size=65536):
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), batch_size):
+            batch = np.asarray(vectors[start:start + batch_size], dtype=np.float32)
+            assignment[start:start + batch_size] = (batch @ centroids.T).argmax(axis=1)
+        return assignment
+
+    def search(self, query, k=1, n_probe=8):
+        """n_probe — сколько ближайших кластеров просматривать: больше — выше recall, но медленнее."""
+        n_probe = min(n_probe, len(self.centroids))
+        centroid_scores = self.centroids @ query
+        probe = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        rows = np.concatenate([self.order[self.offsets[list_id]:self.offsets[list_id + 1]] for list_id in probe])
+        if not len(rows):
+            return []
+        # Отсортированные номера строк — последовательное чтение из memmap
+        rows.sort()
+        scores = np.asarray(self.vectors[rows], dtype=np.float32) @ query
+        return top_k(rows, scores, k)
+
+    def save(self, path, with_vectors=True):
+        """with_vectors=False — embeddings.npy уже записан (например, потоково через memmap)."""
+        if with_vectors:
+            np.save(os.path.join(path, 'embeddings.npy'), self.vectors)
+        np.save(os.path.join(path, 'ivf_centroids.npy'), self.centroids)
+        np.save(os.path.join(path, 'ivf_order.npy'), self.order)
+        np.save(os.path.join(path, 'ivf_offsets.npy'), self.offsets)
+        return {'n_vectors': len(self.vectors), 'dtype': str(self.vectors.dtype), 'n_lists': len(self.centroids)}
+
+    @classmethod
+    def load(cls, path):
+        return cls(load_array(path, 'embeddings'), load_array(path, 'ivf_centroids', mmap=False),
+                   load_array(path, 'ivf_order'), load_array(path, 'ivf_offsets', mmap=False))
@@ -0,0 +1,86 @@
+# ./app/score_intents.py
+
+import argparse
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from bot import classify_intents, init_worker
+from utils import logger
+
+
+# Файл реплик: по одной в строке, через табуляцию можно указать ожидаемое намерение
+def iter_batches(path, batch_size):
+    batch = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            replica, _, expected = line.rstrip('\n').partition('\t')
+            batch.append((replica, expected or None))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def classify_batch(batch):
+    return batch, classify_intents([replica for replica, _ in batch])
+
+
+def iter_classified(path, batch_size, workers):
+    batches = iter_batches(path, batch_size)
+    if workers <= 1:
+        yield from map(classify_batch, batches)
+        return
+    with ProcessPoolExecutor(workers, initializer=init_worker) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append(executor.submit(classify_batch, batch))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def score_file(path, output, batch_size=4096, workers=1):
+    total = labeled = checked = correct = 0
+    start = time.perf_counter()
+    for batch, labels in iter_classified(path, batch_size, workers):
+        for (replica, expected), label in zip(batch, labels):
+            output.write(f"{replica}\t{label or ''}\n")
+            labeled += label is not None
+            if expected is not None:
+                checked += 1
+                correct += label == expected
+        total += len(batch)
+        elapsed = time.perf_counter() - start
+        logger.info(f"Классифицировано {total} реплик за {elapsed:.1f} с ({total / elapsed:.0f} реплик/с)")
+    elapsed = time.perf_counter() - start
+    return {'replicas': total, 'labeled': labeled, 'seconds': round(elapsed, 2),
+            'per_sec': round(total / elapsed, 1) if elapsed else None,
+            'accuracy': round(correct / checked, 4) if checked else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Пакетная классификация намерений для файла реплик')
+    parser.add_argument('input', help='реплики по одной в строке; «реплика<TAB>намерение» для оценки точности')
+    parser.add_argument('--output', help='куда записать «реплика<TAB>намерение» (по умолчанию stdout)')
+    parser.add_argument('--batch-size', type=int, default=4096)
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        result = score_file(args.input, output, args.batch_size, args.workers)
+    finally:
+        if args.output:
+            output.close()
+    summary = (f"{result['replicas']} реплик за {result['seconds']} с ({result['per_sec']} реплик/с), "
+               f"с намерением: {result['labeled']}")
+    if result['accuracy'] is not None:
+        summary += f", точность: {result['accuracy']}"
+    print(summary, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
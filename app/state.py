@@ -0,0 +1,293 @@
+# ./app/state.py
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from utils import logger
+
+HISTORY_SIZE = 5
+STAT_TYPES = ('intent', 'generate', 'failure')
+# Разделитель реплик истории в базе (в тексте сообщений заменяется пробелом)
+HISTORY_SEPARATOR = '\x1f'
+
+
+# Состояние диалога пользователя: поля в __slots__ вместо словаря user_data.
+# Поддерживает user_data[key], get, in, copy и update, поэтому bot() работает с ним как со словарём
+class UserState:
+    __slots__ = ('state', 'current_dish', 'last_intent', 'last_bot_response', 'history', 'counters', 'extra',
+                 'touched')
+    FIELDS = ('state', 'current_dish', 'last_intent', 'last_bot_response', 'history', 'stats')
+
+    def __init__(self, state='NONE', current_dish=None, last_intent=None, last_bot_response=None, history=(),
+                 counters=(0, 0, 0), extra=None, touched=0):
+        self.state = state
+        self.current_dish = current_dish
+        self.last_intent = last_intent
+        self.last_bot_response = last_bot_response
+        # Кольцевой буфер последних HISTORY_SIZE реплик
+        self.history = tuple(history)[-HISTORY_SIZE:]
+        self.counters = counters
+        # Редкие ключи и типы статистики вне STAT_TYPES; None, пока не понадобились
+        self.extra = extra
+        self.touched = touched
+
+    def __getitem__(self, key):
+        if key == 'history':
+            return list(self.history)
+        if key == 'stats':
+            stats = dict(zip(STAT_TYPES, self.counters))
+            if self.extra and 'stats' in self.extra:
+                stats.update(self.extra['stats'])
+            return stats
+        if key in UserState.FIELDS:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'history':
+            self.history = tuple(value)[-HISTORY_SIZE:]
+        elif key == 'stats':
+            self.counters = tuple(value.get(stat_type, 0) for stat_type in STAT_TYPES)
+            other = {stat_type: count for stat_type, count in value.items() if stat_type not in STAT_TYPES}
+            if other or (self.extra and 'stats' in self.extra):
+                self.set_extra('stats', other)
+        elif key in UserState.FIELDS:
+            setattr(self, key, value)
+        else:
+            self.set_extra(key, value)
+
+    def set_extra(self, key, value):
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __contains__(self, key):
+        return key in UserState.FIELDS or bool(self.extra and key in self.extra)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def copy(self):
+        return UserState(self.state, self.current_dish, self.last_intent, self.last_bot_response, self.history,
+                         self.counters, dict(self.extra) if self.extra else None, self.touched)
+
+    def update(self, other):
+        if isinstance(other, UserState):
+            for slot in UserState.__slots__:
+                setattr(self, slot, getattr(other, slot))
+            return
+        for key, value in other.items():
+            self[key] = value
+
+
+# Хранилище в памяти: прежнее поведение, но простаивающие дольше idle_ttl секунд пользователи вытесняются
+class MemoryStateStore:
+    def __init__(self, idle_ttl=24 * 3600, flush_interval=1.0):
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        self.states = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __len__(self):
+        return len(self.states)
+
+    def get(self, user_id):
+        with self.lock:
+            state = self.states.get(user_id)
+        if state is None:
+            state = self.load(user_id) or UserState()
+            with self.lock:
+                state = self.states.setdefault(user_id, state)
+        state.touched = int(time.time())
+        return state
+
+    def put(self, user_id, state):
+        state.touched = int(time.time())
+        with self.lock:
+            self.states[user_id] = state
+            self.dirty.add(user_id)
+
+    def load(self, user_id):
+        return None
+
+    def flush(self):
+        with self.lock:
+            self.dirty.clear()
+        return 0
+
+    def evict(self, now=None):
+        """Сбрасывает изменения и выгружает из памяти пользователей, простаивающих дольше idle_ttl."""
+        self.flush()
+        deadline = (now or time.time()) - self.idle_ttl
+        with self.lock:
+            idle = [user_id for user_id, state in self.states.items()
+                    if state.touched < deadline and user_id not in self.dirty]
+            for user_id in idle:
+                del self.states[user_id]
+        if idle:
+            logger.info(f"Вытеснено состояний простаивающих пользователей: {len(idle)}, в памяти: {len(self.states)}")
+        return len(idle)
+
+    def start(self, evict_interval=60.0):
+        """Фоновый поток: сброс изменений раз в flush_interval, вытеснение раз в evict_interval секунд."""
+        def run():
+            last_evict = time.monotonic()
+            while not self.stopped.is_set():
+                self.wakeup.wait(self.flush_interval)
+                self.wakeup.clear()
+                try:
+                    self.flush()
+                    if time.monotonic() - last_evict >= evict_interval:
+                        last_evict = time.monotonic()
+                        self.evict()
+                except Exception as e:
+                    logger.error(f"Ошибка записи состояний пользователей: {e}")
+
+        self.thread = threading.Thread(target=run, name='state-store', daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def close(self):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+
+# Интернированные строки (состояния, блюда, намерения): в базе хранятся их номера
+class Symbols:
+    def __init__(self, rows):
+        self.ids = {}
+        self.names = {}
+        for symbol_id, name in rows:
+            name = sys.intern(name)
+            self.ids[name] = symbol_id
+            self.names[symbol_id] = name
+        self.next_id = max(self.names, default=0) + 1
+        self.new = []
+
+    def id(self, name):
+        if name is None:
+            return None
+        symbol_id = self.ids.get(name)
+        if symbol_id is None:
+            symbol_id = self.next_id
+            self.next_id += 1
+            name = sys.intern(name)
+            self.ids[name] = symbol_id
+            self.names[symbol_id] = name
+            self.new.append((symbol_id, name))
+        return symbol_id
+
+    def name(self, symbol_id):
+        return self.names.get(symbol_id) if symbol_id is not None else None
+
+
+class SQLiteStateStore(MemoryStateStore):
+    """Состояния в SQLite: чтение при первом обращении, запись пакетами (write-behind).
+
+    Изменённые состояния копятся в памяти и сбрасываются одной транзакцией раз в flush_interval
+    секунд или по flush_size изменений. Записи, к которым не обращались дольше retention секунд,
+    удаляются из базы при вытеснении.
+    """
+
+    def __init__(self, path, idle_ttl=24 * 3600, retention=90 * 24 * 3600, flush_interval=1.0, flush_size=1000):
+        super().__init__(idle_ttl, flush_interval)
+        self.path = path
+        self.retention = retention
+        self.flush_size = flush_size
+        self.db_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS symbols (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS user_state (user_id INTEGER PRIMARY KEY, state INTEGER, '
+                        'dish INTEGER, intent INTEGER, response TEXT, history TEXT, intent_count INTEGER, '
+                        'generate_count INTEGER, failure_count INTEGER, extra TEXT, touched INTEGER)')
+        self.symbols = Symbols(self.db.execute('SELECT id, name FROM symbols'))
+
+    def put(self, user_id, state):
+        super().put(user_id, state)
+        if len(self.dirty) >= self.flush_size:
+            self.wakeup.set()
+
+    def load(self, user_id):
+        with self.db_lock:
+            row = self.db.execute('SELECT state, dish, intent, response, history, intent_count, generate_count, '
+                                  'failure_count, extra, touched FROM user_state WHERE user_id = ?',
+                                  (user_id,)).fetchone()
+        if row is None:
+            return None
+        state, dish, intent, response, history, intent_count, generate_count, failure_count, extra, touched = row
+        return UserState(self.symbols.name(state), self.symbols.name(dish), self.symbols.name(intent), response,
+                         history.split(HISTORY_SEPARATOR) if history else (),
+                         (intent_count, generate_count, failure_count), json.loads(extra) if extra else None, touched)
+
+    def pack(self, user_id, state):
+        history = HISTORY_SEPARATOR.join(replica.replace(HISTORY_SEPARATOR, ' ') for replica in state.history)
+        return (user_id, self.symbols.id(state.state), self.symbols.id(state.current_dish),
+                self.symbols.id(state.last_intent), state.last_bot_response, history, *state.counters,
+                json.dumps(state.extra, ensure_ascii=False) if state.extra else None, state.touched)
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return 0
+            rows = [self.pack(user_id, self.states[user_id]) for user_id in self.dirty]
+            self.dirty.clear()
+            new_symbols, self.symbols.new = self.symbols.new, []
+        with self.db_lock:
+            self.db.execute('BEGIN')
+            try:
+                self.db.executemany('INSERT INTO symbols (id, name) VALUES (?, ?)', new_symbols)
+                self.db.executemany('INSERT OR REPLACE INTO user_state VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                # Не записанное вернётся в следующий сброс
+                with self.lock:
+                    self.symbols.new = new_symbols + self.symbols.new
+                    self.dirty.update(row[0] for row in rows)
+                raise
+        return len(rows)
+
+    def evict(self, now=None):
+        now = now or time.time()
+        evicted = super().evict(now)
+        with self.db_lock:
+            deleted = self.db.execute('DELETE FROM user_state WHERE touched < ?', (int(now - self.retention),)).rowcount
+        if deleted:
+            logger.info(f"Удалено устаревших состояний из базы: {deleted}")
+        return evicted
+
+    def close(self):
+        super().close()
+        with self.db_lock:
+            self.db.close()
+
+
+def open_state_store():
+    backend = os.getenv('STATE_BACKEND', 'sqlite')
+    idle_ttl = float(os.getenv('STATE_IDLE_TTL', str(24 * 3600)))
+    if backend == 'memory':
+        return MemoryStateStore(idle_ttl)
+    if backend == 'sqlite':
+        return SQLiteStateStore(os.getenv('STATE_DB', 'state/user_state.sqlite3'), idle_ttl,
+                                retention=float(os.getenv('STATE_RETENTION', str(90 * 24 * 3600))))
+    raise ValueError(f"Неизвестное хранилище состояний: {backend}")
@@ -0,0 +1,142 @@
+# ./app/stt.py
+
+import asyncio
+import contextvars
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import span
+
+# Распознавание речи: google (сетевое API), vosk (локальная модель на CPU) или stub (без сети и модели)
+STT_BACKEND = os.getenv('STT_BACKEND', 'google')
+STT_WORKERS = int(os.getenv('STT_WORKERS', '2'))
+# Сколько голосовых сообщений распознаётся одновременно; остальные ждут, не занимая потоки
+STT_CONCURRENCY = int(os.getenv('STT_CONCURRENCY', str(STT_WORKERS)))
+STT_TIMEOUT = float(os.getenv('STT_TIMEOUT', '15'))
+VOSK_MODEL_PATH = os.getenv('VOSK_MODEL_PATH', 'models/vosk')
+STT_STUB_TEXT = os.getenv('STT_STUB_TEXT', 'сколько стоит цезарь')
+# Время распознавания заглушки на секунду аудио
+STT_STUB_RTF = float(os.getenv('STT_STUB_RTF', '0'))
+SAMPLE_RATE = 16000
+
+
+# 16-битный моно PCM
+class PCMAudio:
+    __slots__ = ('pcm', 'sample_rate', 'sample_width')
+
+    def __init__(self, pcm, sample_rate=SAMPLE_RATE, sample_width=2):
+        self.pcm = pcm
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+
+    @property
+    def seconds(self):
+        return len(self.pcm) / (self.sample_rate * self.sample_width)
+
+
+def decode_ogg(data):
+    """OGG/Opus из Telegram в 16 кГц моно PCM; ffmpeg читает и пишет через пайпы.
+
+    Кодек указан явно, чтобы pydub не запускал ffprobe; каналы и частоту приводит pydub.
+    """
+    from pydub import AudioSegment
+    segment = AudioSegment.from_file(io.BytesIO(data), format='ogg', codec='opus')
+    segment = segment.set_channels(1).set_frame_rate(SAMPLE_RATE).set_sample_width(2)
+    return PCMAudio(segment.raw_data, segment.frame_rate, segment.sample_width)
+
+
+class GoogleBackend:
+    name = 'google'
+
+    def __init__(self, language='ru-RU'):
+        import speech_recognition
+        self.sr = speech_recognition
+        self.language = language
+
+    def transcribe(self, audio):
+        recognizer = self.sr.Recognizer()
+        try:
+            return recognizer.recognize_google(self.sr.AudioData(audio.pcm, audio.sample_rate, audio.sample_width),
+                                               language=self.language)
+        except self.sr.UnknownValueError:
+            return None
+
+
+class VoskBackend:
+    name = 'vosk'
+
+    def __init__(self, model_path=VOSK_MODEL_PATH):
+        # vosk — необязательная зависимость, нужна только для STT_BACKEND=vosk
+        from vosk import KaldiRecognizer, Model, SetLogLevel
+        SetLogLevel(-1)
+        self.model = Model(model_path)
+        self.recognizer_class = KaldiRecognizer
+
+    def transcribe(self, audio):
+        recognizer = self.recognizer_class(self.model, audio.sample_rate)
+        recognizer.AcceptWaveform(audio.pcm)
+        return json.loads(recognizer.FinalResult()).get('text') or None
+
+
+class StubBackend:
+    """Детерминированная замена распознавания: всегда text, время — real_time_factor на секунду аудио."""
+    name = 'stub'
+
+    def __init__(self, text=STT_STUB_TEXT, real_time_factor=STT_STUB_RTF):
+        self.text = text
+        self.real_time_factor = real_time_factor
+
+    def transcribe(self, audio):
+        if self.real_time_factor:
+            time.sleep(audio.seconds * self.real_time_factor)
+        return self.text if audio.pcm else None
+
+
+BACKENDS = {'google': GoogleBackend, 'vosk': VoskBackend, 'stub': StubBackend}
+
+
+def create_backend(name=STT_BACKEND):
+    if name not in BACKENDS:
+        raise ValueError(f"Неизвестный движок распознавания речи: {name}")
+    return BACKENDS[name]()
+
+
+class SpeechRecognizer:
+    """Распознавание в своём пуле потоков: голосовые сообщения не занимают воркеры текстовых.
+
+    Одновременно распознаётся не больше concurrency сообщений, остальные ждут места без потока.
+    Дольше timeout секунд ответа не ждут; место освобождается, только когда поток действительно
+    закончил, поэтому брошенные распознавания не копятся в очереди пула.
+    """
+
+    def __init__(self, backend, workers=STT_WORKERS, concurrency=STT_CONCURRENCY, timeout=STT_TIMEOUT):
+        self.backend = backend
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stt')
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    def transcribe_sync(self, data):
+        with span('decode'):
+            audio = data if isinstance(data, PCMAudio) else decode_ogg(data)
+        with span('stt'):
+            return self.backend.transcribe(audio)
+
+    async def transcribe(self, data):
+        """Текст голосового сообщения (OGG-байты или PCMAudio); None, если речь не распознана."""
+        await self.semaphore.acquire()
+        # Поток пула продолжает трассировку сообщения
+        future = asyncio.get_running_loop().run_in_executor(self.executor, contextvars.copy_context().run,
+                                                            self.transcribe_sync, data)
+        future.add_done_callback(self.release)
+        return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+
+    def release(self, future):
+        self.semaphore.release()
+        # Ошибку брошенного по таймауту распознавания никто не заберёт: забираем, чтобы asyncio о ней не предупреждал
+        if not future.cancelled():
+            future.exception()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,36 +1,193 @@
 # ./app/train_dialogues_model.py
 
-import pickle
-from sklearn.feature_extraction.text import TfidfVectorizer
-from utils import clear_phrase, lemmatize_phrase, logger
-
-logger.info("Начинается обучение модели для dialogues.txt")
-
-# Загрузка dialogues.txt
-dialogues = []
-try:
-    with open('app/data/dialogues.txt', encoding='utf-8') as f:
-        content = f.read()
-    dialogues = [d.split('\n')[:2] for d in content.split('\n\n') if len(d.split('\n')) >= 2]
-    dialogues = [(q[1:].strip() if q.startswith('-') else q, a[1:].strip() if a.startswith('-') else a) for q, a in dialogues]
-except Exception as e:
-    logger.error(f"Ошибка чтения dialogues.txt: {e}")
-    exit(1)
-
-# Подготовка данных
-questions = [lemmatize_phrase(q) for q, _ in dialogues]  # Лемматизируем вопросы
-answers = [a for _, a in dialogues]
-
-# Обучение TF-IDF модели
-tfidf_vectorizer = TfidfVectorizer(analyzer='word', ngram_range=(1, 2), lowercase=True)
-tfidf_matrix = tfidf_vectorizer.fit_transform(questions)
-
-# Сохранение модели
-with open('models/dialogues_vectorizer.pkl', 'wb') as f:
-    pickle.dump(tfidf_vectorizer, f)
-with open('models/dialogues_matrix.pkl', 'wb') as f:
-    pickle.dump(tfidf_matrix, f)
-with open('models/dialogues_answers.pkl', 'wb') as f:
-    pickle.dump(answers, f)
-
-logger.info("Модель для dialogues.txt обучена и сохранена в ./models/")
+import math
+import os
+import time
+from array import array
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import sparse
+from artifacts import StringTable, StringTableWriter, TfidfModel, new_version_dir, publish
+from retrieval import DialogueRetriever, IVFIndex, sentence_vector
+from utils import lemmatize_batch, logger, get_embedding
+
+DIALOGUES_PATH = 'app/data/dialogues.txt'
+TRAIN_BATCH_SIZE = int(os.getenv('TRAIN_BATCH_SIZE', '512'))
+TRAIN_WORKERS = int(os.getenv('TRAIN_WORKERS', str(os.cpu_count() or 1)))
+PROGRESS_EVERY = 10000
+
+
+# Потоковый разбор dialogues.txt: пары «вопрос — ответ» разделены пустой строкой, файл целиком не читается.
+# Вместе с парой отдаётся позиция в байтах сразу после неё — с неё продолжает дообучение
+def iter_dialogues(path, start=0):
+    block = []
+    with open(path, 'rb') as f:
+        f.seek(start)
+        position = start
+        for raw_line in f:
+            position += len(raw_line)
+            line = raw_line.decode('utf-8').rstrip('\r\n')
+            if line:
+                block.append(line)
+                continue
+            if len(block) >= 2:
+                yield strip_dash(block[0]), strip_dash(block[1]), position
+            block = []
+    if len(block) >= 2:
+        yield strip_dash(block[0]), strip_dash(block[1]), position
+
+
+def strip_dash(line):
+    return line[1:].strip() if line.startswith('-') else line
+
+
+def iter_batches(pairs, batch_size):
+    batch = []
+    for pair in pairs:
+        batch.append(pair)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def lemmatize_pairs(batch):
+    return lemmatize_batch([question for question, _, _ in batch]), [answer for _, answer, _ in batch], batch[-1][2]
+
+
+def iter_lemmatized(path, batch_size, workers, start=0):
+    """Пакеты (вопросы в леммах, ответы, позиция в файле); при workers > 1 — в пуле процессов с сохранением порядка."""
+    batches = iter_batches(iter_dialogues(path, start), batch_size)
+    if workers <= 1:
+        yield from map(lemmatize_pairs, batches)
+        return
+    with ProcessPoolExecutor(workers) as executor:
+        # В работе держим ограниченное число пакетов, чтобы память не росла с размером файла
+        pending = deque()
+        for batch in batches:
+            pending.append(executor.submit(lemmatize_pairs, batch))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class Progress:
+    def __init__(self, stage):
+        self.stage = stage
+        self.count = 0
+        self.reported = 0
+        self.start = time.perf_counter()
+
+    def add(self, count):
+        self.count += count
+        if self.count - self.reported >= PROGRESS_EVERY:
+            self.reported = self.count
+            self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        logger.info(f"{self.stage}: {self.count} пар за {elapsed:.1f} с ({self.count / max(elapsed, 1e-9):.0f} пар/с)")
+
+
+def build(path, batches, stats=None, with_ivf=True):
+    """Строит в path индекс по пакетам из iter_lemmatized и возвращает его манифест.
+
+    stats — уже проиндексированные пары (DialogueIndex): для дельта-сегмента idf считается
+    по общей статистике, а не только по новым парам.
+    """
+    vectorizer = TfidfModel([], None)
+
+    # Проход 1: частоты документов для словаря; вопросы в леммах и ответы сразу пишутся в модель
+    document_freq = Counter()
+    questions = StringTableWriter(path, 'questions')
+    answers = StringTableWriter(path, 'answers')
+    source_offset = None
+    progress = Progress("Проход 1 (словарь)")
+    for batch_questions, batch_answers, source_offset in batches:
+        for question, answer in zip(batch_questions, batch_answers):
+            questions.append(question)
+            answers.append(answer)
+            document_freq.update(set(vectorizer.analyze(question)))
+        progress.add(len(batch_questions))
+    progress.report()
+    questions.close()
+    answers.close()
+    n_rows = len(answers)
+
+    # Словарь и idf как у TfidfVectorizer(smooth_idf=True): термы по алфавиту
+    vectorizer.terms = sorted(document_freq)
+    total_rows = n_rows + (len(stats) if stats is not None else 0)
+    total_freq = [document_freq[term] + (stats.document_freq(term) if stats is not None else 0)
+                  for term in vectorizer.terms]
+    vectorizer.idf = np.array([math.log((1 + total_rows) / (1 + freq)) + 1 for freq in total_freq], dtype=np.float64)
+    np.save(os.path.join(path, 'vectorizer_df.npy'),
+            np.array([document_freq[term] for term in vectorizer.terms], dtype=np.int64))
+    term_ids = {term: idx for idx, term in enumerate(vectorizer.terms)}
+    del document_freq
+
+    # Проход 2: строки TF-IDF и эмбеддинги вопросов, эмбеддинги пишутся прямо в memmap
+    embeddings_dtype = os.getenv('EMBEDDINGS_DTYPE', 'float16')
+    emb = get_embedding()
+    embeddings = None
+    if n_rows:
+        embeddings = np.lib.format.open_memmap(os.path.join(path, 'embeddings.npy'), mode='w+',
+                                               dtype=embeddings_dtype, shape=(n_rows, int(emb.pq.dim)))
+    indptr, indices, data = array('q', [0]), array('i'), array('d')
+    progress = Progress("Проход 2 (векторы)")
+    for row, question in enumerate(StringTable.load(path, 'questions')):
+        counts = Counter(term_ids[term] for term in vectorizer.analyze(question))
+        for column in sorted(counts):
+            indices.append(column)
+            data.append(counts[column] * vectorizer.idf[column])
+        indptr.append(len(indices))
+        embeddings[row] = sentence_vector(question.split(), emb)
+        progress.add(1)
+    progress.report()
+
+    # Нормировку строк делает DialogueRetriever.from_matrix
+    tfidf_matrix = sparse.csr_matrix((np.frombuffer(data, dtype=np.float64), np.frombuffer(indices, dtype=np.int32),
+                                      np.frombuffer(indptr, dtype=np.int64)), shape=(n_rows, len(vectorizer.terms)))
+    manifest = {
+        'vectorizer': vectorizer.save(path, 'vectorizer'),
+        'postings': DialogueRetriever.from_matrix(tfidf_matrix).save(path),
+        'n_answers': n_rows,
+        'source_offset': source_offset
+    }
+    del tfidf_matrix
+
+    # Плотные векторы для режима DIALOGUE_RETRIEVAL=dense; IVF-индекс строится только для основной версии
+    if n_rows:
+        embeddings.flush()
+        manifest['dense'] = {'n_vectors': n_rows, 'dtype': embeddings_dtype}
+        if with_ivf:
+            ivf_index = IVFIndex.build(embeddings)
+            manifest['dense'] = ivf_index.save(path, with_vectors=False)
+            logger.info(f"IVF-индекс: {n_rows} векторов ({embeddings_dtype}), {len(ivf_index.centroids)} кластеров")
+            del ivf_index
+        del embeddings
+    return manifest
+
+
+def train(dialogues_path=DIALOGUES_PATH, root='models', batch_size=TRAIN_BATCH_SIZE, workers=TRAIN_WORKERS):
+    path = new_version_dir(root, 'dialogues')
+    manifest = build(path, iter_lemmatized(dialogues_path, batch_size, workers))
+    if manifest['source_offset'] is None:
+        manifest['source_offset'] = 0
+    publish(path, manifest)
+    return path, manifest['n_answers']
+
+
+if __name__ == '__main__':
+    logger.info("Начинается обучение модели для dialogues.txt")
+    start = time.perf_counter()
+    try:
+        path, n_rows = train()
+    except OSError as e:
+        logger.error(f"Ошибка чтения dialogues.txt: {e}")
+        exit(1)
+    elapsed = time.perf_counter() - start
+    logger.info(f"Модель для dialogues.txt обучена и сохранена в {path}: {n_rows} пар за {elapsed:.1f} с "
+                f"({n_rows / max(elapsed, 1e-9):.0f} пар/с)")
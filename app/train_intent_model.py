@@ -1,11 +1,10 @@
 # ./app/train_intent_model.py
 
-import pickle
-import os
 from sklearn.svm import LinearSVC
 from sklearn.feature_extraction.text import TfidfVectorizer
+from artifacts import TfidfModel, LinearModel, TonalLexicon, new_version_dir, publish
 from data import config
-from utils import lemmatize_phrase, logger
+from utils import lemmatize_batch, lemmatize_phrase, logger, read_tonal_pairs
 
 
 logger.info("Начинается обучение модели для intents")
@@ -27,13 +26,19 @@ X = vectorizer.fit_transform(X_text)
 clf = LinearSVC()
 clf.fit(X, y)
 
-# Создание директории
-os.makedirs('models', exist_ok=True)
-
-# Сохранение
-with open('models/intent_model.pkl', 'wb') as f:
-    pickle.dump(clf, f)
-with open('models/intent_vectorizer.pkl', 'wb') as f:
-    pickle.dump(vectorizer, f)
-
-logger.info("Модель для intents обучена и сохранена в ./models/")
+# Тональный словарь по леммам: слова data/tonal.txt приводятся к той же форме, что и реплики
+tonal_pairs = read_tonal_pairs()
+tonal = TonalLexicon.from_pairs(zip(lemmatize_batch([word for word, _ in tonal_pairs]),
+                                    (score for _, score in tonal_pairs)))
+
+# Сохранение в новую версию models/intent/
+path = new_version_dir('models', 'intent')
+manifest = {
+    'vectorizer': TfidfModel.from_vectorizer(vectorizer).save(path, 'vectorizer'),
+    'classifier': LinearModel.from_estimator(clf).save(path, 'classifier'),
+    'tonal': tonal.save(path, 'tonal'),
+    'n_examples': len(X_text)
+}
+publish(path, manifest)
+
+logger.info(f"Модель для intents обучена и сохранена в {path}")
@@ -0,0 +1,70 @@
+# ./app/transitions.py
+
+from metrics import span
+
+# Признак, который истинен всегда: последнее правило состояния
+ALWAYS = 'always'
+_MISSING = object()
+
+
+class Turn:
+    """Одно сообщение пользователя: признаки извлекаются при первом обращении turn[name] и запоминаются."""
+    __slots__ = ('replica', 'analysis', 'context', 'signals', 'values')
+
+    def __init__(self, replica, analysis, context, signals):
+        self.replica = replica
+        self.analysis = analysis
+        self.context = context
+        self.signals = signals
+        self.values = {ALWAYS: True}
+
+    def __getitem__(self, name):
+        value = self.values.get(name, _MISSING)
+        if value is not _MISSING:
+            return value
+        stage, extract = self.signals[name]
+        if stage is None:
+            value = extract(self)
+        else:
+            with span(stage):
+                value = extract(self)
+        self.values[name] = value
+        return value
+
+
+class Transitions:
+    """Таблица переходов «состояние × признак → обработчик», проверенная и собранная один раз.
+
+    signals: имя признака -> (этап метрик или None, функция от Turn). Правила состояния — пары
+    (признак, обработчик), проверяются по порядку: обработчик вызывается, если признак истинен,
+    и возвращает (тип статистики, ответ) или None, тогда проверяется следующее правило. Признак
+    извлекается, только когда до его правила дошла очередь. Правила common проверяются в любом
+    состоянии до правил состояния; неизвестное состояние обрабатывается как default.
+    """
+
+    def __init__(self, signals, table, common=(), default='NONE'):
+        for state, rules in table.items():
+            for signal, handler in (*common, *rules):
+                if signal != ALWAYS and signal not in signals:
+                    raise ValueError(f"Неизвестный признак {signal} в правилах состояния {state}")
+                if not callable(handler):
+                    raise TypeError(f"Обработчик признака {signal} в состоянии {state} не вызываемый: {handler!r}")
+            if not rules or rules[-1][0] != ALWAYS:
+                raise ValueError(f"Последнее правило состояния {state} должно срабатывать всегда ({ALWAYS})")
+        if default not in table:
+            raise ValueError(f"Нет правил для состояния по умолчанию {default}")
+        self.signals = dict(signals)
+        self.rules = {state: (*common, *rules) for state, rules in table.items()}
+        self.default = self.rules[default]
+
+    def turn(self, replica, analysis, context):
+        return Turn(replica, analysis, context, self.signals)
+
+    def run(self, state, turn):
+        """(тип статистики, ответ) первого сработавшего обработчика."""
+        for signal, handler in self.rules.get(state, self.default):
+            if turn[signal]:
+                result = handler(turn)
+                if result is not None:
+                    return result
+        raise RuntimeError(f"Ни одно правило состояния {state} не дало ответа")
@@ -0,0 +1,239 @@
+# ./app/tts.py
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+import metrics
+from utils import logger
+
+TTS_LANG = 'ru'
+# Кэш синтезированных ответов: каталог на диске ('' — только память) и ограничения размера
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR', 'state/tts')
+TTS_CACHE_MEMORY_MB = float(os.getenv('TTS_CACHE_MEMORY_MB', '32'))
+TTS_CACHE_DISK_MB = float(os.getenv('TTS_CACHE_DISK_MB', '512'))
+# Синтезировать шаблонные ответы заранее, в фоне после запуска
+TTS_PREWARM = os.getenv('TTS_PREWARM', '0') == '1'
+
+FILE_IDS = 'file_ids.tsv'
+RESULTS = ('file_id', 'memory', 'disk', 'miss')
+
+
+def cache_key(text, lang=TTS_LANG):
+    return hashlib.sha256(f"{lang}\n{text}".encode('utf-8')).hexdigest()
+
+
+class VoiceCache:
+    """Синтезированные ответы по хешу текста: LRU в памяти, файлы на диске и file_id Telegram.
+
+    После первой отправки голосового сообщения Telegram возвращает file_id — повторный ответ
+    тем же текстом отправляется по нему, без байтов. Файлы на диске вытесняются по давности
+    обращения, когда их суммарный размер превышает disk_bytes; вместе с файлом забывается file_id.
+    """
+
+    def __init__(self, synthesize, directory=TTS_CACHE_DIR, memory_bytes=int(TTS_CACHE_MEMORY_MB * 2 ** 20),
+                 disk_bytes=int(TTS_CACHE_DISK_MB * 2 ** 20)):
+        self.synthesize = synthesize
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        # Ключи файлов на диске от давно не использованных к недавним и их размеры
+        self.disk = OrderedDict()
+        self.disk_size = 0
+        self.file_ids = {}
+        self.results = dict.fromkeys(RESULTS, 0)
+        self.synth_seconds = 0.0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.scan()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def scan(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.mp3'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+            elif entry.name.endswith('.tmp'):
+                os.remove(entry.path)
+        for _, key, size in sorted(files):
+            self.disk[key] = size
+            self.disk_size += size
+        self.trim_disk()
+        file_ids_path = os.path.join(self.directory, FILE_IDS)
+        if os.path.exists(file_ids_path):
+            with open(file_ids_path, encoding='utf-8') as f:
+                for line in f:
+                    key, _, file_id = line.rstrip('\n').partition('\t')
+                    if key in self.disk and file_id:
+                        self.file_ids[key] = file_id
+            # Сжатие журнала: остаются только file_id файлов, которые ещё на диске
+            with open(file_ids_path + '.tmp', 'w', encoding='utf-8') as f:
+                f.writelines(f"{key}\t{file_id}\n" for key, file_id in self.file_ids.items())
+            os.replace(file_ids_path + '.tmp', file_ids_path)
+
+    def count(self, result):
+        with self.lock:
+            self.results[result] += 1
+        metrics.count(metrics.TTS_CACHE, result)
+
+    def file_id(self, text):
+        """file_id уже отправленного голосового ответа с этим текстом или None."""
+        key = cache_key(text)
+        with self.lock:
+            file_id = self.file_ids.get(key)
+            if file_id is not None and key in self.disk:
+                self.disk.move_to_end(key)
+        if file_id is not None:
+            self.count('file_id')
+        return file_id
+
+    def remember_file_id(self, text, file_id):
+        key = cache_key(text)
+        with self.lock:
+            if not file_id or self.file_ids.get(key) == file_id or (self.directory and key not in self.disk):
+                return
+            self.file_ids[key] = file_id
+            if self.directory:
+                with open(os.path.join(self.directory, FILE_IDS), 'a', encoding='utf-8') as f:
+                    f.write(f"{key}\t{file_id}\n")
+
+    def forget_file_id(self, text):
+        # Telegram отклонил file_id: следующий ответ снова отправит байты
+        with self.lock:
+            self.file_ids.pop(cache_key(text), None)
+
+    def get(self, text, count=True):
+        """MP3 ответа из кэша или от synthesize; None, если синтез не удался."""
+        key = cache_key(text)
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                if key in self.disk:
+                    self.disk.move_to_end(key)
+        if data is not None:
+            if count:
+                self.count('memory')
+            return data
+        data = self.read(key)
+        if data is not None:
+            if count:
+                self.count('disk')
+            self.remember(key, data)
+            return data
+        if count:
+            self.count('miss')
+        start = time.perf_counter()
+        data = self.synthesize(text)
+        elapsed = time.perf_counter() - start
+        if data:
+            with self.lock:
+                self.synth_seconds += elapsed
+            self.remember(key, data)
+            self.write(key, data)
+        return data
+
+    def remember(self, key, data):
+        if len(data) > self.memory_bytes:
+            return
+        with self.lock:
+            if key in self.memory:
+                return
+            self.memory[key] = data
+            self.memory_size += len(data)
+            while self.memory_size > self.memory_bytes:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_size -= len(evicted)
+
+    def read(self, key):
+        if not self.directory:
+            return None
+        with self.lock:
+            if key not in self.disk:
+                return None
+            self.disk.move_to_end(key)
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+            # Время изменения — время последнего обращения: порядок вытеснения переживает перезапуск
+            os.utime(self.path(key))
+            return data
+        except FileNotFoundError:
+            with self.lock:
+                self.disk_size -= self.disk.pop(key, 0)
+            return None
+
+    def write(self, key, data):
+        if not self.directory or len(data) > self.disk_bytes:
+            return
+        path = self.path(key)
+        # Запись через временный файл: читатель не увидит недописанный MP3
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Ошибка записи кэша синтеза речи: {e}")
+            return
+        with self.lock:
+            self.disk_size += len(data) - self.disk.pop(key, 0)
+            self.disk[key] = len(data)
+        self.trim_disk()
+
+    def trim_disk(self):
+        with self.lock:
+            evicted = []
+            while self.disk_size > self.disk_bytes:
+                key, size = self.disk.popitem(last=False)
+                self.disk_size -= size
+                self.file_ids.pop(key, None)
+                evicted.append(key)
+        for key in evicted:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def prewarm(self, texts):
+        """Синтезирует ещё не закэшированные тексты; возвращает число новых."""
+        created = 0
+        for text in dict.fromkeys(texts):
+            key = cache_key(text)
+            with self.lock:
+                cached = key in self.memory or key in self.disk
+            if not cached and self.get(text, count=False):
+                created += 1
+        return created
+
+    def start_prewarm(self, texts):
+        def run():
+            start = time.perf_counter()
+            try:
+                created = self.prewarm(texts)
+            except Exception as e:
+                logger.error(f"Ошибка прогрева кэша синтеза речи: {e}")
+                return
+            logger.info(f"Кэш синтеза речи прогрет: новых ответов {created} за {time.perf_counter() - start:.1f} с")
+
+        thread = threading.Thread(target=run, name='tts-prewarm', daemon=True)
+        thread.start()
+        return thread
+
+    def summary(self):
+        """Доля попаданий и оценка сэкономленного времени синтеза (среднее время промаха × попадания)."""
+        with self.lock:
+            results = dict(self.results)
+            hits = results['file_id'] + results['memory'] + results['disk']
+            total = hits + results['miss']
+            mean = self.synth_seconds / results['miss'] if results['miss'] else 0.0
+            return {**results, 'hit_rate': round(hits / total, 4) if total else None,
+                    'saved_seconds': round(hits * mean, 3), 'memory_bytes': self.memory_size,
+                    'disk_bytes': self.disk_size, 'file_ids': len(self.file_ids)}
@@ -0,0 +1,73 @@
+# ./app/update_dialogues_model.py
+
+import argparse
+import os
+import shutil
+import time
+from artifacts import new_version_dir, publish, write_manifest, write_segments
+from dialogue_index import DialogueIndex
+from train_dialogues_model import DIALOGUES_PATH, TRAIN_BATCH_SIZE, TRAIN_WORKERS, build, iter_lemmatized
+from utils import logger
+
+# После стольких дельта-сегментов они сливаются с основной версией
+MAX_SEGMENTS = int(os.getenv('DIALOGUES_MAX_SEGMENTS', '8'))
+
+
+def update(dialogues_path=DIALOGUES_PATH, root='models', batch_size=TRAIN_BATCH_SIZE, workers=TRAIN_WORKERS,
+           max_segments=MAX_SEGMENTS):
+    """Индексирует пары, дописанные в конец dialogues.txt, отдельным дельта-сегментом.
+
+    Рассчитано на одного писателя: update и compact не должны выполняться одновременно.
+    """
+    index = DialogueIndex.load(root)
+    start = index.source_offset
+    size = os.path.getsize(dialogues_path)
+    if size < start:
+        raise ValueError(f"{dialogues_path} короче проиндексированной части ({size} < {start} байт), "
+                         f"нужно полное переобучение")
+    if size == start:
+        logger.info("Новых пар в dialogues.txt нет")
+        return 0
+
+    path = new_version_dir(index.path, 'segments')
+    manifest = build(path, iter_lemmatized(dialogues_path, batch_size, workers, start), stats=index, with_ivf=False)
+    if not manifest['n_answers']:
+        shutil.rmtree(path)
+        logger.info("Новых полных пар в dialogues.txt нет")
+        return 0
+    write_manifest(path, manifest)
+    # Сегмент полностью записан до того, как попадает в SEGMENTS: бот видит его целиком или не видит вовсе
+    segments = list(index.stamp[1]) + [os.path.basename(path)]
+    write_segments(index.path, segments)
+    logger.info(f"Добавлен сегмент {os.path.basename(path)}: {manifest['n_answers']} пар, сегментов {len(segments)}")
+
+    if len(segments) > max_segments:
+        compact(root, batch_size)
+    return manifest['n_answers']
+
+
+def compact(root='models', batch_size=TRAIN_BATCH_SIZE):
+    """Сливает основную версию и сегменты в новую версию без повторной лемматизации."""
+    index = DialogueIndex.load(root)
+    path = new_version_dir(root, 'dialogues')
+    manifest = build(path, index.iter_batches(batch_size))
+    manifest['source_offset'] = index.source_offset
+    publish(path, manifest)
+    logger.info(f"Слияние: {len(index.segments)} частей, {manifest['n_answers']} пар -> {path}")
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Дообучение индекса dialogues.txt без полного переобучения')
+    parser.add_argument('--compact', action='store_true', help='слить сегменты с основной версией')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    try:
+        if args.compact:
+            compact()
+        else:
+            update()
+    except (OSError, ValueError) as e:
+        logger.error(f"Ошибка дообучения dialogues.txt: {e}")
+        exit(1)
+    logger.info(f"Дообучение завершено за {time.perf_counter() - start:.1f} с")
@@ -1,39 +1,399 @@
 # ./app/utils.py
 
+import contextvars
 import logging
+import os
+import random
+import re
+import runpy
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from types import SimpleNamespace
+import numpy as np
 from rapidfuzz import process, fuzz
-from data.config import CONFIG
-from natasha import (
-    Segmenter,
-    MorphVocab,
-    NewsEmbedding,
-    NewsMorphTagger,
-    Doc
-)
+from rapidfuzz.distance import Levenshtein
+import metrics
+from logs import SampledLogger, configure_logging
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+configure_logging()
 logger = logging.getLogger(__name__)
+# Построчные логи обработки сообщений: аргументы подставляются лениво, запись по выборке (MESSAGE_LOG_RATE)
+message_logger = SampledLogger(logger.getChild('messages'), {})
+
+
+# Тяжёлый компонент, который загружается при первом обращении или заранее в фоне.
+# Компонент со stamp перезагружается при изменении файлов (см. start_reloader)
+class Component:
+    registry = []
+
+    def __init__(self, name, loader, stamp=None, warm=None):
+        self.name = name
+        self.loader = loader
+        self.stamp = stamp
+        self.warm = warm
+        self.value = None
+        self.version = None
+        self.seconds = None
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+        Component.registry.append(self)
+
+    def get(self):
+        pinned = getattr(_pinned, 'values', None)
+        if pinned is not None and self.name in pinned:
+            return pinned[self.name]
+        if not self.loaded.is_set():
+            with self.lock:
+                if not self.loaded.is_set():
+                    start = time.perf_counter()
+                    self.version = self.read_stamp()
+                    self.value = self.loader()
+                    self.seconds = time.perf_counter() - start
+                    self.loaded.set()
+                    logger.info(f"Компонент {self.name} загружен за {self.seconds:.3f} с")
+        if pinned is not None and self.stamp is not None:
+            pinned[self.name] = self.value
+        return self.value
+
+    def read_stamp(self):
+        try:
+            return self.stamp() if self.stamp is not None else None
+        except OSError:
+            return None
+
+    def reload(self):
+        """Строит новое значение вне горячего пути и подменяет старое одним присваиванием.
+
+        Запросы, начатые до подмены, дорабатывают на старом значении (см. pin_components).
+        При ошибке загрузки остаётся старое значение.
+        """
+        start = time.perf_counter()
+        version = self.read_stamp()
+        try:
+            value = self.loader()
+            if self.warm is not None:
+                self.warm(value)
+        except Exception as e:
+            self.version = version
+            logger.error(f"Компонент {self.name} не перезагружен, работает прежняя версия: {e}")
+            return False
+        with self.lock:
+            self.value = value
+            self.version = version
+            self.loaded.set()
+        logger.info(f"Компонент {self.name} перезагружен за {(time.perf_counter() - start) * 1000:.1f} мс")
+        return True
+
+    def changed(self):
+        return self.stamp is not None and self.loaded.is_set() and self.read_stamp() != self.version
+
+
+_pinned = threading.local()
+
+
+@contextmanager
+def pin_components():
+    """В пределах блока перезагружаемые компоненты возвращают ту версию, что была получена первой."""
+    if getattr(_pinned, 'values', None) is not None:
+        yield
+        return
+    _pinned.values = {}
+    try:
+        yield
+    finally:
+        _pinned.values = None
+
+
+# Проверки, которые поток перезагрузки выполняет вместе с компонентами: (имя, функция -> True, если обновлено)
+reload_hooks = []
+
+
+def reload_changed_components():
+    reloaded = [component.name for component in Component.registry if component.changed() and component.reload()]
+    reloaded += [name for name, refresh in reload_hooks if refresh()]
+    return reloaded + [f"tenant:{tenant}" for tenant in tenants.reload_changed()]
+
+
+def start_reloader(interval):
+    """Опрашивает mtime файлов компонентов раз в interval секунд и перезагружает изменившиеся."""
+    if interval <= 0:
+        return None
+
+    def run():
+        while True:
+            time.sleep(interval)
+            reload_changed_components()
+
+    thread = threading.Thread(target=run, name='reloader', daemon=True)
+    thread.start()
+    return thread
+
+
+# Выставляется, когда все компоненты из preload_components загружены
+components_ready = threading.Event()
+
+
+def preload_components(components=None):
+    """Загружает компоненты параллельно в фоновых потоках и выставляет components_ready."""
+    components = components if components is not None else list(Component.registry)
+
+    def run():
+        start = time.perf_counter()
+        threads = [threading.Thread(target=component.get, name=f"load-{component.name}", daemon=True)
+                   for component in components]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        logger.info(f"Компоненты загружены за {time.perf_counter() - start:.3f} с: {startup_report()}")
+        components_ready.set()
+
+    loader = threading.Thread(target=run, name='preload', daemon=True)
+    loader.start()
+    return loader
+
+
+def startup_report():
+    return {component.name: round(component.seconds, 3) if component.seconds is not None else None
+            for component in Component.registry}
+
 
 # Инициализация Natasha
-segmenter = Segmenter()
-morph_vocab = MorphVocab()
-emb = NewsEmbedding()
-morph_tagger = NewsMorphTagger(emb)
+def load_natasha():
+    from natasha import Segmenter, MorphVocab, NewsEmbedding, NewsMorphTagger
+    emb = NewsEmbedding()
+    return SimpleNamespace(segmenter=Segmenter(), morph_vocab=MorphVocab(), emb=emb, morph_tagger=NewsMorphTagger(emb))
 
-def load_tonal_dict():
-    tonal_dict = {}
+
+natasha = Component('natasha', load_natasha)
+
+
+def get_embedding():
+    return natasha.get().emb
+
+
+# Тональный словарь: «слово оценка» в строке; train_intent_model.py сохраняет его леммы в models/intent
+TONAL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'tonal.txt')
+
+
+def read_tonal_pairs(path=TONAL_PATH):
+    pairs = []
     try:
-        with open('data/tonal_dict.txt', encoding='utf-8') as f:
+        with open(path, encoding='utf-8') as f:
             for line in f:
-                word, score = line.strip().split('\t')
-                tonal_dict[word] = float(score)
+                parts = line.split()
+                if len(parts) == 2:
+                    pairs.append((parts[0], float(parts[1])))
     except FileNotFoundError:
-        logger.error("Файл tonal_dict.txt не найден")
-    return tonal_dict
+        logger.error(f"Файл тонального словаря {path} не найден")
+    return pairs
+
+
+def load_tonal_dict():
+    from artifacts import TonalLexicon, current_dir
+    try:
+        path, manifest = current_dir('models', 'intent')
+        if 'tonal' in manifest:
+            return TonalLexicon.load(path, 'tonal')
+    except FileNotFoundError:
+        pass
+    # Модель намерений обучена без словаря: строим его из data/tonal.txt
+    pairs = read_tonal_pairs()
+    return TonalLexicon.from_pairs(zip(lemmatize_batch([word for word, _ in pairs]), (score for _, score in pairs)))
+
+
+def tonal_stamp():
+    from artifacts import current_version
+    return current_version('models', 'intent')
+
+
+tonal_dict = Component('tonal_dict', load_tonal_dict, stamp=tonal_stamp)
+
+
+# Конфигурация (меню, намерения, тексты) перечитывается из data/config.py при его изменении
+CONFIG_PATH = os.getenv('BOT_CONFIG_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'config.py'))
+
+
+class ConfigVersion:
+    """Версия CONFIG вместе с построенными по ней индексами."""
+    builders = {}
+
+    def __init__(self, data):
+        self.data = data
+        self.derived = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        if name not in self.derived:
+            with self.lock:
+                if name not in self.derived:
+                    self.derived[name] = ConfigVersion.builders[name](self.data)
+        return self.derived[name]
+
+    def warm(self):
+        for name in ConfigVersion.builders:
+            self.get(name)
+
+
+def load_config_version(path):
+    version = ConfigVersion(runpy.run_path(path)['CONFIG'])
+    # Шаблоны ответов разбираются сразу: ошибка в плейсхолдере не даёт загрузить CONFIG
+    version.get('templates')
+    return version
+
+
+def load_config():
+    return load_config_version(CONFIG_PATH)
 
 
-TONAL_DICT = load_tonal_dict()
+def config_stamp():
+    stat = os.stat(CONFIG_PATH)
+    return CONFIG_PATH, stat.st_mtime_ns, stat.st_size
+
+
+config = Component('config', load_config, stamp=config_stamp, warm=ConfigVersion.warm)
+
+# Другие рестораны: <TENANTS_DIR>/<ресторан>.py с CONFIG того же формата; без ресторана — data/config.py
+TENANTS_DIR = os.getenv('TENANTS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'tenants'))
+# Сколько ресторанов держать в памяти вместе с индексами; давно не использованные вытесняются
+TENANT_CACHE_SIZE = int(os.getenv('TENANT_CACHE_SIZE', '32'))
+DEFAULT_TENANT = 'default'
+# Как параметр deep-link в /start: буквы, цифры, _ и -
+TENANT_NAME = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+_tenant = contextvars.ContextVar('tenant', default=None)
+
+
+class TenantConfigs:
+    """Версии CONFIG ресторанов: загружаются при первом сообщении, индексы строятся лениво.
+
+    В памяти не больше capacity ресторанов (LRU): вытесняется CONFIG вместе со всеми индексами,
+    поэтому память растёт с числом активных ресторанов, а не всех. Natasha, кэш лемм и модели
+    общие для всех ресторанов.
+    """
+
+    def __init__(self, directory=TENANTS_DIR, capacity=TENANT_CACHE_SIZE):
+        self.directory = directory
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        # ресторан -> (ConfigVersion, stamp файла)
+        self.loaded = OrderedDict()
+        self.loads = 0
+        self.evictions = 0
+
+    def path(self, tenant):
+        return os.path.join(self.directory, f"{tenant}.py")
+
+    def exists(self, tenant):
+        return tenant == DEFAULT_TENANT or bool(TENANT_NAME.fullmatch(tenant) and os.path.isfile(self.path(tenant)))
+
+    def stamp(self, tenant):
+        # Ресторан может строиться на основном CONFIG (data/tenants/pizzeria.py): его правка перечитывает и ресторан
+        stat = os.stat(self.path(tenant))
+        base = os.stat(CONFIG_PATH)
+        return stat.st_mtime_ns, stat.st_size, base.st_mtime_ns, base.st_size
+
+    def get(self, tenant):
+        with self.lock:
+            entry = self.loaded.get(tenant)
+            if entry is not None:
+                self.loaded.move_to_end(tenant)
+                return entry[0]
+        if not self.exists(tenant):
+            raise KeyError(tenant)
+        # Загрузка идёт без блокировки: обращения к уже загруженным ресторанам её не ждут
+        start = time.perf_counter()
+        try:
+            stamp = self.stamp(tenant)
+            version = load_config_version(self.path(tenant))
+        except FileNotFoundError:
+            raise KeyError(tenant) from None
+        with self.lock:
+            entry = self.loaded.get(tenant)
+            if entry is not None:
+                # Тот же ресторан успел загрузить другой поток: остаётся его версия
+                self.loaded.move_to_end(tenant)
+                return entry[0]
+            self.loaded[tenant] = (version, stamp)
+            self.loads += 1
+            evicted = []
+            while len(self.loaded) > self.capacity:
+                evicted.append(self.loaded.popitem(last=False)[0])
+                self.evictions += 1
+        logger.info(f"CONFIG ресторана {tenant} загружен за {(time.perf_counter() - start) * 1000:.1f} мс"
+                    + (f", вытеснены: {', '.join(evicted)}" if evicted else ''))
+        return version
+
+    def reload_changed(self):
+        """Перечитывает изменившиеся файлы загруженных ресторанов; индексы строятся до подмены."""
+        with self.lock:
+            loaded = [(tenant, stamp) for tenant, (_, stamp) in self.loaded.items()]
+        reloaded = []
+        for tenant, stamp in loaded:
+            try:
+                new_stamp = self.stamp(tenant)
+                if new_stamp == stamp:
+                    continue
+                version = load_config_version(self.path(tenant))
+                version.warm()
+            except Exception as e:
+                logger.error(f"CONFIG ресторана {tenant} не перезагружен, работает прежняя версия: {e}")
+                continue
+            with self.lock:
+                if tenant in self.loaded:
+                    self.loaded[tenant] = (version, new_stamp)
+                    reloaded.append(tenant)
+        return reloaded
+
+    def stats(self):
+        with self.lock:
+            return {'loaded': len(self.loaded), 'capacity': self.capacity, 'loads': self.loads,
+                    'evictions': self.evictions}
+
+
+tenants = TenantConfigs()
+
+
+@contextmanager
+def tenant_scope(tenant):
+    """В пределах блока get_config() и индексы относятся к ресторану tenant (None — основной CONFIG)."""
+    token = _tenant.set(tenant)
+    try:
+        yield
+    finally:
+        _tenant.reset(token)
+
+
+def current_tenant():
+    return _tenant.get() or DEFAULT_TENANT
+
+
+def current_config():
+    """ConfigVersion ресторана текущего сообщения; в pin_components — одна версия на всё сообщение."""
+    tenant = _tenant.get()
+    if tenant is None or tenant == DEFAULT_TENANT:
+        return config.get()
+    pinned = getattr(_pinned, 'values', None)
+    key = ('tenant', tenant)
+    if pinned is not None and key in pinned:
+        return pinned[key]
+    try:
+        version = tenants.get(tenant)
+    except KeyError:
+        # Основной CONFIG тоже фиксируется: ресторан ищется и ошибка пишется один раз на сообщение
+        logger.error(f"Неизвестный ресторан {tenant}, используется основной CONFIG")
+        version = config.get()
+    if pinned is not None:
+        pinned[key] = version
+    return version
+
+
+def get_config():
+    return current_config().data
 
 # Очистка фразы (оставляем как есть)
 def clear_phrase(phrase):
@@ -43,108 +403,749 @@ def clear_phrase(phrase):
     alphabet = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя- '
     return ''.join(symbol for symbol in phrase if symbol in alphabet).strip()
 
-# Лемматизация и морфологический анализ
-def lemmatize_phrase(phrase):
+# Число — цена, если за ним валюта («400 рублей», «250 р», «300₽») или перед ним сравнение («дешевле 300»).
+# «до N» и «за N» — цена, только если во фразе есть слово о цене: «за 5 минут», «до 2 человек», «мне 25 лет» — не цены
+PRICE_PATTERN = re.compile(r'\b(?:дешевле|меньше|ниже)\s+(\d+)'
+                           r'|\b(?:до|за)\s+(\d+)(?!\d|\s*(?:руб|р\b|₽))'
+                           r'|(\d+)\s*(?:руб|р\b|₽)')
+PRICE_WORDS = re.compile(r'\b(?:цен|стои|бюджет)')
+
+
+# Цены из исходного текста: clear_phrase отбрасывает цифры
+def extract_prices(phrase):
     if not phrase:
-        return ""
+        return []
+    phrase = phrase.lower()
+    priced = PRICE_WORDS.search(phrase) is not None
+    return [int(compared or bound or before_unit) for compared, bound, before_unit in PRICE_PATTERN.findall(phrase)
+            if compared or before_unit or priced]
+
+# Счётчик запусков Natasha (на поток), сбрасывается в начале обработки сообщения
+_lemmatizer_calls = threading.local()
+
+
+def reset_lemmatizer_calls():
+    _lemmatizer_calls.count = 0
+
+
+def get_lemmatizer_calls():
+    return getattr(_lemmatizer_calls, 'count', 0)
+
+
+# Результат разбора реплики: считается один раз и передаётся по всему конвейеру bot()
+class AnalyzedReplica:
+    __slots__ = ('text', 'cleaned', 'tokens', 'lemmas', 'tags', 'prices', 'lemmatized')
+
+    def __init__(self, text, cleaned, tokens, lemmas, tags, prices):
+        self.text = text
+        self.cleaned = cleaned
+        self.tokens = tokens
+        self.lemmas = lemmas
+        self.tags = tags
+        self.prices = prices
+        self.lemmatized = ' '.join(lemmas)
+
+    def __str__(self):
+        return self.text
+
+    def __bool__(self):
+        return bool(self.text)
+
+# Лемматизация и морфологический анализ
+def morph_analyze_batch(cleaned_phrases):
+    """Прогоняет очищенные фразы через Natasha одним пакетом: токены, леммы и теги (pos, feats).
+
+    Морфотеггер получает сразу все предложения всех фраз, как Doc.tag_morph для одного документа.
+    """
+    _lemmatizer_calls.count = get_lemmatizer_calls() + len(cleaned_phrases)
+    nlp = natasha.get()
+
+    # Сегментация: токены фразы раскладываются по предложениям
+    sentences = []
+    for cleaned_phrase in cleaned_phrases:
+        words = list(nlp.segmenter.tokenize(cleaned_phrase))
+        for sent in nlp.segmenter.sentenize(cleaned_phrase):
+            sentences.append([word.text for word in words if sent.start <= word.start and word.stop <= sent.stop])
+        sentences.append(None)  # граница фразы
+
+    results = []
+    tokens, lemmas, tags = [], [], []
+    markups = nlp.morph_tagger.map([sent for sent in sentences if sent is not None])
+    for sent in sentences:
+        if sent is None:
+            # Кортежи: результат разделяется между сообщениями через кэш
+            results.append((tuple(tokens), tuple(lemmas), tuple(tags)))
+            tokens, lemmas, tags = [], [], []
+            continue
+        for token in next(markups).tokens:
+            # Лемматизируем токен; используем лемму, если она есть, иначе оригинальный текст
+            lemma = nlp.morph_vocab.lemmatize(token.text, token.pos, token.feats)
+            tokens.append(token.text)
+            lemmas.append(lemma if lemma else token.text)
+            tags.append((token.pos, token.feats))
+    return results
+
+
+def morph_analyze(cleaned_phrase):
+    return morph_analyze_batch([cleaned_phrase])[0]
+
+
+# Ограниченный LRU-кэш результатов Natasha, ключ — очищенная фраза
+class LRUCache:
+    def __init__(self, maxsize, name='cache', report_every=1000):
+        self.maxsize = maxsize
+        self.name = name
+        self.report_every = report_every
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.data.move_to_end(key)
+                self.hits += 1
+            lookups = self.hits + self.misses
+        if self.report_every and lookups % self.report_every == 0:
+            logger.info(f"Кэш {self.name}: {self.stats()}")
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+
+# Длинные фразы почти не повторяются, в кэш их не кладём
+LEMMA_CACHE_MAX_PHRASE = 200
+lemma_cache = LRUCache(int(os.getenv('LEMMA_CACHE_SIZE', '10000')), name='лемматизации')
+
+
+def get_lemma_cache_stats():
+    return lemma_cache.stats()
+
+
+def cached_morph_analyze(cleaned_phrase):
+    result = lemma_cache.get(cleaned_phrase)
+    if result is None:
+        result = morph_analyze(cleaned_phrase)
+        if len(cleaned_phrase) <= LEMMA_CACHE_MAX_PHRASE:
+            lemma_cache.put(cleaned_phrase, result)
+    return result
+
+
+def analyze_replica(phrase):
+    if isinstance(phrase, AnalyzedReplica):
+        return phrase
+    phrase = phrase or ""
     # Очистка текста
     cleaned_phrase = clear_phrase(phrase)
     if not cleaned_phrase:
+        return AnalyzedReplica(phrase, "", (), (), (), extract_prices(phrase))
+    tokens, lemmas, tags = cached_morph_analyze(cleaned_phrase)
+    return AnalyzedReplica(phrase, cleaned_phrase, tokens, lemmas, tags, extract_prices(phrase))
+
+
+def analyze_batch(phrases):
+    """Разбирает список фраз: промахи кэша уходят в Natasha одним пакетом."""
+    results = [None] * len(phrases)
+    pending = {}
+    for idx, phrase in enumerate(phrases):
+        if isinstance(phrase, AnalyzedReplica):
+            results[idx] = phrase
+            continue
+        phrase = phrase or ""
+        cleaned_phrase = clear_phrase(phrase)
+        cached = lemma_cache.get(cleaned_phrase) if cleaned_phrase else ((), (), ())
+        if cached is None:
+            pending.setdefault(cleaned_phrase, []).append(idx)
+        else:
+            results[idx] = AnalyzedReplica(phrase, cleaned_phrase, *cached, extract_prices(phrase))
+    if pending:
+        for cleaned_phrase, result in zip(pending, morph_analyze_batch(list(pending))):
+            if len(cleaned_phrase) <= LEMMA_CACHE_MAX_PHRASE:
+                lemma_cache.put(cleaned_phrase, result)
+            for idx in pending[cleaned_phrase]:
+                phrase = phrases[idx] or ""
+                results[idx] = AnalyzedReplica(phrase, cleaned_phrase, *result, extract_prices(phrase))
+    return results
+
+
+def lemmatize_phrase(phrase):
+    if not phrase:
         return ""
+    return analyze_replica(phrase).lemmatized
 
-    # Создание объекта Natasha Doc
-    doc = Doc(cleaned_phrase)
-    doc.segment(segmenter)
-    doc.tag_morph(morph_tagger)
 
-    # Лемматизация
-    lemmatized_words = []
-    for token in doc.tokens:
-        # Лемматизируем токен
-        token.lemmatize(morph_vocab)
+def lemmatize_batch(phrases):
+    return [analysis.lemmatized for analysis in analyze_batch(phrases)]
 
-        # Используем лемму, если она есть, иначе оригинальный текст
-        lemma = token.lemma if token.lemma else token.text
-        lemmatized_words.append(lemma)
+# Модификаторы тональности следующих слов: частица с Polarity=Neg и наречия-усилители
+NEGATION_FACTOR = -0.7
+NEGATIONS = ('не', 'ни')
+INTENSIFIERS = {'очень': 1.5, 'совсем': 1.5, 'крайне': 1.5, 'слишком': 1.3, 'весьма': 1.3, 'невероятно': 1.6,
+                'безумно': 1.6, 'ужасно': 1.5, 'жутко': 1.5, 'довольно': 1.2, 'немного': 0.5, 'слегка': 0.5,
+                'чуть': 0.5}
+MODIFIER_LEMMAS = frozenset(NEGATIONS) | frozenset(INTENSIFIERS)
+# Сколько предыдущих слов может влиять на оценку: «не очень хороший»
+MODIFIER_WINDOW = 2
 
-    res =  ' '.join(lemmatized_words)
-    # print(res)
 
-    return res
+def token_modifier(lemma, tag):
+    if lemma not in MODIFIER_LEMMAS:
+        return 1.0
+    pos, feats = tag
+    if feats.get('Polarity') == 'Neg':
+        return NEGATION_FACTOR
+    return INTENSIFIERS.get(lemma, 1.0) if pos == 'ADV' else 1.0
 
-# Анализ тональности
-def analyze_sentiment(phrase):
-    if not phrase:
-        return 'neutral'
-    lemmatized = lemmatize_phrase(phrase)
-    words = lemmatized.split()
-    sentiment_score = 0
-    count = 0
-    for word in words:
-        if word in TONAL_DICT:
-            sentiment_score += TONAL_DICT[word]
+
+def phrase_sentiment(analysis):
+    """Тональность одной разобранной фразы, как в sentiment_scores, но без numpy: для одиночных сообщений."""
+    lexicon = tonal_dict.get()
+    total = count = 0
+    previous = [1.0] * MODIFIER_WINDOW
+    for lemma, tag in zip(analysis.lemmas, analysis.tags):
+        score = lexicon.score(lemma)
+        if score is not None:
+            factor = 1.0
+            for modifier in reversed(previous):
+                factor *= modifier
+            total += score * factor
             count += 1
-    if count == 0:
-        return 'neutral'
-    avg_score = sentiment_score / count
-    if avg_score > 0.3:
+        previous = previous[1:] + [token_modifier(lemma, tag)]
+    return total / count if count else float('nan')
+
+
+def sentiment_scores(phrases):
+    """Средняя тональность каждой фразы пакета (NaN — тональных слов нет).
+
+    Леммы всех фраз кодируются и ищутся в словаре одним проходом numpy. Оценка слова умножается
+    на модификаторы MODIFIER_WINDOW предыдущих слов той же фразы: отрицание меняет знак,
+    усилитель увеличивает или ослабляет. Теги разбора проверяются только у лемм-кандидатов.
+    """
+    analyses = analyze_batch(phrases)
+    lengths = np.fromiter((len(analysis.lemmas) for analysis in analyses), dtype=np.int64, count=len(analyses))
+    if not lengths.sum():
+        return np.full(len(analyses), np.nan)
+    owners = np.repeat(np.arange(len(analyses)), lengths)
+    lemmas = [lemma for analysis in analyses for lemma in analysis.lemmas]
+    # Одно кодирование на пакет: в леммах очищенных фраз нет перевода строки
+    words = np.array('\n'.join(lemmas).encode('utf-8').split(b'\n'))
+    scores = tonal_dict.get().lookup(words)
+    found = ~np.isnan(scores)
+    weights = scores[found].astype(np.float64)
+
+    candidates = [idx for idx, lemma in enumerate(lemmas) if lemma in MODIFIER_LEMMAS]
+    if candidates:
+        starts = np.cumsum(lengths) - lengths
+        modifiers = np.ones(len(words))
+        for idx in candidates:
+            owner = owners[idx]
+            modifiers[idx] = token_modifier(lemmas[idx], analyses[owner].tags[idx - starts[owner]])
+        factors = np.ones(len(words))
+        for shift in range(1, MODIFIER_WINDOW + 1):
+            same = owners[shift:] == owners[:-shift]
+            factors[shift:] *= np.where(same, modifiers[:-shift], 1.0)
+        weights *= factors[found]
+    totals = np.bincount(owners[found], weights=weights, minlength=len(analyses))
+    counts = np.bincount(owners[found], minlength=len(analyses))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return totals / counts
+
+
+def sentiment_label(score):
+    if score > 0.3:
         return 'positive'
-    elif avg_score < -0.3:
+    elif score < -0.3:
         return 'negative'
     return 'neutral'
 
+
+def sentiment_labels(phrases):
+    return [sentiment_label(score) for score in sentiment_scores(phrases)]
+
+
+# Анализ тональности
+def analyze_sentiment(phrase):
+    if not phrase:
+        return 'neutral'
+    return sentiment_label(phrase_sentiment(analyze_replica(phrase)))
+
 # Проверка на осмысленность текста
 def is_meaningful_text(text):
-    text = clear_phrase(text)
+    text = text.cleaned if isinstance(text, AnalyzedReplica) else clear_phrase(text)
     words = text.split()
     return any(len(word) > 2 and all(c in 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя' for c in word) for word in words)
 
+# Мультишаблонный поиск подстрок (Ахо-Корасик)
+class AhoCorasick:
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        self.empty = [idx for idx, pattern in enumerate(patterns) if not pattern]
+        for idx, pattern in enumerate(patterns):
+            if not pattern:
+                continue
+            node = 0
+            for symbol in pattern:
+                if symbol not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[node][symbol] = len(self.goto) - 1
+                node = self.goto[node][symbol]
+            self.output[node].append(idx)
+        # Ссылки неудач строим обходом в ширину
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for symbol, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and symbol not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(symbol, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def search(self, text):
+        """Возвращает множество индексов шаблонов, встретившихся в тексте."""
+        # Пустой шаблон, как и в операторе in, входит в любую строку
+        found = set(self.empty)
+        node = 0
+        for symbol in text:
+            while node and symbol not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(symbol, 0)
+            found.update(self.output[node])
+        return found
+
+
+# Индекс меню: лемматизированные названия и синонимы считаются один раз
+class MenuIndex:
+    def __init__(self, dishes):
+        self.dishes = list(dishes.keys())
+        patterns = []
+        pattern_dish = []
+        self.candidates = []
+        self.candidate_dish = []
+        self.candidate_bounds = []
+        for dish_idx, (dish, data) in enumerate(dishes.items()):
+            for phrase in [dish] + data.get('synonyms', []):
+                patterns.append(lemmatize_phrase(phrase))
+                pattern_dish.append(dish_idx)
+            self.candidate_bounds.append(len(self.candidates))
+            self.candidates.extend([dish] + data.get('synonyms', []))
+            self.candidate_dish.extend([dish_idx] * (1 + len(data.get('synonyms', []))))
+        self.candidate_bounds.append(len(self.candidates))
+        self.pattern_dish = pattern_dish
+        self.matcher = AhoCorasick(patterns)
+
+    def find(self, replica):
+        """Ищет блюдо в лемматизированной фразе, сохраняя порядок блюд из CONFIG."""
+        exact = [self.pattern_dish[idx] for idx in self.matcher.search(replica)]
+        best = min(exact) if exact else len(self.dishes)
+        # Нечёткий поиск нужен только среди блюд, стоящих раньше точного совпадения
+        limit = self.candidate_bounds[best]
+        if limit:
+            matches = process.extract(replica, self.candidates[:limit], scorer=fuzz.partial_ratio,
+                                      score_cutoff=85, limit=None)
+            fuzzy = [self.candidate_dish[idx] for _, score, idx in matches if score > 85]
+            if fuzzy:
+                best = min(best, min(fuzzy))
+        return self.dishes[best] if best < len(self.dishes) else None
+
+
+def build_menu_index(data):
+    menu_index = MenuIndex(data['dishes'])
+    logger.info(f"Индекс меню построен: {len(menu_index.dishes)} блюд, {len(menu_index.candidates)} вариантов названий")
+    return menu_index
+
+
+ConfigVersion.builders['menu_index'] = build_menu_index
+
+
+def get_menu_index():
+    """Индекс меню текущей версии CONFIG."""
+    return current_config().get('menu_index')
+
+
+# Страница результатов фильтра меню
+class MenuPage:
+    __slots__ = ('dishes', 'total', 'offset')
+
+    def __init__(self, dishes, total, offset):
+        self.dishes = dishes
+        self.total = total
+        self.offset = offset
+
+    @property
+    def rest(self):
+        return self.total - self.offset - len(self.dishes)
+
+
+# Каталог меню версии CONFIG: отсортированные цены для bisect, списки блюд по категориям и диетическим меткам.
+# Результаты идут в порядке блюд из CONFIG
+class Menu:
+    def __init__(self, dishes, dietary=None):
+        self.names = tuple(dishes)
+        self.positions = {name: idx for idx, name in enumerate(self.names)}
+        self.prices = np.array([data['price'] for data in dishes.values()], dtype=np.float64)
+        self.price_order = np.argsort(self.prices, kind='stable')
+        self.sorted_prices = self.prices[self.price_order]
+        categories = {}
+        for idx, data in enumerate(dishes.values()):
+            for category in data.get('categories', []):
+                categories.setdefault(category, []).append(idx)
+        dietary = dietary or {}
+        self.labels = {tag: spec.get('label', tag) for tag, spec in dietary.items()}
+        self.dietary_categories = {tag: frozenset(spec.get('categories', [])) for tag, spec in dietary.items()}
+        tagged = {}
+        for tag, spec in dietary.items():
+            items = {idx for category in spec.get('categories', []) for idx in categories.get(category, [])}
+            items.update(idx for idx, data in enumerate(dishes.values()) if tag in data.get('dietary', []))
+            tagged[tag] = sorted(items)
+        # Списки позиций блюд и маски для проверки принадлежности при пересечении фильтров
+        self.categories = {category: np.array(items, dtype=np.int64) for category, items in categories.items()}
+        self.dietary = {tag: np.array(items, dtype=np.int64) for tag, items in tagged.items()}
+        self.category_masks = {category: self.mask(items) for category, items in self.categories.items()}
+        self.dietary_masks = {tag: self.mask(items) for tag, items in self.dietary.items()}
+
+    def mask(self, positions):
+        mask = np.zeros(len(self.names), dtype=bool)
+        mask[positions] = True
+        return mask
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def in_category(self, category):
+        return [self.names[idx] for idx in self.categories.get(category, ())]
+
+    def random_dish(self, exclude=None):
+        """random.choice по блюдам без exclude, но без построения списка (тот же расход random)."""
+        excluded = self.positions.get(exclude)
+        if excluded is None:
+            return random.choice(self.names)
+        idx = random.randrange(len(self.names) - 1)
+        return self.names[idx + (idx >= excluded)]
+
+    def price_positions(self, max_price, count):
+        # Немного дешёвых блюд — сортируем их позиции, иначе быстрее маска по всему массиву цен
+        if count * 16 < len(self.names):
+            return np.sort(self.price_order[:count])
+        return np.flatnonzero(self.prices <= max_price)
+
+    def filter(self, max_price=None, category=None, dietary=None, offset=0, limit=None):
+        """Блюда не дороже max_price, из категории и с диетической меткой; страница offset:offset+limit.
+
+        Число блюд по цене даёт bisect по отсортированным ценам. Перебирается только самый
+        короткий из подходящих списков, остальные условия проверяются масками.
+        """
+        empty = np.zeros(0, dtype=np.int64)
+        candidates = []
+        if category is not None:
+            candidates.append((len(self.categories.get(category, empty)), 'category'))
+        if dietary is not None:
+            candidates.append((len(self.dietary.get(dietary, empty)), 'dietary'))
+        if max_price is not None:
+            candidates.append((bisect_right(self.sorted_prices, max_price), 'price'))
+        kind = None
+        if not candidates:
+            found = np.arange(len(self.names))
+        else:
+            size, kind = min(candidates)
+            if kind == 'category':
+                found = self.categories.get(category, empty)
+            elif kind == 'dietary':
+                found = self.dietary.get(dietary, empty)
+            else:
+                found = self.price_positions(max_price, size)
+        if category is not None and kind != 'category' and len(found):
+            found = found[self.category_masks[category][found]] if category in self.category_masks else empty
+        if dietary is not None and kind != 'dietary' and len(found):
+            found = found[self.dietary_masks[dietary][found]] if dietary in self.dietary_masks else empty
+        if max_price is not None and kind != 'price' and len(found):
+            found = found[self.prices[found] <= max_price]
+        end = len(found) if limit is None else offset + limit
+        return MenuPage([self.names[idx] for idx in found[offset:end]], len(found), offset)
+
+
+def build_menu(data):
+    menu = Menu(data['dishes'], data.get('dietary'))
+    logger.info(f"Каталог меню построен: {len(menu)} блюд, {len(menu.categories)} категорий, "
+                f"диетических меток {len(menu.dietary)}")
+    return menu
+
+
+ConfigVersion.builders['menu'] = build_menu
+
+
+def get_menu():
+    """Каталог меню текущей версии CONFIG."""
+    return current_config().get('menu')
+
+
+# Индекс примеров намерений: лемматизация примеров выполняется один раз
+class IntentExampleIndex:
+    def __init__(self, intents, threshold=0.65):
+        self.threshold = threshold
+        self.examples = []
+        self.intents = []
+        for intent_key, data in intents.items():
+            for example in data.get('examples', []):
+                example = lemmatize_phrase(example)  # Лемматизируем примеры
+                if not example:
+                    continue
+                self.examples.append(example)
+                self.intents.append(intent_key)
+        self.lengths = np.array([len(example) for example in self.examples], dtype=np.int64)
+        # Доля допустимых правок относительно длины примера
+        self.max_edit_ratio = 1 - threshold
+
+    def best_match(self, replica):
+        """Возвращает (намерение, score) ближайшего примера или (None, 0), если score ниже порога.
+
+        score = 1 - levenshtein / len(example), как и прежний расчёт через nltk.edit_distance.
+        """
+        if not self.examples:
+            return None, 0
+        # Расстояние Левенштейна не меньше разницы длин: отбрасываем заведомо далёкие примеры
+        allowed = np.abs(self.lengths - len(replica)) <= self.lengths * self.max_edit_ratio + 1
+        candidates = np.flatnonzero(allowed)
+        if not len(candidates):
+            return None, 0
+        distances = process.cdist([replica], [self.examples[idx] for idx in candidates],
+                                  scorer=Levenshtein.distance, dtype=np.int64)[0]
+        scores = 1 - distances / np.maximum(self.lengths[candidates], 1)
+        best = int(scores.argmax())
+        if scores[best] < self.threshold:
+            return None, 0
+        return self.intents[candidates[best]], float(scores[best])
+
+    def best_matches(self, replicas, batch_size=4096):
+        """best_match для списка фраз: расстояния до всех примеров одной матрицей на пакет."""
+        if not self.examples:
+            return [(None, 0)] * len(replicas)
+        results = []
+        for start in range(0, len(replicas), batch_size):
+            batch = replicas[start:start + batch_size]
+            distances = process.cdist(batch, self.examples, scorer=Levenshtein.distance, dtype=np.int32, workers=-1)
+            scores = 1 - distances / np.maximum(self.lengths, 1)
+            # Те же кандидаты, что и в best_match: остальные примеры не участвуют в выборе
+            lengths = np.array([len(replica) for replica in batch], dtype=np.int64)
+            allowed = np.abs(self.lengths[None, :] - lengths[:, None]) <= self.lengths * self.max_edit_ratio + 1
+            scores[~allowed] = -np.inf
+            best = scores.argmax(axis=1)
+            best_scores = scores[np.arange(len(batch)), best]
+            results.extend((self.intents[idx], float(score)) if score >= self.threshold else (None, 0)
+                           for idx, score in zip(best, best_scores))
+        return results
+
+
+def build_intent_index(data):
+    intent_index = IntentExampleIndex(data['intents'])
+    logger.info(f"Индекс примеров намерений построен: {len(intent_index.examples)} примеров")
+    return intent_index
+
+
+ConfigVersion.builders['intent_index'] = build_intent_index
+
+
+def get_intent_index():
+    """Индекс примеров намерений текущей версии CONFIG."""
+    return current_config().get('intent_index')
+
+
 # Извлечение блюда
 def extract_dish_name(replica):
     replica = lemmatize_phrase(replica)  # Используем лемматизированную фразу
     if not replica:
         return None
-    for dish, data in CONFIG['dishes'].items():
-        # Лемматизируем название блюда и синонимы
-        dish_lemmatized = lemmatize_phrase(dish)
-        synonyms_lemmatized = [lemmatize_phrase(syn) for syn in data.get('synonyms', [])]
-        if dish_lemmatized in replica or any(syn in replica for syn in synonyms_lemmatized):
-            return dish
-        candidates = [dish] + data.get('synonyms', [])
-        best_match = process.extractOne(replica, candidates, scorer=fuzz.partial_ratio)
-        if best_match and best_match[1] > 85:
-            return dish
-    return None
+    return get_menu_index().find(replica)
 
-# Извлечение категории
-def extract_dish_category(replica):
-    replica = lemmatize_phrase(replica)  # Используем лемматизированную фразу
-    if not replica:
-        return None
-    for category in CONFIG['categories']:
+# Варианты написания категорий (лемматизируются один раз на версию CONFIG)
+def build_category_variants(data):
+    category_variants = []
+    for category in data['categories']:
         # Лемматизируем категорию
         category_lemmatized = lemmatize_phrase(category)
-        category_variants = [
+        category_variants.append((category, [
             category_lemmatized,
             category_lemmatized + 'ы',
             category_lemmatized[:-1] + 'ая' if category_lemmatized.endswith('а') else category_lemmatized,
             category_lemmatized[:-1] + 'и' if category_lemmatized.endswith('а') else category_lemmatized
-        ]
+        ]))
+    return category_variants
+
+
+ConfigVersion.builders['category_variants'] = build_category_variants
+
+
+def get_category_variants():
+    return current_config().get('category_variants')
+
+
+# Извлечение категории
+def extract_dish_category(replica):
+    replica = lemmatize_phrase(replica)  # Используем лемматизированную фразу
+    if not replica:
+        return None
+    for category, category_variants in get_category_variants():
         for variant in category_variants:
             if variant in replica:
                 return category
     return None
 
+# Слова диетических фильтров (лемматизируются один раз на версию CONFIG)
+def build_dietary_keywords(data):
+    return {lemmatize_phrase(keyword): tag for tag, spec in data.get('dietary', {}).items()
+            for keyword in spec.get('keywords', [])}
+
+
+ConfigVersion.builders['dietary_keywords'] = build_dietary_keywords
+
+
+# Извлечение диетической метки: 'vegan', 'kids' или None
+def extract_dietary(replica):
+    lemmas = replica.lemmas if isinstance(replica, AnalyzedReplica) else lemmatize_phrase(replica).split()
+    keywords = current_config().get('dietary_keywords')
+    for lemma in lemmas:
+        if lemma in keywords:
+            return keywords[lemma]
+    return None
+
 # Извлечение цены
 def extract_price(replica):
-    replica = clear_phrase(replica)  # Цены не лемматизируем
-    if not replica:
-        return None
-    words = replica.split()
-    for word in words:
-        if word.isdigit():
-            return int(word)
-    return None
+    # Цены не лемматизируем
+    prices = replica.prices if isinstance(replica, AnalyzedReplica) else extract_prices(replica)
+    return prices[0] if prices else None
+
+# Плейсхолдеры шаблонов ответов: [dish_name], [price], [description]
+PLACEHOLDER = re.compile(r'\[([a-z_]+)\]')
+DISH_SLOTS = ('dish_name', 'price', 'description')
+# Намерения про конкретное блюдо: в ответ подставляются его название, цена и описание
+DISH_INTENTS = ('dish_price', 'dish_availability', 'dish_info', 'order_dish')
+INTENT_SLOTS = {**dict.fromkeys(DISH_INTENTS, DISH_SLOTS), 'dish_recommendation': ('dish_name',)}
+# Ответы этих намерений бот составляет сам, шаблоны CONFIG не подставляются
+COMPOSED_INTENTS = ('menu_types', 'yes', 'no', 'filter_dishes')
+DEFAULT_DESCRIPTION = 'вкусное блюдо'
+# Сколько ответов «шаблон × блюдо» подставить заранее; для больших меню остальные собираются при ответе
+TEMPLATE_PRERENDER_LIMIT = int(os.getenv('TEMPLATE_PRERENDER_LIMIT', '20000'))
+
+
+# Шаблон ответа, разобранный один раз: в segments текст и имена плейсхолдеров чередуются
+class ResponseTemplate:
+    __slots__ = ('text', 'segments', 'slots', 'rendered')
+
+    def __init__(self, text, allowed):
+        segments = PLACEHOLDER.split(text)
+        for slot in segments[1::2]:
+            if slot not in allowed:
+                raise ValueError(f"Плейсхолдер [{slot}] недопустим в шаблоне {text!r}, "
+                                 f"допустимы: {', '.join(allowed) or 'нет'}")
+        self.text = text
+        self.segments = segments
+        self.slots = tuple(segments[1::2])
+        # блюдо -> готовый ответ (см. ResponseTemplates.prerender)
+        self.rendered = {}
+
+    def render(self, values):
+        if not self.slots:
+            return self.text
+        segments = self.segments.copy()
+        # На нечётных местах стоят имена плейсхолдеров — заменяются значениями
+        for position in range(1, len(segments), 2):
+            segments[position] = values[segments[position]]
+        return ''.join(segments)
+
+
+class ResponseTemplates:
+    """Шаблоны CONFIG['intents'][*]['responses'] и failure_phrases одной версии CONFIG.
+
+    Плейсхолдеры проверяются при загрузке: неизвестный или недопустимый для намерения плейсхолдер
+    и блюдо без цены — ошибка загрузки CONFIG, а не ответа. Пока шаблонов × блюд не больше
+    prerender_limit, ответы для всех блюд подставлены заранее; в большом меню запоминаются
+    ответы, которые уже понадобились, тоже не больше prerender_limit.
+    """
+
+    def __init__(self, data, prerender_limit=TEMPLATE_PRERENDER_LIMIT):
+        self.intents = {}
+        for intent, spec in data['intents'].items():
+            allowed = DISH_SLOTS if intent in COMPOSED_INTENTS else INTENT_SLOTS.get(intent, ())
+            self.intents[intent] = tuple(ResponseTemplate(text, allowed) for text in spec['responses'])
+        self.failure = tuple(ResponseTemplate(text, ('dish_name',)) for text in data['failure_phrases'])
+        self.values = {}
+        for dish_name, dish in data['dishes'].items():
+            if 'price' not in dish:
+                raise ValueError(f"У блюда {dish_name} не указана цена")
+            self.values[dish_name] = {'dish_name': dish_name, 'price': str(dish['price']),
+                                      'description': dish.get('description', DEFAULT_DESCRIPTION)}
+        self.prerender_limit = prerender_limit
+        self.prerendered = 0
+        self.prerender()
+
+    def dish_templates(self):
+        for intent, templates in self.intents.items():
+            if intent in INTENT_SLOTS:
+                yield from templates
+        yield from self.failure
+
+    def prerender(self):
+        templates = [template for template in self.dish_templates() if template.slots]
+        if len(templates) * len(self.values) > self.prerender_limit:
+            return
+        for template in templates:
+            if not template.rendered:
+                template.rendered = {dish_name: template.render(values) for dish_name, values in self.values.items()}
+                self.prerendered += len(template.rendered)
+
+    def render(self, template, dish_name):
+        """Ответ по шаблону для блюда из меню."""
+        answer = template.rendered.get(dish_name)
+        if answer is None:
+            answer = template.render(self.values[dish_name])
+            if self.prerendered < self.prerender_limit:
+                template.rendered[dish_name] = answer
+                self.prerendered += 1
+        return answer
+
+
+ConfigVersion.builders['templates'] = ResponseTemplates
+
+
+def get_templates():
+    """Шаблоны ответов текущей версии CONFIG."""
+    return current_config().get('templates')
 
 # Класс для управления статистикой
 class Stats:
@@ -161,4 +1162,6 @@ class Stats:
         else:
             self.stats[type] = 1
         self.context.user_data['stats'] = self.stats
-        logger.info(f"Stats: {self.stats} | Вопрос: {replica} | Ответ: {answer}")
\ No newline at end of file
+        metrics.count(metrics.REPLIES, type)
+        message_logger.info("Stats: %s | Вопрос: %s | Ответ: %s | Лемматизаций: %d", self.stats, replica, answer,
+                            get_lemmatizer_calls())
\ No newline at end of file